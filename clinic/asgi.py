@@ -5,6 +5,13 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+
+The live queue board (home.views.queueevents) keeps one streaming
+response open per screen, so serve the site with an ASGI server, e.g.
+
+    uvicorn clinic.asgi:application
+
+Queue changes are pushed to the screens connected to the same process.
 """
 
 import os
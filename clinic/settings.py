@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'home.middleware.MetricsMiddleware',
+    'home.middleware.RequestIdMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,7 +59,6 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR,"templates")],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -65,12 +66,41 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            # Templates are compiled once per process (and reloaded by the
+            # development server when they change)
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
         },
     },
 ]
 
 WSGI_APPLICATION = 'clinic.wsgi.application'
 
+# Cache of the page fragments (queue tables, history lists) and of their
+# version counters. With several worker processes use a shared cache
+# (e.g. django.core.cache.backends.redis.RedisCache) so that a change made
+# by one worker invalidates the fragments of all of them.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
+# Sessions are read from the cache and only go to the database on a cache
+# miss, so the doctor and reception pages (which only need the role stored
+# in the session at login, see home.roles) make no database reads. With
+# several workers use a shared cache, or keep sessions in the cache only
+# ('django.contrib.sessions.backends.cache') or in signed cookies
+# ('django.contrib.sessions.backends.signed_cookies').
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -79,6 +109,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'timeout': 20,
+        },
     }
 }
 
@@ -119,8 +152,209 @@ USE_TZ = True
 
 STATIC_URL = 'static/' 
 # STATICFILES_DIRS=[os.path.join(BASE_DIR,"static")]
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# collectstatic gives every file a content-hashed name and writes .gz copies
+# of the text files. Run "manage.py optimizeassets" before it to make the
+# resized image variants used by {% optimized %}.
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'home.storage.GzipManifestStaticFilesStorage',
+    },
+}
+
+# Widths (pixels) of the image variants made by optimizeassets, and the
+# width picked by {% optimized %} when a template does not ask for one.
+
+CLINIC_IMAGE_WIDTHS = (640, 1280, 1920)
+CLINIC_IMAGE_WIDTH = 1920
+
+# Serve STATIC_ROOT from Django (outside the development server), with
+# far-future cache headers for the hashed names and max-age
+# CLINIC_STATIC_MAX_AGE (seconds) for the others.
+
+CLINIC_SERVE_STATIC = True
+CLINIC_STATIC_MAX_AGE = 3600
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Clinic data
+# Appointment logs (appointment<doctor>.csv) are kept in this directory.
+
+APPOINTMENT_DIR = BASE_DIR / 'appointment'
+
+# Phone numbers are stored in a canonical form: digits only, without the
+# trunk prefix 0 and without this country code in front of a national
+# number of CLINIC_PHONE_DIGITS digits (see home.phones).
+
+CLINIC_PHONE_COUNTRY_CODE = '91'
+CLINIC_PHONE_DIGITS = 10
+
+# Appointments each doctor takes per day, and how long a booking in progress
+# may hold a slot before the slot is given back.
+
+CLINIC_DAILY_CAPACITY = {
+    'csp': 3,
+    'gendoc': 3,
+}
+CLINIC_SLOT_HOLD_SECONDS = 120
+
+# Days of appointments kept in the Appointment table (today included).
+# Older days are archived in the background as compressed CSV in their
+# AppointmentPartition rows, where they can still be read by date range.
+
+CLINIC_APPOINTMENT_HOT_DAYS = 7
+
+# Doctor each doctor account works as.
+
+CLINIC_DOCTOR_ACCOUNTS = {
+    'sridharandoc': 'csp',
+    'vijayalakshmidoc': 'gendoc',
+}
+
+# Send requests to the patient, doctor and reception pages to the login
+# page unless the user logged in with that role (and as that doctor).
+# For development only, CLINIC_REQUIRE_ROLES=0 in the environment opens
+# every page to anyone.
+
+CLINIC_REQUIRE_ROLES = os.environ.get('CLINIC_REQUIRE_ROLES', '1') != '0'
+
+# Login attempts allowed per username in a window of seconds; attempts
+# over the limit are turned away (429) before the password is checked.
+
+CLINIC_LOGIN_THROTTLE = (5, 60)
+
+# Patient history: snapshot + write-ahead log directory, number of logged
+# changes between compacted snapshots (written by a background thread),
+# and whether every log append is fsync'ed (survives power loss, not only
+# a crash of the server process).
+
+HISTORY_DIR = BASE_DIR / 'appointment'
+HISTORY_SNAPSHOT_EVERY = 1000
+HISTORY_FSYNC = False
+
+# Tree indexing the history in memory. ArrayBinarySearchTree keeps the
+# nodes and records in flat arrays and uses far less memory per patient
+# ("manage.py benchclinic --tree-memory" compares the two):
+#   HISTORY_TREE = 'home.arraytree.ArrayBinarySearchTree'
+
+HISTORY_TREE = 'home.trees.BinarySearchTree'
+
+# Tiered history (see home.coldhistory): at each snapshot, the history of
+# the patients not seen for HISTORY_HOT_DAYS days moves out of memory into
+# compressed segment files read on demand, and back to memory when they
+# visit again (None keeps everything in memory); the history of
+# HISTORY_COLD_CACHE patients read from the segments stays in memory, and
+# segments are merged into one once there are HISTORY_COLD_SEGMENTS.
+# Cold read hits and misses are in /metrics (clinic_history_cold_reads),
+# and load times under clinic_store_seconds{operation="history_cold_load"}.
+
+HISTORY_HOT_DAYS = 365
+HISTORY_COLD_CACHE = 256
+HISTORY_COLD_SEGMENTS = 8
+
+# Number of history entries shown per page of the patient history views.
+
+CLINIC_HISTORY_PAGE_SIZE = 20
+
+# History page cache in front of the state backend (see home.historycache):
+# most pages kept per worker, and seconds a page may be served for.
+
+CLINIC_HISTORY_CACHE_SIZE = 512
+CLINIC_HISTORY_CACHE_SECONDS = 300
+
+# History keyword search (/doctor/historysearch?q=...): most entries
+# returned, and seconds after which the index is rebuilt to pick up the
+# history written by other workers (DatabaseStateBackend only).
+
+CLINIC_HISTORY_SEARCH_LIMIT = 50
+CLINIC_HISTORY_SEARCH_REFRESH = 300
+
+# Where the queues and patient history live. LocalStateBackend keeps them in
+# process memory (run a single worker); DatabaseStateBackend keeps them in
+# the database, shared by all the workers:
+#   CLINIC_STATE_BACKEND = 'home.state.DatabaseStateBackend'
+
+CLINIC_STATE_BACKEND = 'home.state.LocalStateBackend'
+CLINIC_STATE_OPTIONS = {}
+
+# Reception typeahead (/receptionist/recephome/lookup?q=...): most matches
+# returned, and seconds after which the index is rebuilt to pick up the
+# bookings made by other workers.
+
+CLINIC_LOOKUP_LIMIT = 10
+CLINIC_LOOKUP_REFRESH = 300
+
+# Seconds between keep-alive comments sent on an idle live queue stream
+# (the queue pages subscribe to /queue/events/<doctor>).
+
+CLINIC_QUEUE_HEARTBEAT = 15
+
+# Expected waits (queue pages, /queue/wait/<doctor>): consultation length
+# (seconds) assumed until a doctor has been timed, longest gap between two
+# calls still counted as a consultation, and weight of the latest
+# consultation in the moving average.
+
+CLINIC_CONSULTATION_SECONDS = 600
+CLINIC_CONSULTATION_MAX_SECONDS = 3600
+CLINIC_WAIT_EWMA_ALPHA = 0.2
+
+# Daily analytics: seconds between two writes of the counted events to the
+# DailyCount table, number of symptoms listed per doctor and day in the
+# daily report, and days exported to CSV when no range is given.
+
+CLINIC_ANALYTICS_FLUSH_SECONDS = 10
+CLINIC_ANALYTICS_TOP_SYMPTOMS = 10
+CLINIC_ANALYTICS_EXPORT_DAYS = 30
+
+# Addresses allowed to scrape /metrics (request timings, store I/O timings,
+# history tree search depth and queue lengths of the worker).
+
+CLINIC_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# Logging of the clinic app: JSON lines with the request id, written to
+# stderr in batches by a background thread. CLINIC_LOG_SAMPLING keeps only
+# a fraction of the records of chatty events; set CLINIC_LOG_LEVEL to
+# 'DEBUG' to trace history tree searches ("tree.search").
+
+CLINIC_LOG_LEVEL = 'INFO'
+CLINIC_LOG_SAMPLING = {'tree.search': 0.01}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request_id': {'()': 'home.log.RequestIdFilter'},
+        'sampling': {'()': 'home.log.SamplingFilter', 'rates': CLINIC_LOG_SAMPLING},
+    },
+    'formatters': {
+        'json': {'()': 'home.log.JsonFormatter'},
+    },
+    'handlers': {
+        'clinic': {
+            '()': 'home.log.BatchingHandler',
+            'formatter': 'json',
+            'filters': ['sampling', 'request_id'],
+        },
+    },
+    'loggers': {
+        'home': {
+            'handlers': ['clinic'],
+            'level': CLINIC_LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
+
+# Compile every template at startup (HomeConfig.ready) instead of on the
+# first request that uses it.
+
+CLINIC_PRECOMPILE_TEMPLATES = True
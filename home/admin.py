@@ -1,3 +1,44 @@
 from django.contrib import admin
 
+from .models import Appointment, AppointmentPartition, DailyCount, HistoryEntry, Patient, QueueEntry
+
 # Register your models here.
+
+
+@admin.register(Patient)
+class PatientAdmin(admin.ModelAdmin):
+    list_display = ['name', 'phone', 'age', 'gender']
+    search_fields = ['name', 'phone']
+
+
+@admin.register(Appointment)
+class AppointmentAdmin(admin.ModelAdmin):
+    list_display = ['name', 'phone', 'doctor', 'date']
+    list_filter = ['doctor', 'date']
+    search_fields = ['name', 'phone']
+
+
+@admin.register(AppointmentPartition)
+class AppointmentPartitionAdmin(admin.ModelAdmin):
+    list_display = ['doctor', 'date', 'number', 'archived', 'count']
+    list_filter = ['doctor', 'archived']
+    exclude = ['data']
+
+
+@admin.register(QueueEntry)
+class QueueEntryAdmin(admin.ModelAdmin):
+    list_display = ['name', 'phone', 'doctor', 'level']
+    list_filter = ['doctor']
+
+
+@admin.register(HistoryEntry)
+class HistoryEntryAdmin(admin.ModelAdmin):
+    list_display = ['phone', 'doctor', 'entry', 'date']
+    list_filter = ['doctor']
+    search_fields = ['phone']
+
+
+@admin.register(DailyCount)
+class DailyCountAdmin(admin.ModelAdmin):
+    list_display = ['date', 'doctor', 'event', 'key', 'count']
+    list_filter = ['doctor', 'event', 'date']
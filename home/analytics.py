@@ -0,0 +1,167 @@
+import logging
+import re
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DOCTORS, DailyCount
+from .signals import appointment_booked, queue_changed
+
+
+logger = logging.getLogger(__name__)
+
+# Counted events: bookings, bookings turned away (day full), check-ins,
+# check-ins of patients booked for the day, emergency insertions,
+# patients called in, and symptoms (keyed)
+BOOKED = 'booked'
+FULL = 'full'
+CHECKIN = 'checkin'
+ATTENDED = 'attended'
+EMERGENCY = 'emergency'
+SEEN = 'seen'
+SYMPTOM = 'symptom'
+
+QUEUE_EVENTS = {'enqueue': CHECKIN, 'emergency': EMERGENCY, 'dequeue': SEEN}
+
+
+def symptom_phrases(text):
+    """ Splits the symptoms typed in the patient form ("Fever, dry cough")
+    into normalized phrases ("fever", "dry cough").
+    """
+    phrases = (' '.join(part.casefold().split()) for part in re.split(r'[,;/\n]', text or ''))
+    return [phrase[:100] for phrase in phrases if phrase]
+
+
+class DailyStats:
+    """ Daily counters of the clinic, per doctor.
+
+    Events are counted in memory as they happen and a background thread
+    adds them to the DailyCount rows of the day (one row per day, doctor,
+    event and key) every `flush_interval' seconds with atomic increments,
+    so several workers can count into the same rows and a request never
+    waits for the database. A day's report reads the few rows of that
+    day instead of scanning appointments and history.
+    """
+
+    def __init__(self, flush_interval=None):
+        self.flush_interval = (flush_interval if flush_interval is not None
+                               else settings.CLINIC_ANALYTICS_FLUSH_SECONDS)
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def count(self, doctor, event, key='', n=1, day=None):
+        day = day if day is not None else timezone.localdate()
+        with self._lock:
+            self._counts[(day, doctor, event, key)] += n
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='clinic-analytics', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            threading.Event().wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not save the daily counters')
+            finally:
+                close_old_connections()
+
+    def _add(self, day, doctor, event, key, n):
+        rows = DailyCount.objects.filter(date=day, doctor=doctor, event=event, key=key)
+        if rows.update(count=F('count') + n):
+            return
+        try:
+            with transaction.atomic():
+                DailyCount.objects.create(date=day, doctor=doctor, event=event, key=key, count=n)
+        except IntegrityError:
+            # Another worker created the row first
+            rows.update(count=F('count') + n)
+
+    def flush(self):
+        """ Adds the events counted so far to the database.
+        """
+        with self._flush_lock:
+            with self._lock:
+                counts, self._counts = self._counts, Counter()
+            done = []
+            try:
+                for (day, doctor, event, key), n in counts.items():
+                    self._add(day, doctor, event, key, n)
+                    done.append((day, doctor, event, key))
+            finally:
+                for item in done:
+                    del counts[item]
+                if counts:
+                    # Keep what could not be written for the next flush
+                    with self._lock:
+                        self._counts.update(counts)
+
+    def report(self, day, top=None):
+        """ Returns {doctor: figures} of `day': bookings, bookings turned
+        away, check-ins, no-shows (booked but never checked in for the
+        booking),
+        emergencies, patients seen and the `top' symptoms with their counts.
+        """
+        top = top if top is not None else settings.CLINIC_ANALYTICS_TOP_SYMPTOMS
+        return self.range(day, day, top).get(day, self._empty())
+
+    @staticmethod
+    def _empty():
+        return {doctor: {BOOKED: 0, FULL: 0, CHECKIN: 0, ATTENDED: 0, EMERGENCY: 0, SEEN: 0,
+                         'no_shows': 0, 'symptoms': []} for doctor in DOCTORS}
+
+    def range(self, since, until, top=None):
+        """ Returns {day: report(day)} of the days from `since' to `until'
+        that have any counts.
+        """
+        top = top if top is not None else settings.CLINIC_ANALYTICS_TOP_SYMPTOMS
+        days = defaultdict(self._empty)
+        symptom_counts = defaultdict(Counter)
+        rows = (DailyCount.objects.filter(date__gte=since, date__lte=until)
+                .values_list('date', 'doctor', 'event', 'key', 'count'))
+        for day, doctor, event, key, count in rows.iterator():
+            if event == SYMPTOM:
+                symptom_counts[(day, doctor)][key] += count
+            else:
+                days[day][doctor][event] = days[day][doctor].get(event, 0) + count
+        for (day, doctor), counts in symptom_counts.items():
+            days[day][doctor]['symptoms'] = counts.most_common(top)
+        for figures in days.values():
+            for counts in figures.values():
+                # Walk-ins and emergencies check in without a booking
+                counts['no_shows'] = max(counts[BOOKED] - counts[ATTENDED], 0)
+        return dict(sorted(days.items()))
+
+    def symptoms(self, doctor, text):
+        """ Counts the symptoms a patient booked `doctor' for.
+        """
+        for phrase in set(symptom_phrases(text)):
+            self.count(doctor, SYMPTOM, phrase)
+
+    def booked(self, sender, doctor, date=None, **kwargs):
+        """ `appointment_booked' receiver: counts the booking on the day
+        of the appointment.
+        """
+        self.count(doctor, BOOKED, day=date)
+
+    def queueChanged(self, sender, doctor, event, **kwargs):
+        """ `queue_changed' receiver.
+        """
+        if event in QUEUE_EVENTS:
+            self.count(doctor, QUEUE_EVENTS[event])
+# End of the class DailyStats
+
+
+daily = DailyStats()
+
+
+def connect():
+    appointment_booked.connect(daily.booked, dispatch_uid='home.analytics.booked')
+    queue_changed.connect(daily.queueChanged, dispatch_uid='home.analytics.queue')
@@ -0,0 +1,257 @@
+import csv
+import io
+import logging
+import threading
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .metrics import STORE_SECONDS
+from .models import Appointment, AppointmentPartition
+from .phones import canonical_phone
+from .registry import registry
+from .signals import appointment_booked
+from .slots import SlotReservations
+
+
+logger = logging.getLogger(__name__)
+
+
+class AppointmentStore:
+    """ Appointment book for every doctor of the clinic.
+
+    Bookings are Appointment rows. The daily count of a doctor and the
+    check-in lookup on (phone number, name) are answered from the index
+    on the partition of the day instead of a file scan.
+    Rows are converted to and from the appointment CSV format
+    (name, age, email, gender, doctor, phone number) on import/export.
+    The daily cap of every doctor is enforced by slot reservations.
+    The demographics of the patients (age, email, gender) are kept once
+    per patient by the PatientRegistry, not on every appointment.
+
+    The bookings of a doctor and day make an AppointmentPartition, and
+    the book of the day is its latest partition: clearing the day opens
+    a new partition (one INSERT) and keeps the cleared bookings on
+    record. Partitions older than `hot_days' are archived in the
+    background as compressed CSV and their rows leave the Appointment
+    table, which therefore only holds the last few days however long
+    the clinic keeps its records; between() reads both.
+    """
+
+    def __init__(self, slots=None, patients=None, hot_days=None):
+        self.slots = slots if slots is not None else SlotReservations()
+        self.patients = patients if patients is not None else registry
+        self.hot_days = hot_days if hot_days is not None else settings.CLINIC_APPOINTMENT_HOT_DAYS
+        self._archiving = threading.Lock()
+
+    def _appointment(self, row, date):
+        name, age, email, gender, doctor, phone = row
+        phone = canonical_phone(phone) or phone
+        patient_id = self.patients.register(phone, name, age, email, gender)
+        return Appointment(name=name, patient_id=patient_id, doctor=doctor, phone=phone, date=date)
+
+    @staticmethod
+    def _today(date):
+        return date if date is not None else timezone.localdate()
+
+    @staticmethod
+    def _latest(doctor, date):
+        return AppointmentPartition.objects.filter(doctor=doctor, date=date).order_by('-number').first()
+
+    def _open(self, doctor, date, number):
+        try:
+            with transaction.atomic():
+                return AppointmentPartition.objects.create(doctor=doctor, date=date, number=number)
+        except IntegrityError:
+            # Another worker opened it first
+            return self._latest(doctor, date)
+
+    def partition(self, doctor, date=None):
+        """ Returns the current AppointmentPartition of `doctor' on `date'
+        (today by default), opening the first one of the day if needed.
+        """
+        date = self._today(date)
+        partition = self._latest(doctor, date)
+        if partition is None:
+            partition = self._open(doctor, date, 0)
+            # A new day: older days can go to the archive
+            self.archive_later()
+        return partition
+
+    def count(self, doctor, date=None):
+        """ Returns the number of appointments booked with `doctor' on
+        `date' (today by default).
+        """
+        return Appointment.objects.filter(partition=self.partition(doctor, date)).count()
+
+    def find(self, doctor, name, phone, date=None):
+        """ Returns the appointment of (name, phone) with `doctor' on
+        `date' (today by default), or `None' if there is no such appointment.
+        """
+        with STORE_SECONDS.time('appointment_find'):
+            return Appointment.objects.filter(partition=self.partition(doctor, date),
+                                              phone=phone, name=name).first()
+
+    def add(self, doctor, row, date=None):
+        """ Books a row (in the CSV format) with `doctor'.
+        """
+        appointment = self._add(doctor, row, date)
+        self._booked([appointment])
+        return appointment
+
+    def _add(self, doctor, row, date):
+        date = self._today(date)
+        appointment = self._appointment(row, date)
+        appointment.doctor = doctor
+        appointment.partition = self.partition(doctor, date)
+        appointment.save()
+        return appointment
+
+    def _booked(self, appointments):
+        """ Sends `appointment_booked' for `appointments' once they are
+        committed, so a booking rolled back (e.g. a failed import) is
+        never counted.
+        """
+        def send():
+            for appointment in appointments:
+                appointment_booked.send(sender=self.__class__, doctor=appointment.doctor,
+                                        name=appointment.name, phone=appointment.phone,
+                                        date=appointment.date)
+        transaction.on_commit(send)
+
+    def book(self, doctor, row):
+        """ Books a row if `doctor' has a free slot today.
+        Returns `True' if the row was booked.
+        """
+        with STORE_SECONDS.time('appointment_book'):
+            return self._book(doctor, row)
+
+    def _book(self, doctor, row):
+        hold = self.slots.reserve(doctor)
+        if hold is None:
+            return False
+        try:
+            appointment = self._add(doctor, row, hold.date)
+        except BaseException:
+            self.slots.release(hold)
+            raise
+        if not self.slots.confirm(hold):
+            # The hold expired and its slot went to another booking
+            appointment.delete()
+            return False
+        self._booked([appointment])
+        return True
+
+    def rollover(self, doctor, date=None):
+        """ Cancels every appointment booked with `doctor' on `date'
+        (today by default) by opening a new, empty partition. The
+        cancelled bookings stay in the previous partition.
+        """
+        date = self._today(date)
+        self._open(doctor, date, self.partition(doctor, date).number + 1)
+        self.slots.reset(doctor, date)
+
+    @staticmethod
+    def _rows(partition):
+        """ Returns the rows (in the CSV format) of `partition'.
+        """
+        if partition.archived:
+            data = zlib.decompress(partition.data).decode() if partition.data else ''
+            return list(csv.reader(io.StringIO(data, newline='')))
+        rows = (Appointment.objects.filter(partition=partition).order_by('id')
+                .values_list('name', 'patient__age', 'patient__email', 'patient__gender', 'doctor', 'phone'))
+        return [['' if value is None else str(value) for value in row] for row in rows.iterator()]
+
+    def between(self, doctor, since, until):
+        """ Yields (date, partition number, rows) of every partition of
+        `doctor' from `since' to `until' (inclusive), archived or not.
+        """
+        partitions = (AppointmentPartition.objects.filter(doctor=doctor, date__gte=since, date__lte=until)
+                      .order_by('date', 'number'))
+        for partition in partitions.iterator():
+            yield partition.date, partition.number, self._rows(partition)
+
+    def _archive(self, partition):
+        rows = self._rows(partition)
+        out = io.StringIO(newline='')
+        csv.writer(out).writerows(rows)
+        with transaction.atomic():
+            if not AppointmentPartition.objects.filter(pk=partition.pk, archived=False).update(
+                    archived=True, count=len(rows), data=zlib.compress(out.getvalue().encode())):
+                # Archived by another worker
+                return False
+            Appointment.objects.filter(partition=partition).delete()
+        return True
+
+    def archive(self, before=None):
+        """ Archives the partitions dated before `before' (by default
+        the last `hot_days' days are kept). Returns the number of
+        partitions archived.
+        """
+        before = before if before is not None else timezone.localdate() - timedelta(days=self.hot_days - 1)
+        archived = 0
+        with STORE_SECONDS.time('appointment_archive'):
+            for partition in AppointmentPartition.objects.filter(archived=False, date__lt=before).iterator():
+                archived += self._archive(partition)
+        return archived
+
+    def _archiveInBackground(self):
+        try:
+            archived = self.archive()
+            if archived:
+                logger.info('Archived %d appointment partitions', archived)
+        except Exception:
+            logger.exception('Could not archive the appointments')
+        finally:
+            connection.close()
+            self._archiving.release()
+
+    def archive_later(self):
+        """ Runs archive() in a background thread, unless one is running.
+        """
+        if not self._archiving.acquire(blocking=False):
+            return
+        threading.Thread(target=self._archiveInBackground, name='clinic-appointment-archive',
+                         daemon=True).start()
+
+    def _bulkAdd(self, appointments):
+        Appointment.objects.bulk_create(appointments)
+        self._booked(appointments)
+        return len(appointments)
+
+    def import_csv(self, doctor, path, date=None, batch_size=1000):
+        """ Bulk-inserts every row of an appointment CSV file as a booking
+        with `doctor' on `date', `batch_size' rows per INSERT.
+        Returns the number of rows imported.
+        """
+        date = self._today(date)
+        partition = self.partition(doctor, date)
+        imported = 0
+        batch = []
+        with STORE_SECONDS.time('appointment_import'), \
+                open(path, 'r', newline="") as f, transaction.atomic():
+            for row in csv.reader(f):
+                if not row:
+                    continue
+                appointment = self._appointment(row, date)
+                appointment.doctor = doctor
+                appointment.partition = partition
+                batch.append(appointment)
+                if len(batch) == batch_size:
+                    imported += self._bulkAdd(batch)
+                    batch = []
+            if batch:
+                imported += self._bulkAdd(batch)
+        return imported
+
+    def export_csv(self, doctor, path, date=None):
+        """ Writes the appointments of `doctor' on `date' (today by
+        default), archived or not, to `path' in the CSV format.
+        """
+        partition = self._latest(doctor, self._today(date))
+        with STORE_SECONDS.time('appointment_export'), open(path, 'w', newline="") as f:
+            if partition is not None:
+                csv.writer(f).writerows(self._rows(partition))
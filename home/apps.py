@@ -1,6 +1,29 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+def enable_sqlite_wal(sender, connection, **kwargs):
+    """ Lets readers and one writer use a SQLite database at the same time,
+    so several worker processes can share it.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
 
 
 class HomeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'home'
+
+    def ready(self):
+        from . import analytics, events, fulltext, historycache, lookup, templating, waittime
+
+        connection_created.connect(enable_sqlite_wal)
+        events.connect()
+        analytics.connect()
+        lookup.connect()
+        fulltext.connect()
+        templating.connect()
+        historycache.connect()
+        waittime.connect()
@@ -0,0 +1,423 @@
+import logging
+from array import array
+from datetime import date
+
+from .history import DOCTOR_CODES, HistoryRecord
+from .log import log_event
+from .metrics import TREE_COMPARISONS, TREE_SEARCH_DEPTH
+from .models import DOCTORS
+from .trees import AbsBinaryTree
+
+
+logger = logging.getLogger(__name__)
+
+# Index of a missing child or record
+NONE = -1
+
+
+class ArrayBinarySearchTree(AbsBinaryTree):
+    """ AVL tree of patient histories laid out as a struct of arrays.
+
+    Node `i' is the i-th item of parallel arrays -- the integer phone
+    key, the left and right child indices, the subtree height, the
+    doctor code and the first and last record of the patient's history
+    -- instead of a Python object per node. The history records of all
+    the patients share parallel record arrays (date ordinal, doctor
+    code, text offset and length, next record), chaining the records of
+    a patient in date order, and the text of every record sits in one
+    append-only buffer. A patient therefore costs a few machine words
+    however many patients there are.
+
+    Insert and search keep the API of BinarySearchTree: they take and
+    return positions with the `pat_num', `pat_docass' and `pat_his'
+    attributes, `pat_his' behaving like a HistoryRecords. Keys must be
+    integers (see home.phones). Nodes are never deleted.
+    """
+
+    class _historyNode:
+        """ Position of node `index' in an ArrayBinarySearchTree.
+        Made on demand; it holds no data of its own.
+        """
+        __slots__ = ['_tree', '_index']
+
+        def __init__(self, tree, index):
+            self._tree = tree
+            self._index = index
+
+        @property
+        def pat_num(self):
+            return self._tree._keys[self._index]
+
+        @property
+        def pat_docass(self):
+            return DOCTORS[self._tree._docs[self._index]]
+
+        @property
+        def pat_his(self):
+            return _ArrayHistory(self._tree, self._index)
+
+        def __eq__(self, other):
+            return (isinstance(other, type(self))
+                    and self._tree is other._tree and self._index == other._index)
+
+        def __hash__(self):
+            return hash((id(self._tree), self._index))
+    # End of nested class _historyNode
+
+    def __init__(self):
+        self._root = NONE
+        # Nodes
+        self._keys = array('q')
+        self._left = array('l')
+        self._right = array('l')
+        self._heights = array('b')
+        self._docs = array('b')
+        self._first = array('l')
+        self._last = array('l')
+        self._counts = array('l')
+        # History records
+        self._days = array('l')
+        self._codes = array('b')
+        self._offsets = array('q')
+        self._lengths = array('l')
+        self._next = array('l')
+        self._free = []
+        self._blob = bytearray()
+        self._garbage = 0
+
+    def copy(self):
+        """ Returns a copy of this tree (a copy of each of its arrays), so
+        it does not change with this tree.
+        """
+        other = type(self)()
+        other._root = self._root
+        for name in ('_keys', '_left', '_right', '_heights', '_docs', '_first', '_last', '_counts',
+                     '_days', '_codes', '_offsets', '_lengths', '_next'):
+            setattr(other, name, getattr(self, name)[:])
+        other._free = list(self._free)
+        other._blob = bytearray(self._blob)
+        other._garbage = self._garbage
+        return other
+
+    def _position(self, index):
+        return self._historyNode(self, index) if index != NONE else None
+
+    def root(self):
+        """ Returns the root (position) of this tree.
+        """
+        return self._position(self._root)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def left(self, pos):
+        return self._position(self._left[pos._index])
+
+    def right(self, pos):
+        return self._position(self._right[pos._index])
+
+    def numChildren(self, pos):
+        return (self._left[pos._index] != NONE) + (self._right[pos._index] != NONE)
+
+    def parent(self, pos):
+        """ Returns the parent of `pos', found by a search from the root
+        (nodes keep no parent index).
+        """
+        key = self._keys[pos._index]
+        parent, i = NONE, self._root
+        while i != pos._index:
+            parent = i
+            i = self._left[i] if key < self._keys[i] else self._right[i]
+        return self._position(parent)
+
+    def height(self, pos=None):
+        """ Returns the height of the subtree rooted at `pos' in O(1) time.
+        Returns the height of this tree, if `pos' is `None'.
+        """
+        if pos is None:
+            if self.isEmpty():
+                return -1
+            return self._heights[self._root] - 1
+        return self._heights[pos._index] - 1
+
+    # AVL balancing on node indices
+
+    def _nodeHeight(self, i):
+        return self._heights[i] if i != NONE else 0
+
+    def _updateHeight(self, i):
+        self._heights[i] = 1 + max(self._nodeHeight(self._left[i]), self._nodeHeight(self._right[i]))
+
+    def _rotateRight(self, i):
+        top = self._left[i]
+        self._left[i] = self._right[top]
+        self._right[top] = i
+        self._updateHeight(i)
+        self._updateHeight(top)
+        return top
+
+    def _rotateLeft(self, i):
+        top = self._right[i]
+        self._right[i] = self._left[top]
+        self._left[top] = i
+        self._updateHeight(i)
+        self._updateHeight(top)
+        return top
+
+    def _balance(self, i):
+        """ Rebalances the subtree at `i'. Returns the index of its new root.
+        """
+        self._updateHeight(i)
+        balance = self._nodeHeight(self._left[i]) - self._nodeHeight(self._right[i])
+        if balance > 1:
+            child = self._left[i]
+            if self._nodeHeight(self._left[child]) < self._nodeHeight(self._right[child]):
+                self._left[i] = self._rotateLeft(child)
+            return self._rotateRight(i)
+        if balance < -1:
+            child = self._right[i]
+            if self._nodeHeight(self._right[child]) < self._nodeHeight(self._left[child]):
+                self._right[i] = self._rotateRight(child)
+            return self._rotateLeft(i)
+        return i
+
+    def _addNode(self, pat_num, pat_doc):
+        self._keys.append(pat_num)
+        self._left.append(NONE)
+        self._right.append(NONE)
+        self._heights.append(1)
+        self._docs.append(DOCTOR_CODES[pat_doc])
+        self._first.append(NONE)
+        self._last.append(NONE)
+        self._counts.append(0)
+        return len(self._keys) - 1
+
+    def insert(self, pat_num, pathis, pat_doc, pos=None):
+        """ Adds the history `pathis' (HistoryRecords) of patient `pat_num'.
+        The history is appended to the existing node if the patient is
+        already in the tree. Returns the node of the patient.
+        """
+        path = []
+        i = self._root
+        while i != NONE:
+            key = self._keys[i]
+            if pat_num == key:
+                _ArrayHistory(self, i).extend(pathis)
+                return self._historyNode(self, i)
+            path.append(i)
+            i = self._left[i] if pat_num < key else self._right[i]
+        node = self._addNode(pat_num, pat_doc)
+        _ArrayHistory(self, node).extend(pathis)
+        if not path:
+            self._root = node
+            return self._historyNode(self, node)
+        if pat_num < self._keys[path[-1]]:
+            self._left[path[-1]] = node
+        else:
+            self._right[path[-1]] = node
+        # Rebalance from the new leaf up, relinking rotated subtrees
+        for depth in range(len(path) - 1, -1, -1):
+            i = path[depth]
+            top = self._balance(i)
+            if top != i:
+                if depth == 0:
+                    self._root = top
+                elif self._left[path[depth - 1]] == i:
+                    self._left[path[depth - 1]] = top
+                else:
+                    self._right[path[depth - 1]] = top
+        return self._historyNode(self, node)
+
+    def search(self, patnum, pos=None):
+        """ Returns the node of patient `patnum', or `None' if not found.
+        The depth reached and the comparisons made are recorded in the
+        metrics, as in BinarySearchTree.search.
+        """
+        i = pos._index if pos is not None else self._root
+        keys, left, right = self._keys, self._left, self._right
+        path = [] if logger.isEnabledFor(logging.DEBUG) else None
+        depth = comparisons = 0
+        while i != NONE:
+            key = keys[i]
+            if path is not None:
+                path.append(key)
+            depth += 1
+            comparisons += 1
+            if patnum == key:
+                break
+            comparisons += 1
+            i = left[i] if patnum < key else right[i]
+        TREE_SEARCH_DEPTH.observe(depth)
+        TREE_COMPARISONS.inc(comparisons)
+        if path is not None:
+            log_event(logger, 'tree.search', logging.DEBUG, key=patnum, found=i != NONE,
+                      depth=depth, comparisons=comparisons, path=path)
+        return self._position(i)
+
+    # History records
+
+    def _addRecord(self, record):
+        data = record.text.encode()
+        values = (record.date.toordinal(), DOCTOR_CODES[record.doctor], len(self._blob), len(data), NONE)
+        self._blob += data
+        if self._free:
+            r = self._free.pop()
+            (self._days[r], self._codes[r], self._offsets[r],
+             self._lengths[r], self._next[r]) = values
+            return r
+        for column, value in zip((self._days, self._codes, self._offsets, self._lengths, self._next), values):
+            column.append(value)
+        return len(self._days) - 1
+
+    def _freeRecord(self, r):
+        self._garbage += self._lengths[r]
+        self._free.append(r)
+        if self._garbage * 2 > len(self._blob):
+            self._compact()
+
+    def _record(self, r):
+        offset = self._offsets[r]
+        text = self._blob[offset:offset + self._lengths[r]].decode()
+        return HistoryRecord(date.fromordinal(self._days[r]), DOCTORS[self._codes[r]], text)
+
+    def _records(self, node):
+        r = self._first[node]
+        while r != NONE:
+            yield r
+            r = self._next[r]
+
+    def _compact(self):
+        """ Rewrites the text buffer without the text of freed records.
+        """
+        blob = bytearray()
+        for node in range(len(self._keys)):
+            for r in self._records(node):
+                offset = self._offsets[r]
+                self._offsets[r] = len(blob)
+                blob += self._blob[offset:offset + self._lengths[r]]
+        self._blob = blob
+        self._garbage = 0
+# End of the class ArrayBinarySearchTree
+
+
+class _ArrayHistory:
+    """ The history of one patient of an ArrayBinarySearchTree, with the
+    interface of HistoryRecords. Records are kept sorted by date, a
+    record coming after every record of the same day or earlier.
+    """
+    __slots__ = ['_tree', '_node']
+
+    def __init__(self, tree, node):
+        self._tree = tree
+        self._node = node
+
+    def __len__(self):
+        return self._tree._counts[self._node]
+
+    def __iter__(self):
+        for r in self._tree._records(self._node):
+            yield self._tree._record(r)
+
+    def _seek(self, i):
+        """ Returns the record index of the `i'-th record of the patient
+        (0 <= i < len), the latest one in O(1) time.
+        """
+        tree = self._tree
+        if i == tree._counts[self._node] - 1:
+            return tree._last[self._node]
+        nxt = tree._next
+        r = tree._first[self._node]
+        for _ in range(i):
+            r = nxt[r]
+        return r
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('history record index out of range')
+        return self._tree._record(self._seek(i))
+
+    def add(self, record):
+        """ Inserts a HistoryRecord after every record of the same day or earlier.
+        """
+        tree, node = self._tree, self._node
+        new = tree._addRecord(record)
+        day = tree._days[new]
+        if tree._last[node] == NONE or tree._days[tree._last[node]] <= day:
+            # Records mostly come in date order
+            if tree._last[node] == NONE:
+                tree._first[node] = new
+            else:
+                tree._next[tree._last[node]] = new
+            tree._last[node] = new
+        else:
+            prev, r = NONE, tree._first[node]
+            while r != NONE and tree._days[r] <= day:
+                prev, r = r, tree._next[r]
+            tree._next[new] = r
+            if prev == NONE:
+                tree._first[node] = new
+            else:
+                tree._next[prev] = new
+        tree._counts[node] += 1
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def amend(self, record):
+        """ Replaces the latest record with `record'.
+        """
+        tree, node = self._tree, self._node
+        last = tree._last[node]
+        if last != NONE:
+            prev = NONE
+            for r in tree._records(node):
+                if r == last:
+                    break
+                prev = r
+            if prev == NONE:
+                tree._first[node] = NONE
+            else:
+                tree._next[prev] = NONE
+            tree._last[node] = prev
+            tree._counts[node] -= 1
+            tree._freeRecord(last)
+        self.add(record)
+
+    def between(self, start=None, end=None):
+        """ Iterates over the records dated from `start' to `end' (inclusive).
+        """
+        for record in self:
+            if start is not None and record.date < start:
+                continue
+            if end is not None and record.date > end:
+                break
+            yield record
+
+    def page(self, since=None, cursor=None, limit=20):
+        """ Returns up to `limit' records dated `since' or later, starting
+        at `cursor', and the cursor of the next page (`None' on the last).
+        """
+        tree, node = self._tree, self._node
+        count = tree._counts[node]
+        i = int(cursor) if cursor is not None else 0
+        if i >= count or (since is not None and tree._days[tree._last[node]] < since.toordinal()):
+            # Past the end, or every record is older than `since'
+            return [], None
+        # Go straight to the cursor, then skip the records before `since'
+        days, nxt = tree._days, tree._next
+        r = self._seek(i)
+        if since is not None:
+            day = since.toordinal()
+            while days[r] < day:
+                r = nxt[r]
+                i += 1
+        records = []
+        while r != NONE and len(records) < limit:
+            records.append(tree._record(r))
+            r = nxt[r]
+            i += 1
+        return records, (str(i) if r != NONE else None)
+# End of the class _ArrayHistory
@@ -0,0 +1,65 @@
+import functools
+import json
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.templatetags.static import static
+
+
+# Directory (inside the app static files) of the variants made by
+# optimizeassets, and the index of the variants of every image
+OPTIMIZED_DIR = 'optimized'
+VARIANTS = f'{OPTIMIZED_DIR}/variants.json'
+
+
+def variant_name(name, width, fmt):
+    """ Static path of the `width' pixels wide `fmt' variant of image `name'.
+    """
+    stem = os.path.splitext(name)[0]
+    return f'{OPTIMIZED_DIR}/{stem}-{width}.{fmt}'
+
+
+@functools.lru_cache(maxsize=None)
+def variants():
+    """ Returns {image: {"widths": [...], "formats": [...]}} as written by
+    optimizeassets, or {} if it was not run. Read once per process.
+    """
+    if settings.DEBUG:
+        path = finders.find(VARIANTS)
+    else:
+        try:
+            path = staticfiles_storage.path(VARIANTS)
+        except NotImplementedError:
+            path = None
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _url(name):
+    try:
+        return static(name)
+    except ValueError:
+        # Not collected (ManifestStaticFilesStorage is strict)
+        return settings.STATIC_URL + name
+
+
+def optimized_url(name, fmt=None, width=None):
+    """ URL of the best variant of image `name': the narrowest one at
+    least `width' pixels wide (CLINIC_IMAGE_WIDTH by default), in format
+    `fmt' (the format of the original by default). Falls back to the
+    original image when no such variant was made.
+    """
+    info = variants().get(name)
+    fmt = fmt or os.path.splitext(name)[1].lstrip('.').lower()
+    if fmt == 'jpeg':
+        fmt = 'jpg'
+    if info is None or fmt not in info['formats'] or not info['widths']:
+        return _url(name)
+    width = width or settings.CLINIC_IMAGE_WIDTH
+    widths = sorted(info['widths'])
+    chosen = next((w for w in widths if w >= width), widths[-1])
+    return _url(variant_name(name, chosen, fmt))
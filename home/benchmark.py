@@ -0,0 +1,342 @@
+import contextlib
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils.module_loading import import_string
+
+from .appointments import AppointmentStore
+from .models import DOCTORS
+from .registry import PatientRegistry
+from .slots import SlotReservations
+
+
+# Leading digits of Indian mobile numbers: 9 and 8 are the most common
+MOBILE_PREFIXES = [('9', 0.45), ('8', 0.25), ('7', 0.2), ('6', 0.1)]
+
+NAMES = ['Aarav', 'Aditi', 'Arjun', 'Divya', 'Ishaan', 'Kavya', 'Lakshmi', 'Meera',
+         'Nikhil', 'Priya', 'Rahul', 'Saanvi', 'Sridhar', 'Vijay', 'Karuna', 'Anand']
+
+SYMPTOMS = ['fever', 'cough', 'cold', 'headache', 'stomach ache', 'rash', 'sore throat',
+            'back pain', 'ear pain', 'vomiting']
+
+
+class SyntheticPatients:
+    """ Reproducible stream of synthetic patients.
+
+    Phone numbers look like Indian mobile numbers (ten digits starting
+    with 6-9, weighted like real allocations). A share of the visits
+    (`returning') are made by patients seen before, picked with a
+    Zipf-like bias towards a few frequent visitors, so history lookups
+    hit both short and long histories.
+    """
+
+    def __init__(self, seed=0, returning=0.3):
+        self._random = random.Random(seed)
+        self._returning = returning
+        self._seen = []
+        self._phones = set()
+
+    def _phone(self):
+        prefixes, weights = zip(*MOBILE_PREFIXES)
+        while True:
+            phone = self._random.choices(prefixes, weights)[0] + ''.join(
+                self._random.choice('0123456789') for _ in range(9))
+            if phone not in self._phones:
+                self._phones.add(phone)
+                return phone
+
+    def next(self):
+        """ Returns the (name, age, gender, doctor, phone) of the next visit.
+        """
+        rnd = self._random
+        if self._seen and rnd.random() < self._returning:
+            # Zipf-like: the k-th patient ever seen returns with weight 1/k
+            k = min(int(rnd.paretovariate(1.0)), len(self._seen))
+            return self._seen[k - 1]
+        patient = (rnd.choice(NAMES), rnd.randint(1, 90), rnd.choice(['male', 'female', 'others']),
+                   rnd.choice(DOCTORS), self._phone())
+        self._seen.append(patient)
+        return patient
+
+    def symptoms(self):
+        return self._random.choice(SYMPTOMS)
+# End of the class SyntheticPatients
+
+
+class ClinicDay:
+    """ The requests of one synthetic clinic day, in the order they happen.
+
+    Every visit books an appointment and checks in; `emergency_rate' of
+    the visits come in as emergencies instead. Doctors look up the
+    history of the patient, write a prescription and call the next one
+    from the queue, lagging `lag' visits behind the check-in desk.
+    """
+
+    def __init__(self, visits, seed=0, emergency_rate=0.05, lag=5):
+        self.visits = visits
+        self._patients = SyntheticPatients(seed)
+        self._random = random.Random(seed + 1)
+        self._emergency_rate = emergency_rate
+        self._lag = lag
+
+    def requests(self):
+        """ Yields (endpoint, path, data) tuples; `data' is `None' for a GET.
+        """
+        waiting = []
+        for _ in range(self.visits):
+            name, age, gender, doctor, phone = self._patients.next()
+            if self._random.random() < self._emergency_rate:
+                yield 'emergency', '/receptionist/recephome/emergency', {
+                    'submit': '1', 'p_name': name, 'doc_ass': doctor, 'p_num': phone,
+                    'triage': str(self._random.randint(1, 3))}
+            else:
+                yield 'makeappointment', '/patient/patientform', {
+                    'submit': '1', 'p_name': name, 'p_age': str(age), 'p_emailid': '',
+                    'p_gen': gender, 'doc_ass': doctor, 'p_num': phone,
+                    'symptoms': self._patients.symptoms()}
+                yield 'addpatienttoqueue', '/receptionist/recephome/addpatient', {
+                    'submit': '1', 'p_name': name, 'doc_ass': doctor, 'p_num': phone}
+            waiting.append((doctor, phone))
+            if len(waiting) > self._lag:
+                yield from self._consult(*waiting.pop(0))
+        for doctor, phone in waiting:
+            yield from self._consult(doctor, phone)
+
+    def _consult(self, doctor, phone):
+        home = 'doctorcsphome' if doctor == 'csp' else 'doctorgendochome'
+        yield f'{doctor}history', f'/doctor/{home}/patienthis', {'submit': '1', 'p_num': phone}
+        yield f'{doctor}prescription', f'/doctor/{home}/prescription{doctor}', {
+            'submit': '1', 'p_num': phone, 'p_problems': self._patients.symptoms(),
+            'Prescription': 'paracetamol'}
+        yield f'dequeue{doctor}', f'/receptionist/recephome/dequeue{doctor}', None
+        yield f'showqueue{doctor}', f'/receptionist/recephome/showqueue{doctor}', None
+# End of the class ClinicDay
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of the sorted list `values'.
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Benchmark:
+    """ Replays a ClinicDay against the views with the Django test client.
+
+    The day runs on a throwaway test database and a fresh state backend
+    (history in a temporary directory), with the daily cap lifted, so a
+    run never touches real data. `concurrency' threads, each with its
+    own client, take the requests in day order. Latency and throughput
+    are measured on that run; peak memory is measured afterwards by
+    replaying up to `memory_sample' requests of each endpoint one at a
+    time under tracemalloc, which would otherwise skew the latencies.
+    """
+
+    def __init__(self, visits=200, concurrency=4, seed=0, memory_sample=20):
+        self.day = ClinicDay(visits, seed)
+        self.concurrency = concurrency
+        self.seed = seed
+        self.memory_sample = memory_sample
+
+    def run(self):
+        """ Returns the results as a JSON-serialisable dict.
+        """
+        with self._environment():
+            requests = list(self.day.requests())
+            latencies, errors, elapsed = self._replay(requests)
+            memory = self._memory(requests)
+        endpoints = {}
+        for endpoint, times in sorted(latencies.items()):
+            times.sort()
+            endpoints[endpoint] = {
+                'requests': len(times),
+                'errors': errors[endpoint],
+                'p50_ms': percentile(times, 50),
+                'p95_ms': percentile(times, 95),
+                'p99_ms': percentile(times, 99),
+                'throughput_rps': len(times) / elapsed,
+                'peak_memory_kb': memory.get(endpoint),
+            }
+        return {
+            'visits': self.day.visits,
+            'concurrency': self.concurrency,
+            'seed': self.seed,
+            'state_backend': settings.CLINIC_STATE_BACKEND,
+            'elapsed_s': elapsed,
+            'throughput_rps': len(requests) / elapsed,
+            'endpoints': endpoints,
+        }
+
+    @contextlib.contextmanager
+    def _environment(self):
+        from . import views
+        from .historycache import histories
+
+        setup_test_environment()
+        tmp = tempfile.mkdtemp(prefix='clinicbench')
+        if connection.vendor == 'sqlite':
+            # A file, unlike the default in-memory test database, can be
+            # shared by the worker threads
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tmp, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        saved = views.state, views.appointments
+        cached = None
+        try:
+            # The simulated clients do not log in
+            with override_settings(HISTORY_DIR=tmp, CLINIC_REQUIRE_ROLES=False):
+                views.state = import_string(settings.CLINIC_STATE_BACKEND)(**settings.CLINIC_STATE_OPTIONS)
+                # The history views read through the history cache
+                cached = histories.use(views.state)
+                capacity = {doctor: self.day.visits for doctor in DOCTORS}
+                views.appointments = AppointmentStore(SlotReservations(capacity=capacity), PatientRegistry())
+                yield
+        finally:
+            store = getattr(views.state, 'store', None)
+            if store is not None:
+                store.close()
+            views.state, views.appointments = saved
+            histories.use(cached)
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @staticmethod
+    def _send(client, path, data):
+        if data is None:
+            return client.get(path)
+        return client.post(path, data)
+
+    def _replay(self, requests):
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+        lock = threading.Lock()
+        pending = iter(requests)
+
+        def worker():
+            # Exceptions reach the test client through a process-wide
+            # signal, so with several threads they must not be re-raised
+            # (each would be blamed on every request in flight).
+            client = Client(raise_request_exception=False)
+            try:
+                while True:
+                    with lock:
+                        request = next(pending, None)
+                    if request is None:
+                        return
+                    endpoint, path, data = request
+                    start = time.perf_counter()
+                    failed = self._send(client, path, data).status_code >= 400
+                    took = (time.perf_counter() - start) * 1000
+                    with lock:
+                        latencies[endpoint].append(took)
+                        errors[endpoint] += failed
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for future in [pool.submit(worker) for _ in range(self.concurrency)]:
+                future.result()
+        return latencies, errors, time.perf_counter() - start
+
+    def _memory(self, requests):
+        """ Peak memory (KiB) allocated while serving one request, the
+        worst of `memory_sample' requests per endpoint.
+        """
+        sampled = defaultdict(int)
+        peaks = {}
+        client = Client(raise_request_exception=False)
+        tracemalloc.start()
+        try:
+            for endpoint, path, data in requests:
+                if sampled[endpoint] >= self.memory_sample:
+                    continue
+                sampled[endpoint] += 1
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                self._send(client, path, data)
+                peak = (tracemalloc.get_traced_memory()[1] - base) / 1024
+                peaks[endpoint] = max(peaks.get(endpoint, 0), peak)
+        finally:
+            tracemalloc.stop()
+        return peaks
+# End of the class Benchmark
+
+
+def tree_memory(patients=10000, visits=3, seed=0, engines=None):
+    """ Memory (bytes) taken by the history of `patients' synthetic
+    patients with `visits' history records each, indexed by each tree
+    engine in `engines' (dotted paths; the linked and the array-backed
+    trees by default). Every engine is measured on its own under
+    tracemalloc, the records being built before tracing starts.
+    """
+    from .history import HistoryRecord, HistoryRecords
+
+    engines = engines or ['home.trees.BinarySearchTree', 'home.arraytree.ArrayBinarySearchTree']
+    synthetic = SyntheticPatients(seed, returning=0)
+    day = random.Random(seed)
+    histories = []
+    for _ in range(patients):
+        doctor, phone = synthetic.next()[3:]
+        records = [HistoryRecord.parse(f'{synthetic.symptoms()} paracetamol,2024-{day.randint(1, 12):02d}-'
+                                       f'{day.randint(1, 28):02d}', doctor) for _ in range(visits)]
+        histories.append((int(phone), doctor, records))
+    results = {}
+    for engine in engines:
+        tree_class = import_string(engine)
+        tracemalloc.start()
+        try:
+            tree = tree_class()
+            for key, doctor, records in histories:
+                tree.insert(key, HistoryRecords(records), doctor)
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        results[engine] = {'patients': len(tree), 'bytes': size, 'bytes_per_patient': size / len(tree)}
+        del tree
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ Returns the regressions of `results' against `baseline': one line
+    per endpoint whose p95 latency or peak memory grew, or whose
+    throughput fell, by more than `tolerance' (a fraction).
+    """
+    regressions = []
+    for endpoint, old in baseline['endpoints'].items():
+        new = results['endpoints'].get(endpoint)
+        if new is None:
+            continue
+        for key, worse in (('p95_ms', 1), ('peak_memory_kb', 1), ('throughput_rps', -1)):
+            if not old.get(key) or new.get(key) is None:
+                continue
+            change = (new[key] - old[key]) / old[key]
+            if change * worse > tolerance:
+                regressions.append(f'{endpoint}: {key} {old[key]:.2f} -> {new[key]:.2f} ({change:+.0%})')
+    return regressions
+
+
+def load(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
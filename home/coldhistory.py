@@ -0,0 +1,179 @@
+import json
+import mmap
+import os
+import zlib
+from collections import OrderedDict
+
+from .metrics import HISTORY_COLD_READS, STORE_SECONDS
+
+
+class ColdHistory:
+    """ The cold tier of a HistoryStore: history records moved out of
+    memory into compressed segment files.
+
+    A segment (history.<generation>.seg) is a run of blocks, each the
+    zlib-compressed JSON list of some "text,date" entries of one patient
+    of one doctor. Segments are never modified once written; the offset
+    index, {doctor: {key: [(segment, offset, length), ...]}}, lives in
+    memory and is saved with the snapshot of the store. Segments are
+    memory-mapped and a block is decompressed straight from the map.
+    The records of the last `cache_size' patients read are kept, so a
+    patient being looked at (an active patient) is only loaded once.
+    Every method is called under the lock of the HistoryStore, but for
+    write() and saved() on a copy of the index (copyIndex()), which a
+    snapshot calls from its background thread.
+    """
+
+    def __init__(self, directory, cache_size=256):
+        self._dir = directory
+        self._cache_size = cache_size
+        self._index = {}
+        self._maps = {}
+        self._cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def _path(self, segment):
+        return os.path.join(self._dir, segment)
+
+    @property
+    def segments(self):
+        return sorted(self._maps)
+
+    def _map(self, segment):
+        with open(self._path(segment), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load(self, segments, index):
+        """ Opens the `segments' of a snapshot and its saved `index'
+        ({doctor: [[key, [[segment, offset, length], ...]], ...]}).
+        """
+        self.close()
+        self._maps = {segment: self._map(segment) for segment in segments}
+        self._index = {doctor: {key: [tuple(block) for block in blocks] for key, blocks in patients}
+                       for doctor, patients in index.items()}
+
+    def saved(self, index=None):
+        """ Returns the segments used by `index' (the current index by
+        default) and the index in the format saved with the snapshot.
+        """
+        index = index if index is not None else self._index
+        segments = {segment for patients in index.values() for blocks in patients.values()
+                    for segment, offset, length in blocks}
+        return sorted(segments), {doctor: [[key, [list(block) for block in blocks]]
+                                           for key, blocks in patients.items()]
+                                  for doctor, patients in index.items()}
+
+    def copyIndex(self):
+        """ Returns a copy of the offset index that does not change when
+        patients are taken out of the tier.
+        """
+        return {doctor: dict(patients) for doctor, patients in self._index.items()}
+
+    def keys(self, doctor):
+        """ Returns the keys of the patients of `doctor' with cold records.
+        """
+        return list(self._index.get(doctor, ()))
+
+    def __contains__(self, patient):
+        doctor, key = patient
+        return key in self._index.get(doctor, ())
+
+    def _read(self, blocks):
+        entries = []
+        for segment, offset, length in blocks:
+            view = memoryview(self._maps[segment])[offset:offset + length]
+            try:
+                entries.extend(json.loads(zlib.decompress(view)))
+            finally:
+                view.release()
+        return entries
+
+    def records(self, doctor, key):
+        """ Returns the cold "text,date" entries of patient `key' with
+        `doctor', oldest first (empty if it has none).
+        """
+        blocks = self._index.get(doctor, {}).get(key)
+        if not blocks:
+            return []
+        entries = self._cache.get((doctor, key))
+        if entries is not None:
+            self._cache.move_to_end((doctor, key))
+            self.hits += 1
+            HISTORY_COLD_READS.inc(1, 'hit')
+            return entries
+        self.misses += 1
+        HISTORY_COLD_READS.inc(1, 'miss')
+        with STORE_SECONDS.time('history_cold_load'):
+            entries = self._read(blocks)
+        self._cache[(doctor, key)] = entries
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return entries
+
+    def take(self, doctor, key):
+        """ Removes patient `key' of `doctor' from the cold tier and
+        returns its entries (which go back to memory).
+        """
+        entries = self.records(doctor, key)
+        self._index.get(doctor, {}).pop(key, None)
+        self._cache.pop((doctor, key), None)
+        return entries
+
+    def write(self, segment, moved, merge=False, index=None):
+        """ Writes the entries `moved' out of memory ({doctor: {key:
+        entries}}) to a new `segment' and returns `index' (the current
+        index by default) including them. With `merge', every cold entry
+        is rewritten to the new segment, one block per patient, so the
+        older segments are no longer needed.
+        """
+        base = index if index is not None else self._index
+        index = {doctor: ({} if merge else {key: list(blocks) for key, blocks in patients.items()})
+                 for doctor, patients in base.items()}
+        written = []
+        with open(self._path(segment), 'wb') as f:
+            def block(doctor, key, entries):
+                data = zlib.compress(json.dumps(entries).encode())
+                index.setdefault(doctor, {}).setdefault(key, []).append((segment, f.tell(), len(data)))
+                f.write(data)
+                written.append(key)
+
+            for doctor, patients in moved.items():
+                for key, entries in patients.items():
+                    if merge and key in base.get(doctor, ()):
+                        entries = self._read(base[doctor][key]) + entries
+                    block(doctor, key, entries)
+            if merge:
+                for doctor, patients in base.items():
+                    for key, blocks in patients.items():
+                        if key not in moved.get(doctor, ()):
+                            block(doctor, key, self._read(blocks))
+            f.flush()
+            os.fsync(f.fileno())
+        if not written:
+            os.remove(self._path(segment))
+        return index
+
+    def replace(self, index=None):
+        """ Switches to `index' (keeps the current index by default) once
+        the snapshot saving it is written, and closes and deletes the
+        segments it no longer uses.
+        """
+        used = set(self.saved(index)[0])
+        for segment in used - set(self._maps):
+            self._maps[segment] = self._map(segment)
+        for segment in set(self._maps) - used:
+            self._maps.pop(segment).close()
+            os.remove(self._path(segment))
+        if index is not None:
+            # The records read of a patient whose blocks stayed put are
+            # still good
+            for doctor, key in list(self._cache):
+                if index.get(doctor, {}).get(key) != self._index.get(doctor, {}).get(key):
+                    del self._cache[(doctor, key)]
+            self._index = index
+
+    def close(self):
+        for segment in self._maps.values():
+            segment.close()
+        self._maps = {}
+# End of the class ColdHistory
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import threading
+
+from .signals import queue_changed
+
+
+class QueueFeed:
+    """ Fans the queue changes of this process out to live queue screens.
+
+    Each screen subscribes to the feed of one doctor and gets a bounded
+    asyncio.Queue of events. Changes are made by the (sync) views on
+    worker threads, so events are handed to the event loop of each
+    subscriber with `call_soon_threadsafe'. A screen that falls
+    `maxsize' events behind is marked stale and reloads the whole queue
+    instead of being sent an ever growing backlog.
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, doctor):
+        """ Returns a new subscription to the changes of `doctor'.
+        Must be called from the event loop that will read it.
+        """
+        sub = _Subscription(asyncio.get_running_loop(), self.maxsize)
+        with self._lock:
+            self._subscribers.setdefault(doctor, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, doctor, sub):
+        with self._lock:
+            subs = self._subscribers.get(doctor)
+            if subs is not None:
+                subs.discard(sub)
+
+    def publish(self, doctor, event, data):
+        with self._lock:
+            subs = list(self._subscribers.get(doctor, ()))
+        for sub in subs:
+            try:
+                sub.loop.call_soon_threadsafe(sub.put, event, data)
+            except RuntimeError:
+                # The loop of a disconnected screen is already closed
+                self.unsubscribe(doctor, sub)
+
+    def receiver(self, sender, doctor, event, patient, position=None, **kwargs):
+        """ `queue_changed' receiver publishing the change as a delta.
+        """
+        self.publish(doctor, event, {'name': patient.patname, 'doctor': patient.doc,
+                                     'phone': patient.pnum, 'position': position})
+# End of the class QueueFeed
+
+
+class _Subscription:
+    """ Events of one doctor waiting to be sent to one screen.
+    """
+    __slots__ = ['loop', 'events', 'stale']
+
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.events = asyncio.Queue(maxsize)
+        self.stale = False
+
+    def put(self, event, data):
+        try:
+            self.events.put_nowait((event, data))
+        except asyncio.QueueFull:
+            self.stale = True
+
+    def reset(self):
+        """ Drops the queued events and clears the stale mark, before the
+        whole queue is reloaded.
+        """
+        while True:
+            try:
+                self.events.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        self.stale = False
+
+
+def sse(event, data):
+    """ Formats one Server-Sent Event.
+    """
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+feed = QueueFeed()
+
+
+def connect():
+    queue_changed.connect(feed.receiver, dispatch_uid='home.events.feed')
@@ -0,0 +1,191 @@
+import logging
+import re
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .history import parse_entry
+from .models import DOCTORS
+from .signals import history_changed
+
+
+logger = logging.getLogger(__name__)
+
+
+def tokenize(text):
+    """ Returns the set of lower-cased words of `text'.
+    """
+    return set(re.findall(r'\w+', text.casefold()))
+
+
+class HistoryIndex:
+    """ Inverted index over the symptoms and prescriptions of the patient
+    history of every doctor.
+
+    Every history entry is identified by (doctor, phone, i), `i' being
+    its place in the patient's history, and every word of its text has
+    a posting set of the entries it appears in. A keyword query
+    intersects the posting sets of its words, smallest first, so it only
+    looks at entries holding all of them instead of walking the history
+    trees. The index keeps references and dates only: the text of the
+    entries found is read back from the state, one history per patient.
+    The entries of a patient are re-indexed whenever their history
+    changes (the `history_changed' signal, sent on bookings and
+    prescriptions). The index is built on the first search; with a state
+    shared by several workers, a background thread rebuilds it every
+    `refresh' seconds to pick up the changes made by the others. The
+    state of a single worker is never rebuilt: every change already came
+    through the signal, and a rebuild would read back the cold history
+    segments of every patient.
+    """
+
+    def __init__(self, refresh=None):
+        self._refresh = refresh if refresh is not None else settings.CLINIC_HISTORY_SEARCH_REFRESH
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._built = False
+        self._pending = None
+        self._thread = None
+        self._entries = {}
+        self._postings = {}
+
+    @staticmethod
+    def _unindex(entries, postings, doctor, phone):
+        days, tokens = entries.pop((doctor, phone), ((), ()))
+        for token in tokens:
+            posting = postings.get(token)
+            if posting is not None:
+                posting.difference_update((doctor, phone, i) for i in range(len(days)))
+                if not posting:
+                    del postings[token]
+
+    @classmethod
+    def _index(cls, entries, postings, doctor, phone, history):
+        cls._unindex(entries, postings, doctor, phone)
+        days = []
+        words = set()
+        for i, entry in enumerate(history):
+            text, day = parse_entry(str(entry))
+            tokens = tokenize(text)
+            days.append(day)
+            words |= tokens
+            for token in tokens:
+                postings.setdefault(token, set()).add((doctor, phone, i))
+        if days:
+            # The dates filter the hits; the words find the postings to
+            # drop when the patient is re-indexed
+            entries[(doctor, phone)] = (days, words)
+
+    def _build(self):
+        """ Rebuilds the index. The patients whose history changes while
+        it is read are re-indexed once the new index is in place.
+        """
+        from .state import get_state
+
+        with self._build_lock:
+            with self._lock:
+                self._pending = set()
+            try:
+                state = get_state()
+                entries = {}
+                postings = {}
+                for doctor in DOCTORS:
+                    for phone, history in state.all_history(doctor):
+                        self._index(entries, postings, doctor, phone, history)
+            except BaseException:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                self._entries, self._postings = entries, postings
+                for doctor, phone in self._pending:
+                    self._reindex(state, doctor, phone)
+                self._pending = None
+                self._built = True
+
+    def _run(self):
+        while True:
+            threading.Event().wait(self._refresh)
+            try:
+                self._build()
+            except Exception:
+                logger.exception('Could not rebuild the history search index')
+            finally:
+                close_old_connections()
+
+    def _reindex(self, state, doctor, phone):
+        self._index(self._entries, self._postings, doctor, phone, state.history(doctor, phone) or ())
+
+    def reindex(self, doctor, phone):
+        """ Indexes the current history of patient `phone' with `doctor'.
+        """
+        from .state import get_state
+
+        with self._lock:
+            if self._pending is not None:
+                self._pending.add((doctor, phone))
+            # Read under the lock, so the last change is indexed last
+            if self._built:
+                self._reindex(get_state(), doctor, phone)
+
+    def search(self, query, since=None, until=None, doctor=None, limit=50):
+        """ Returns the history entries holding every word of `query',
+        dated from `since' to `until' (inclusive) and of `doctor' if
+        given, as dicts of doctor, phone, date and text, latest first.
+        At most `limit' entries are returned.
+        """
+        from .state import get_state
+
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        state = get_state()
+        if not self._built:
+            self._build()
+            with self._lock:
+                if self._thread is None and state.shared:
+                    self._thread = threading.Thread(target=self._run, name='clinic-history-search',
+                                                    daemon=True)
+                    self._thread.start()
+        with self._lock:
+            postings = sorted((self._postings.get(token, set()) for token in tokens), key=len)
+            hits = set(postings[0]).intersection(*postings[1:])
+            found = []
+            for entry_doctor, phone, i in hits:
+                if doctor is not None and entry_doctor != doctor:
+                    continue
+                day = self._entries[(entry_doctor, phone)][0][i]
+                if (since is not None and day < since) or (until is not None and day > until):
+                    continue
+                found.append((day, entry_doctor, phone, i))
+        found.sort(key=lambda hit: hit[0], reverse=True)
+        histories = {}
+        matches = []
+        for day, entry_doctor, phone, i in found:
+            if len(matches) == limit:
+                break
+            if (entry_doctor, phone) not in histories:
+                histories[(entry_doctor, phone)] = list(state.history(entry_doctor, phone) or ())
+            history = histories[(entry_doctor, phone)]
+            if i >= len(history):
+                continue
+            text, entry_day = parse_entry(str(history[i]))
+            # Skip an entry changed by another worker since it was indexed
+            if entry_day != day or not tokens <= tokenize(text):
+                continue
+            matches.append({'doctor': entry_doctor, 'phone': phone, 'date': day.isoformat(), 'text': text})
+        return matches
+
+    def receiver(self, sender, doctor, pat_num, **kwargs):
+        """ `history_changed' receiver.
+        """
+        self.reindex(doctor, pat_num)
+# End of the class HistoryIndex
+
+
+index = HistoryIndex()
+
+
+def connect():
+    history_changed.connect(index.receiver, dispatch_uid='home.fulltext.index')
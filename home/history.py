@@ -0,0 +1,567 @@
+import heapq
+import json
+import logging
+import os
+import threading
+from array import array
+from collections import namedtuple
+from datetime import date, timedelta
+from operator import attrgetter
+
+from .coldhistory import ColdHistory
+from .metrics import STORE_SECONDS
+from .models import DOCTORS
+from .phones import InvalidPhone, phone_key, phone_text
+from .trees import BinarySearchTree
+
+
+logger = logging.getLogger(__name__)
+
+DOCTOR_CODES = {doctor: code for code, doctor in enumerate(DOCTORS)}
+
+
+def parse_entry(entry):
+    """ Splits a history entry "text,YYYY-MM-DD" into (text, date).
+    Entries without a valid trailing date are dated today.
+    """
+    text, sep, day = entry.rpartition(',')
+    if sep:
+        try:
+            return text, date.fromisoformat(day.strip())
+        except ValueError:
+            pass
+    return entry, date.today()
+
+
+class HistoryRecord(namedtuple('HistoryRecord', ['date', 'doctor', 'text'])):
+    """ One visit of a patient. Prints as the "text,date" history entry.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return f'{self.text},{self.date.isoformat()}'
+
+    @classmethod
+    def parse(cls, entry, doctor):
+        text, day = parse_entry(entry)
+        return cls(day, doctor, text)
+
+
+class HistoryRecords:
+    """ Compact history of one patient, ordered by date.
+
+    Each record is four ints in one array -- the date as a day ordinal,
+    the interned code of the doctor, and the offset and length of its
+    text -- while the UTF-8 text of all the records sits in a separate
+    append-only blob. A patient therefore costs two objects however long
+    their history gets. Records are kept sorted by date, so date ranges
+    and pages are found by binary search and read straight from the
+    arrays. Text replaced by `amend' is reclaimed once it makes up half
+    of the blob.
+    """
+    __slots__ = ['_recs', '_blob', '_garbage']
+
+    def __init__(self, records=()):
+        self._recs = array('l')
+        self._blob = bytearray()
+        self._garbage = 0
+        self.extend(records)
+
+    def copy(self):
+        """ Returns a copy of these records that does not change with them.
+        """
+        other = HistoryRecords()
+        other._recs = self._recs[:]
+        other._blob = bytearray(self._blob)
+        other._garbage = self._garbage
+        return other
+
+    def __len__(self):
+        return len(self._recs) // 4
+
+    def _record(self, i):
+        day, code, offset, length = self._recs[i * 4:i * 4 + 4]
+        text = self._blob[offset:offset + length].decode()
+        return HistoryRecord(date.fromordinal(day), DOCTORS[code], text)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._record(i)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('history record index out of range')
+        return self._record(i)
+
+    def _bisect(self, day, right=True):
+        """ Index of the first record dated after (`right') or on `day'.
+        """
+        recs = self._recs
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if recs[mid * 4] < day or (right and recs[mid * 4] == day):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def add(self, record):
+        """ Inserts a HistoryRecord after every record of the same day or earlier.
+        """
+        data = record.text.encode()
+        day = record.date.toordinal()
+        i = self._bisect(day)
+        self._recs[i * 4:i * 4] = array('l', (day, DOCTOR_CODES[record.doctor],
+                                              len(self._blob), len(data)))
+        self._blob += data
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def amend(self, record):
+        """ Replaces the latest record with `record'.
+        """
+        if len(self):
+            self._garbage += self._recs[-1]
+            del self._recs[-4:]
+        self.add(record)
+        if self._garbage * 2 > len(self._blob):
+            self._compact()
+
+    def _compact(self):
+        blob = bytearray()
+        recs = self._recs
+        for i in range(2, len(recs), 4):
+            offset = recs[i]
+            recs[i] = len(blob)
+            blob += self._blob[offset:offset + recs[i + 1]]
+        self._blob = blob
+        self._garbage = 0
+
+    def between(self, start=None, end=None):
+        """ Iterates over the records dated from `start' to `end' (inclusive).
+        """
+        lo = self._bisect(start.toordinal(), right=False) if start is not None else 0
+        hi = self._bisect(end.toordinal()) if end is not None else len(self)
+        for i in range(lo, hi):
+            yield self._record(i)
+
+    def page(self, since=None, cursor=None, limit=20):
+        """ Returns up to `limit' records dated `since' or later, starting
+        at `cursor', and the cursor of the next page (`None' on the last).
+        """
+        start = self._bisect(since.toordinal(), right=False) if since is not None else 0
+        if cursor is not None:
+            start = max(start, int(cursor))
+        end = min(start + limit, len(self))
+        records = [self._record(i) for i in range(start, end)]
+        return records, (str(end) if end < len(self) else None)
+
+
+class HistoryStore:
+    """ Durable patient history of every doctor of the clinic.
+
+    The history of each doctor is indexed in memory by a BinarySearchTree
+    (or the `tree_class' given, e.g. the compact ArrayBinarySearchTree)
+    whose nodes hold the HistoryRecords of a patient, keyed on the
+    integer phone key of the patient (see home.phones), so different
+    spellings of a number share one node and comparisons are int compares.
+    Every change is first appended to a write-ahead log (one JSON record
+    per line) and then applied to the tree. Once `snapshot_every' records
+    have been logged, a fresh log is started and the trees are written
+    out as a compacted snapshot, so a restart only loads the snapshot and
+    replays the short log written after it. The snapshot is written by a
+    background thread from copies of the trees, so requests go on while
+    it is dumped and synced; its trees then replace the ones in use, and
+    the changes logged in the meantime are applied to them again.
+
+    With `hot_days', the history is tiered: when a snapshot is written,
+    the patients not seen for `hot_days' days leave the trees for a
+    compressed segment of the cold tier (see ColdHistory), read back on
+    demand, so memory holds the history of the active patients only. A
+    patient of the cold tier who visits again comes back to memory. Cold segments are
+    merged into one once there are `cold_segments' of them.
+
+    Files in `directory':
+        history.snapshot.json  -- the latest snapshot and its generation
+        history.<generation>.wal -- log of the changes made after it
+        history.<generation>.seg -- cold records moved out at a snapshot
+    """
+
+    SNAPSHOT = 'history.snapshot.json'
+
+    def __init__(self, directory, doctors=DOCTORS, snapshot_every=1000, fsync=False,
+                 tree_class=BinarySearchTree, hot_days=None, cold_cache=256, cold_segments=8):
+        self._dir = directory
+        self._hot_days = hot_days
+        self._cold_segments = cold_segments
+        self._cold = ColdHistory(directory, cold_cache)
+        self._tree_class = tree_class
+        self._snapshot_every = snapshot_every
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._snapshotting = threading.Lock()
+        self._trees = {doctor: tree_class() for doctor in doctors}
+        self._generation = 0
+        self._pending = 0
+        # Records logged while a snapshot is written (None if none is)
+        self._since = None
+        self._wal = None
+        os.makedirs(directory, exist_ok=True)
+        with STORE_SECONDS.time('history_recover'):
+            self._recover()
+
+    def _path(self, name):
+        return os.path.join(self._dir, name)
+
+    def _walPath(self, generation):
+        return self._path(f'history.{generation}.wal')
+
+    def tree(self, doctor):
+        """ Returns the in-memory index (the hot tier) of the given doctor.
+        """
+        return self._trees[doctor]
+
+    def _recover(self):
+        """ Rebuilds the trees from the snapshot and the tail of the log.
+        A partially written last record (the process died mid-append)
+        is cut off the log.
+        """
+        snapshot = self._path(self.SNAPSHOT)
+        if os.path.exists(snapshot):
+            with open(snapshot, 'r') as f:
+                data = json.load(f)
+            self._generation = data['generation']
+            for doctor, nodes in data['doctors'].items():
+                tree = self._trees.setdefault(doctor, self._tree_class())
+                for pat_num, pat_docass, pat_his in nodes:
+                    records = (HistoryRecord.parse(entry, doctor) for entry in pat_his)
+                    # Snapshots written before keys were normalized hold
+                    # strings; spellings of the same number are merged
+                    try:
+                        key = phone_key(pat_num)
+                    except InvalidPhone:
+                        logger.warning('Dropping the history of invalid phone number %r', pat_num)
+                        continue
+                    tree.insert(key, HistoryRecords(records), pat_docass)
+            self._cold.load(data.get('segments', []), data.get('cold', {}))
+
+        covered = self._generation
+        while True:
+            self._replayLog(self._walPath(self._generation))
+            # A snapshot was being written when the process stopped: the
+            # changes made meanwhile are in the log of the next generation
+            if not os.path.exists(self._walPath(self._generation + 1)):
+                break
+            self._generation += 1
+
+        # Logs of older generations are already part of the snapshot, and
+        # segments it does not use were left by a snapshot that failed
+        for name in os.listdir(self._dir):
+            parts = name.split('.')
+            if len(parts) != 3 or parts[0] != 'history' or not parts[1].isdigit():
+                continue
+            if ((parts[2] == 'wal' and int(parts[1]) < covered)
+                    or (parts[2] == 'seg' and name not in self._cold.segments)):
+                os.remove(self._path(name))
+
+        self._wal = open(self._walPath(self._generation), 'a')
+
+    def _replayLog(self, wal):
+        if not os.path.exists(wal):
+            return
+        with open(wal, 'rb+') as f:
+            good = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._replay(record)
+                self._pending += 1
+                good += len(line)
+            f.truncate(good)
+
+    def _replay(self, record):
+        """ Applies a logged record again, skipping one that cannot be
+        applied rather than failing the whole recovery.
+        """
+        try:
+            self._apply(record)
+        except InvalidPhone:
+            logger.warning('Skipping a logged change of invalid phone number %r', record['num'])
+        except Exception:
+            logger.exception('Skipping a logged change that cannot be applied: %r', record)
+
+    def _validate(self, record):
+        """ Raises ValueError if `record' could not be applied, before it
+        is logged.
+        """
+        if record['doctor'] not in self._trees or record['doctor'] not in DOCTOR_CODES:
+            raise ValueError(f"Unknown doctor: {record['doctor']!r}")
+        entries = record['entries'] if record['op'] == 'add' else [record['entry']]
+        if not all(isinstance(entry, str) for entry in entries):
+            raise ValueError(f'History entries must be strings: {entries!r}')
+
+    def _apply(self, record):
+        doctor = record['doctor']
+        tree = self._trees[doctor]
+        key = phone_key(record['num'])
+        if record['op'] == 'add':
+            records = [HistoryRecord.parse(entry, doctor) for entry in record['entries']]
+            if (doctor, key) in self._cold and tree.search(key) is None:
+                # A patient back after a long time: the whole history is hot again
+                records = [HistoryRecord.parse(entry, doctor) for entry in self._cold.take(doctor, key)] + records
+            tree.insert(key, HistoryRecords(records), doctor)
+        elif record['op'] == 'amend':
+            pos = tree.search(key)
+            if pos is None:
+                # The latest record may be cold: bring the patient back in memory
+                records = HistoryRecords(HistoryRecord.parse(entry, doctor)
+                                         for entry in self._cold.take(doctor, key))
+                records.amend(HistoryRecord.parse(record['entry'], doctor))
+                tree.insert(key, records, doctor)
+            else:
+                pos.pat_his.amend(HistoryRecord.parse(record['entry'], doctor))
+
+    def _log(self, record):
+        """ Appends a record to the log, applies it and starts a snapshot
+        if due.
+        """
+        self._validate(record)
+        with self._lock:
+            with STORE_SECONDS.time('history_append'):
+                self._wal.write(json.dumps(record) + '\n')
+                self._wal.flush()
+                if self._fsync:
+                    os.fsync(self._wal.fileno())
+            self._apply(record)
+            self._pending += 1
+            if self._since is not None:
+                self._since.append(record)
+            if self._pending >= self._snapshot_every:
+                self._snapshotLater()
+
+    def add(self, doctor, pat_num, entries):
+        """ Appends the history `entries' (a list) of patient `pat_num'.
+        """
+        self._log({'op': 'add', 'doctor': doctor, 'num': phone_key(pat_num), 'entries': entries})
+
+    def amend(self, doctor, pat_num, entry):
+        """ Replaces the latest history entry of patient `pat_num' with
+        `entry', adding the patient if it has no history yet.
+        """
+        self._log({'op': 'amend', 'doctor': doctor, 'num': phone_key(pat_num), 'entry': entry})
+
+    def snapshot(self):
+        """ Writes a compacted snapshot and starts a new log, once the
+        snapshot being written in the background (if any) is done.
+        """
+        with self._snapshotting:
+            with self._lock:
+                job = self._rotate()
+            self._snapshot(*job)
+
+    def _snapshotLater(self):
+        """ Starts a snapshot in a background thread, unless one is being
+        written. Called under the lock.
+        """
+        if not self._snapshotting.acquire(blocking=False):
+            return
+        threading.Thread(target=self._snapshotInBackground, args=self._rotate(),
+                         name='clinic-history-snapshot', daemon=True).start()
+
+    def _snapshotInBackground(self, generation, trees, cold):
+        try:
+            self._snapshot(generation, trees, cold)
+        except Exception:
+            logger.exception('Could not write the history snapshot')
+        finally:
+            self._snapshotting.release()
+
+    def _rotate(self):
+        """ Starts the log of a new generation and returns it with copies
+        of the trees and of the cold index, which the snapshot of that
+        generation is written from. Called under the lock.
+        """
+        generation = self._generation + 1
+        self._wal.close()
+        self._wal = open(self._walPath(generation), 'a')
+        self._generation = generation
+        self._pending = 0
+        self._since = []
+        trees = {doctor: tree.copy() for doctor, tree in self._trees.items()}
+        return generation, trees, self._cold.copyIndex()
+
+    def _snapshot(self, generation, trees, cold):
+        try:
+            with STORE_SECONDS.time('history_snapshot'):
+                trees, cold = self._writeSnapshot(generation, trees, cold)
+        except BaseException:
+            with self._lock:
+                self._since = None
+                # The cold segment written for the failed snapshot is not used
+                segment = self._path(f'history.{generation}.seg')
+                if os.path.exists(segment):
+                    os.remove(segment)
+            raise
+        with self._lock:
+            self._swap(generation, trees, cold)
+
+    def _tier(self, generation, trees, cold):
+        """ Moves the history of the patients of `trees' whose last visit
+        is older than `hot_days' days to a new cold segment. Returns the
+        trees holding the other patients and the cold index including the
+        new segment (`cold' if unchanged).
+        """
+        if self._hot_days is None:
+            return trees, cold
+        cutoff = date.today() - timedelta(days=self._hot_days)
+        moved = {}
+        for doctor, tree in trees.items():
+            for pos in tree.positions():
+                if len(pos.pat_his) and pos.pat_his[-1].date < cutoff:
+                    moved.setdefault(doctor, {})[pos.pat_num] = [str(record) for record in pos.pat_his]
+        kept = dict(trees)
+        for doctor, patients in moved.items():
+            # Rebuild the trees that lose patients, without them
+            kept[doctor] = self._tree_class()
+            for pos in trees[doctor].positions():
+                if pos.pat_num not in patients and len(pos.pat_his):
+                    kept[doctor].insert(pos.pat_num, pos.pat_his, pos.pat_docass)
+        if not moved and len(self._cold.segments) < self._cold_segments:
+            return kept, cold
+        segment = f'history.{generation}.seg'
+        return kept, self._cold.write(segment, moved, merge=len(self._cold.segments) >= self._cold_segments,
+                                      index=cold)
+
+    def _writeSnapshot(self, generation, trees, cold):
+        """ Writes the snapshot of `generation' from copies of the trees
+        and of the cold index. Returns the trees and the cold index it
+        holds.
+        """
+        trees, cold = self._tier(generation, trees, cold)
+        segments, saved = self._cold.saved(cold)
+        data = {
+            'generation': generation,
+            'doctors': {
+                doctor: [[pos.pat_num, pos.pat_docass, [str(record) for record in pos.pat_his]]
+                         for pos in tree.positions()]
+                for doctor, tree in trees.items()
+            },
+            'segments': segments,
+            'cold': saved,
+        }
+        tmp = self._path(self.SNAPSHOT + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # The snapshot of the new generation becomes visible atomically;
+        # from here on recovery ignores the older logs.
+        os.replace(tmp, self._path(self.SNAPSHOT))
+        return trees, cold
+
+    def _swap(self, generation, trees, cold):
+        """ Switches to the trees and cold index of the snapshot just
+        written, and applies the changes logged since they were copied.
+        Called under the lock.
+        """
+        # Segments no longer used (patients back in memory, or merged)
+        # are deleted
+        self._cold.replace(cold)
+        self._trees = trees
+        since, self._since = self._since, None
+        for record in since:
+            self._replay(record)
+        old = generation - 1
+        while os.path.exists(self._walPath(old)):
+            os.remove(self._walPath(old))
+            old -= 1
+
+    def _search(self, doctor, key):
+        pos = self._trees[doctor].search(key)
+        cold = self._cold.records(doctor, key)
+        if not cold:
+            return pos.pat_his if pos is not None else None
+        records = HistoryRecords(HistoryRecord.parse(entry, doctor) for entry in cold)
+        if pos is not None:
+            records.extend(pos.pat_his)
+        return records
+
+    def search(self, doctor, pat_num):
+        """ Returns the HistoryRecords of patient `pat_num' with `doctor',
+        or `None' if the patient has no history.
+        """
+        try:
+            key = phone_key(pat_num)
+        except InvalidPhone:
+            return None
+        with self._lock:
+            pat_his = self._search(doctor, key)
+            # A copy: the records in the tree change with the next visit
+            return HistoryRecords(pat_his) if pat_his is not None else None
+
+    def patients(self, doctor):
+        """ Returns the phone numbers of the patients of `doctor' with history.
+        """
+        with self._lock:
+            keys = [pos.pat_num for pos in self._trees[doctor].positions()]
+            hot = set(keys)
+            keys.extend(key for key in self._cold.keys(doctor) if key not in hot)
+            return [phone_text(key) for key in keys]
+
+    def tiers(self):
+        """ Returns the patients with records in memory and in the cold
+        segments, and the hits and misses of the cold reads.
+        """
+        with self._lock:
+            cold = self._cold
+            return {'hot_patients': sum(len(tree) for tree in self._trees.values()),
+                    'cold_patients': sum(len(cold.keys(doctor)) for doctor in self._trees),
+                    'segments': len(cold.segments), 'cold_hits': cold.hits, 'cold_misses': cold.misses}
+
+    def patient(self, pat_num):
+        """ Returns the HistoryRecords of patient `pat_num' with every
+        doctor, merged in date order, or `None' if the patient has no
+        history.
+        """
+        try:
+            key = phone_key(pat_num)
+        except InvalidPhone:
+            return None
+        with self._lock:
+            found = [pat_his for pat_his in (self._search(doctor, key) for doctor in self._trees)
+                     if pat_his is not None]
+            if not found:
+                return None
+            return HistoryRecords(heapq.merge(*found, key=attrgetter('date')))
+
+    def page(self, doctor, pat_num, since=None, cursor=None, limit=20):
+        """ Returns a page of the history of patient `pat_num' with
+        `doctor' (see HistoryRecords.page), or `None' if the patient
+        has no history.
+        """
+        try:
+            key = phone_key(pat_num)
+        except InvalidPhone:
+            return None
+        with self._lock:
+            pat_his = self._search(doctor, key)
+            if pat_his is None:
+                return None
+            return pat_his.page(since, cursor, limit)
+
+    def close(self):
+        # Let a snapshot being written finish first
+        with self._snapshotting, self._lock:
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+            self._cold.close()
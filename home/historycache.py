@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .metrics import HISTORY_CACHE
+from .signals import history_changed, queue_changed
+from .templating import history_version
+
+
+class HistoryCache:
+    """ Bounded LRU cache of history pages, in front of the state backend.
+
+    A page is kept under (doctor, pat_num, since, cursor, limit) with the
+    history version of the patient (see templating) it was read at. A
+    page is only served while that version is current and for `ttl'
+    seconds at most, so a history written by another worker is never
+    shown stale if the Django cache is shared, and for `ttl' seconds at
+    most otherwise. The history changes of this process drop the pages
+    of the patient at once (write-through invalidation). When a doctor
+    calls a patient in, the first page of their history is read ahead,
+    so the doctor's first search is a hit. The least recently used page
+    is dropped when more than `size' pages are cached.
+    """
+
+    def __init__(self, state=None, size=None, ttl=None):
+        self._state = state
+        self._size = size if size is not None else settings.CLINIC_HISTORY_CACHE_SIZE
+        self._ttl = ttl if ttl is not None else settings.CLINIC_HISTORY_CACHE_SECONDS
+        self._pages = OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """ The backend read through: the one given to the cache, or else
+        the configured one (get_state()), looked up when it is needed
+        rather than when this module is imported.
+        """
+        from .state import get_state
+
+        return self._state if self._state is not None else get_state()
+
+    def use(self, state):
+        """ Reads through `state' (the configured backend if `None') from
+        now on, dropping the pages read from the previous backend.
+        Returns the previous backend (`None' for the configured one).
+        """
+        with self._lock:
+            previous, self._state = self._state, state
+            self._pages.clear()
+            self._keys.clear()
+        return previous
+
+    def _drop(self, key):
+        del self._pages[key]
+        patient = key[:2]
+        keys = self._keys[patient]
+        keys.discard(key)
+        if not keys:
+            del self._keys[patient]
+
+    def _get(self, key, version):
+        with self._lock:
+            cached = self._pages.get(key)
+            if cached is None:
+                return None
+            page, cached_version, expires = cached
+            if cached_version != version or expires < time.monotonic():
+                self._drop(key)
+                return None
+            self._pages.move_to_end(key)
+            return page
+
+    def _put(self, key, version, page):
+        with self._lock:
+            if key in self._pages:
+                self._drop(key)
+            self._pages[key] = (page, version, time.monotonic() + self._ttl)
+            self._keys.setdefault(key[:2], set()).add(key)
+            while len(self._pages) > self._size:
+                self._drop(next(iter(self._pages)))
+
+    def page(self, doctor, pat_num, since=None, cursor=None, limit=None, version=None):
+        """ Returns state.history_page(doctor, pat_num, since, cursor, limit),
+        from the cache if possible. `version' is the current history
+        version of the patient, read if not given.
+        """
+        limit = limit if limit is not None else settings.CLINIC_HISTORY_PAGE_SIZE
+        version = version if version is not None else history_version(doctor, pat_num)
+        key = (doctor, pat_num, since, cursor, limit)
+        page = self._get(key, version)
+        if page is not None:
+            HISTORY_CACHE.inc(1, 'hit')
+            return page
+        HISTORY_CACHE.inc(1, 'miss')
+        page = self.state.history_page(doctor, pat_num, since, cursor, limit)
+        if page is not None:
+            self._put(key, version, page)
+        return page
+
+    def prefetch(self, doctor, pat_num):
+        """ Reads the first page of the history of `pat_num' into the cache.
+        """
+        limit = settings.CLINIC_HISTORY_PAGE_SIZE
+        version = history_version(doctor, pat_num)
+        key = (doctor, pat_num, None, None, limit)
+        if self._get(key, version) is not None:
+            return
+        page = self.state.history_page(doctor, pat_num, None, None, limit)
+        if page is not None:
+            HISTORY_CACHE.inc(1, 'prefetch')
+            self._put(key, version, page)
+
+    def invalidate(self, doctor, pat_num):
+        """ Drops the cached pages of the history of `pat_num' with `doctor'.
+        """
+        with self._lock:
+            for key in list(self._keys.get((doctor, pat_num), ())):
+                self._drop(key)
+
+    def __len__(self):
+        return len(self._pages)
+
+    def historyChanged(self, sender, doctor, pat_num, **kwargs):
+        """ `history_changed' receiver.
+        """
+        self.invalidate(doctor, pat_num)
+
+    def queueChanged(self, sender, doctor, event, patient, **kwargs):
+        """ `queue_changed' receiver: reads ahead the history of the
+        patient a doctor just called in.
+        """
+        if event == 'dequeue':
+            self.prefetch(doctor, patient.pnum)
+# End of the class HistoryCache
+
+
+histories = HistoryCache()
+
+
+def connect():
+    history_changed.connect(histories.historyChanged, dispatch_uid='home.historycache.history')
+    queue_changed.connect(histories.queueChanged, dispatch_uid='home.historycache.queue')
@@ -0,0 +1,149 @@
+import contextvars
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+
+
+# Id of the request being served, set by RequestIdMiddleware
+request_id = contextvars.ContextVar('request_id', default=None)
+
+# LogRecord attributes that are not extra fields of an event
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def log_event(logger, event, level=logging.INFO, **fields):
+    """ Logs the structured event `event' (e.g. "appointment.booked")
+    with the given fields. Nothing is built if `level' is disabled.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'event': event, 'fields': fields})
+
+
+class RequestIdFilter(logging.Filter):
+    """ Stamps records with the id of the current request.
+    """
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """ Keeps a fraction of the records of each event type.
+    `rates' maps an event name to the fraction kept (0 to 1); events
+    not listed, and records that are not events, are all kept.
+    Warnings and errors are never dropped.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None), 1)
+        return rate >= 1 or record.levelno >= logging.WARNING or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one line of JSON.
+    """
+
+    def format(self, record):
+        data = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                    + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        data.update(getattr(record, 'fields', None) or {})
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key not in data and key != 'fields':
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class BatchingHandler(logging.Handler):
+    """ Non-blocking handler writing records in batches.
+
+    `emit' only puts the record on a bounded queue, so logging never
+    waits for I/O; a background thread formats the queued records and
+    writes them `batch_size' at a time, at least every `flush_interval'
+    seconds. When the queue is full the record is dropped and counted
+    in `dropped' rather than slowing the request down.
+    """
+
+    def __init__(self, stream=None, filename=None, batch_size=100, flush_interval=0.5,
+                 capacity=10000):
+        super().__init__()
+        if filename is not None:
+            stream = open(filename, 'a', encoding='utf-8')
+        self.stream = stream if stream is not None else sys.stderr
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(capacity)
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='clinic-log', daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _take(self, timeout):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.format(record) + '\n')
+            except Exception:
+                self.handleError(record)
+        if lines:
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+
+    def _run(self):
+        while not self._closed.is_set():
+            batch = self._take(self.flush_interval)
+            if batch:
+                with self._write_lock:
+                    self._write(batch)
+
+    def flush(self):
+        """ Writes out the records queued so far (from the calling thread).
+        """
+        with self._write_lock:
+            while True:
+                batch = self._take(0)
+                if not batch:
+                    break
+                self._write(batch)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join(self.flush_interval * 2)
+        self.flush()
+        if self.stream not in (sys.stderr, sys.stdout):
+            self.stream.close()
+        super().close()
@@ -0,0 +1,193 @@
+import logging
+import re
+import threading
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import DOCTORS, Appointment, Patient
+from .phones import canonical_phone
+from .signals import appointment_booked, history_changed
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_name(name):
+    """ Lower-cases `name' and reduces it to words of letters and digits.
+    """
+    return ' '.join(re.findall(r'\w+', (name or '').casefold()))
+
+
+class PatientLookup:
+    """ Typeahead index of the patients of the clinic.
+
+    Patients (one per phone number and doctor) are found by a prefix of
+    their phone number or of any word of their normalized name. Each
+    index is a sorted array of (key, phone, doctor) tuples, so the
+    matches of a prefix are a contiguous run found by one binary search.
+    The index is built from the appointments and the patient history
+    on the first search, then updated on every booking and history
+    change made by this process. A background thread rebuilds it every
+    `refresh' seconds, without holding up the searches, so that the
+    bookings made by other workers show up as well.
+    """
+
+    def __init__(self, refresh=None):
+        self._refresh = refresh if refresh is not None else settings.CLINIC_LOOKUP_REFRESH
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._built = False
+        self._pending = None
+        self._thread = None
+        self._names = {}
+        self._byPhone = []
+        self._byName = []
+
+    @staticmethod
+    def _nameKeys(name):
+        words = name.split()
+        # Every word of the name starts a key, so "kumar" finds "ravi kumar"
+        return [' '.join(words[i:]) for i in range(len(words))]
+
+    def _add(self, doctor, name, phone):
+        phone = canonical_phone(phone)
+        if not phone:
+            return
+        name = (name or '').strip()
+        normalized = normalize_name(name)
+        patient = (phone, doctor)
+        old = self._names.get(patient)
+        if old is None:
+            insort(self._byPhone, (phone, phone, doctor))
+        elif not normalized:
+            return
+        elif normalize_name(old) == normalized:
+            self._names[patient] = name
+            return
+        else:
+            for key in self._nameKeys(normalize_name(old)):
+                i = bisect_left(self._byName, (key, phone, doctor))
+                if i < len(self._byName) and self._byName[i] == (key, phone, doctor):
+                    del self._byName[i]
+        self._names[patient] = name
+        for key in self._nameKeys(normalized):
+            insort(self._byName, (key, phone, doctor))
+
+    def _read(self):
+        """ Reads the patients from the database and the history and
+        returns the names and the two sorted indexes.
+        """
+        from .state import get_state
+
+        names = {}
+
+        def read(doctor, name, phone):
+            phone = canonical_phone(phone)
+            if phone:
+                name = (name or '').strip()
+                # The latest booking names the patient, unless unnamed
+                if name or (phone, doctor) not in names:
+                    names[(phone, doctor)] = name
+
+        rows = Appointment.objects.order_by('id').values_list('doctor', 'name', 'phone')
+        for doctor, name, phone in rows.iterator():
+            read(doctor, name, phone)
+        # Patients whose bookings were archived are named from the registry
+        registry = dict(Patient.objects.values_list('phone', 'name').iterator())
+        state = get_state()
+        for doctor in DOCTORS:
+            for phone in state.history_patients(doctor):
+                if (canonical_phone(phone), doctor) not in names:
+                    read(doctor, registry.get(phone, ''), phone)
+        byPhone = sorted((phone, phone, doctor) for phone, doctor in names)
+        byName = sorted((key, phone, doctor) for (phone, doctor), name in names.items()
+                        for key in self._nameKeys(normalize_name(name)))
+        return names, byPhone, byName
+
+    def _build(self):
+        """ Rebuilds the index. The changes made while the database is
+        read are applied to the new index once it is in place.
+        """
+        with self._build_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                index = self._read()
+            except BaseException:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                self._names, self._byPhone, self._byName = index
+                for patient in self._pending:
+                    self._add(*patient)
+                self._pending = None
+                self._built = True
+
+    def _run(self):
+        while True:
+            threading.Event().wait(self._refresh)
+            try:
+                self._build()
+            except Exception:
+                logger.exception('Could not rebuild the patient lookup')
+            finally:
+                close_old_connections()
+
+    def add(self, doctor, name, phone):
+        """ Adds (or renames) the patient `phone' of `doctor'.
+        """
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((doctor, name, phone))
+            if self._built:
+                self._add(doctor, name, phone)
+
+    @staticmethod
+    def _scan(index, prefix, seen, doctor, limit):
+        i = bisect_left(index, (prefix,))
+        while i < len(index) and len(seen) < limit:
+            key, phone, patient_doctor = index[i]
+            if not key.startswith(prefix):
+                break
+            if doctor is None or patient_doctor == doctor:
+                seen.setdefault((phone, patient_doctor), None)
+            i += 1
+
+    def search(self, query, limit=10, doctor=None):
+        """ Returns up to `limit' patients matching `query' (a prefix of a
+        phone number or of a name) as dicts of name, phone and doctor,
+        matches on the phone number first.
+        """
+        if not self._built:
+            self._build()
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='clinic-lookup', daemon=True)
+                    self._thread.start()
+        with self._lock:
+            seen = {}
+            phone = canonical_phone(query)
+            if phone and not re.search(r'[^\d\s()+-]', query):
+                self._scan(self._byPhone, phone, seen, doctor, limit)
+            name = normalize_name(query)
+            if name:
+                self._scan(self._byName, name, seen, doctor, limit)
+            return [{'name': self._names[patient], 'phone': patient[0], 'doctor': patient[1]}
+                    for patient in seen]
+
+    def receiver(self, sender, doctor, phone=None, name='', pat_num=None, **kwargs):
+        """ `appointment_booked' and `history_changed' receiver.
+        """
+        self.add(doctor, name, phone if phone is not None else pat_num)
+# End of the class PatientLookup
+
+
+lookup = PatientLookup()
+
+
+def connect():
+    appointment_booked.connect(lookup.receiver, dispatch_uid='home.lookup.booked')
+    history_changed.connect(lookup.receiver, dispatch_uid='home.lookup.history')
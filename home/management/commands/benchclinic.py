@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from home.benchmark import Benchmark, compare, load, save, tree_memory
+
+
+class Command(BaseCommand):
+    help = ("Replays a synthetic clinic day against the booking, check-in, queue and "
+            "history views on a test database and reports latency, throughput and "
+            "peak memory per endpoint.")
+
+    # The benchmark swaps in its own state; loading the URLconf for the
+    # checks would create the real one first.
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--visits', type=int, default=200,
+                            help="Number of patient visits in the day.")
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help="Number of clients sending requests at the same time.")
+        parser.add_argument('--seed', type=int, default=0,
+                            help="Seed of the synthetic patients.")
+        parser.add_argument('--memory-sample', type=int, default=20,
+                            help="Requests per endpoint replayed under tracemalloc.")
+        parser.add_argument('--save', metavar='PATH',
+                            help="Write the results to PATH as a JSON baseline.")
+        parser.add_argument('--baseline', metavar='PATH',
+                            help="Compare with the JSON baseline at PATH; fails on regressions.")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Allowed relative regression against the baseline.")
+        parser.add_argument('--tree-memory', type=int, metavar='PATIENTS',
+                            help="Only compare the memory taken by the history tree engines "
+                                 "for PATIENTS synthetic patients.")
+
+    def handle(self, *args, **options):
+        if options['tree_memory'] is not None:
+            return self._treeMemory(options['tree_memory'], options['seed'])
+        if options['visits'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--visits and --concurrency must be at least 1.")
+        baseline = load(options['baseline']) if options['baseline'] else None
+        results = Benchmark(options['visits'], options['concurrency'], options['seed'],
+                            options['memory_sample']).run()
+
+        self.stdout.write(f"{results['visits']} visits, {results['concurrency']} clients, "
+                          f"{results['elapsed_s']:.2f}s, {results['throughput_rps']:.1f} req/s")
+        self.stdout.write(f"{'endpoint':<22}{'reqs':>6}{'errs':>6}{'p50 ms':>9}{'p95 ms':>9}"
+                          f"{'p99 ms':>9}{'req/s':>9}{'peak KiB':>10}")
+        for endpoint, row in results['endpoints'].items():
+            peak = row['peak_memory_kb']
+            self.stdout.write(f"{endpoint:<22}{row['requests']:>6}{row['errors']:>6}"
+                              f"{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+                              f"{row['throughput_rps']:>9.1f}"
+                              f"{'-' if peak is None else format(peak, '.1f'):>10}")
+
+        if options['save']:
+            save(results, options['save'])
+            self.stdout.write(f"Saved the results to {options['save']}")
+        if baseline is not None:
+            regressions = compare(results, baseline, options['tolerance'])
+            if regressions:
+                for line in regressions:
+                    self.stderr.write(line)
+                raise CommandError(f"{len(regressions)} regressions against {options['baseline']}.")
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {options['baseline']}."))
+
+    def _treeMemory(self, patients, seed):
+        if patients < 1:
+            raise CommandError("--tree-memory must be at least 1.")
+        self.stdout.write(f"{'engine':<42}{'patients':>10}{'KiB':>12}{'B/patient':>11}")
+        for engine, row in tree_memory(patients, seed=seed).items():
+            self.stdout.write(f"{engine:<42}{row['patients']:>10}{row['bytes'] / 1024:>12.1f}"
+                              f"{row['bytes_per_patient']:>11.1f}")
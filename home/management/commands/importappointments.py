@@ -0,0 +1,32 @@
+import os
+from datetime import date
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from home.appointments import AppointmentStore
+from home.models import DOCTORS
+
+
+class Command(BaseCommand):
+    help = "Bulk-imports the appointment<doctor>.csv files into the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=str(settings.APPOINTMENT_DIR),
+                            help="Directory holding the appointment CSV files.")
+        parser.add_argument('--date', type=date.fromisoformat, default=None,
+                            help="Booking date of the imported rows (YYYY-MM-DD, default today).")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of rows per bulk INSERT.")
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['dir']):
+            raise CommandError(f"{options['dir']} is not a directory.")
+        store = AppointmentStore()
+        for doctor in DOCTORS:
+            path = os.path.join(options['dir'], f'appointment{doctor}.csv')
+            if not os.path.exists(path):
+                continue
+            imported = store.import_csv(doctor, path, date=options['date'],
+                                        batch_size=options['batch_size'])
+            self.stdout.write(f"{doctor}: imported {imported} appointments from {path}")
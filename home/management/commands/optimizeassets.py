@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.management.base import BaseCommand, CommandError
+
+from home.assets import OPTIMIZED_DIR, variant_name
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+SOURCE_FORMATS = {'.jpg': 'jpg', '.jpeg': 'jpg', '.png': 'png'}
+
+
+class Command(BaseCommand):
+    help = ("Makes resized, recompressed variants (progressive JPEG or PNG, and WebP) "
+            "of the static images, for the {% optimized %} template tag. "
+            "Run it before collectstatic. Needs Pillow.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=os.path.join(apps.get_app_config('home').path,
+                                                             'static', OPTIMIZED_DIR),
+                            help="Directory the variants are written to.")
+        parser.add_argument('--quality', type=int, default=80,
+                            help="JPEG quality of the variants (WebP uses 5 less).")
+        parser.add_argument('--force', action='store_true',
+                            help="Remake variants that are newer than their image.")
+
+    def handle(self, *args, **options):
+        if Image is None:
+            raise CommandError("optimizeassets needs Pillow: pip install Pillow")
+        output = options['output']
+        os.makedirs(output, exist_ok=True)
+        index = {}
+        seen = set()
+        for finder in finders.get_finders():
+            for path, storage in finder.list(['CVS', '.*', '*~']):
+                fmt = SOURCE_FORMATS.get(os.path.splitext(path)[1].lower())
+                path = path.replace(os.sep, '/')
+                if fmt is None or path.startswith(OPTIMIZED_DIR + '/') or path in seen:
+                    continue
+                seen.add(path)
+                index[path] = self._optimize(path, storage.path(path), fmt, output, options)
+        with open(os.path.join(output, 'variants.json'), 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        self.stdout.write(f"Optimized {len(index)} images into {output}")
+
+    def _optimize(self, name, source, fmt, output, options):
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            widths = sorted(w for w in settings.CLINIC_IMAGE_WIDTHS if w < image.width)
+            if image.width <= max(settings.CLINIC_IMAGE_WIDTHS):
+                widths.append(image.width)
+            before = os.path.getsize(source)
+            after = 0
+            for width in widths:
+                resized = image
+                if width != image.width:
+                    resized = image.resize((width, round(image.height * width / image.width)),
+                                           Image.LANCZOS)
+                for variant in (fmt, 'webp'):
+                    target = os.path.join(output, os.path.relpath(variant_name(name, width, variant),
+                                                                  OPTIMIZED_DIR))
+                    if (not options['force'] and os.path.exists(target)
+                            and os.path.getmtime(target) >= os.path.getmtime(source)):
+                        continue
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    self._save(resized, target, variant, options['quality'])
+                    if (variant == fmt and width == image.width
+                            and os.path.getsize(target) > os.path.getsize(source)):
+                        # Already well compressed; keep the original bytes
+                        shutil.copyfile(source, target)
+                after = os.path.getsize(os.path.join(
+                    output, os.path.relpath(variant_name(name, width, fmt), OPTIMIZED_DIR)))
+        self.stdout.write(f"{name}: {before // 1024} KiB -> {after // 1024} KiB at {widths[-1]}px "
+                          f"({', '.join(map(str, widths))})")
+        return {'widths': widths, 'formats': [fmt, 'webp']}
+
+    @staticmethod
+    def _save(image, target, fmt, quality):
+        if fmt == 'jpg':
+            image.convert('RGB').save(target, 'JPEG', quality=quality, optimize=True, progressive=True)
+        elif fmt == 'png':
+            image.save(target, 'PNG', optimize=True)
+        else:
+            image.save(target, 'WEBP', quality=quality - 5, method=6)
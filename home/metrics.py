@@ -0,0 +1,267 @@
+import threading
+import time
+from bisect import bisect_left
+
+
+# Upper bounds (seconds) of the latency buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _labelText(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    text = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                     .replace('\n', r'\n'))
+                    for name, value in pairs)
+    return '{' + text + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """ Base class of the metrics of a Registry.
+    A metric keeps one series per combination of label values.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """ Yields the (name, label text, value) lines of this metric.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{labels} {_number(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+# End of the class Metric
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        for values, total in series:
+            yield self.name + '_total', _labelText(self.labels, values), total
+# End of the class Counter
+
+
+class Gauge(Metric):
+    """ A value that goes up and down. A gauge built with `function'
+    is not set but read when the metrics are collected: `function'
+    returns a dict {label values (tuple): value}.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self._function = function
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._series[labels] = value
+
+    def samples(self):
+        if self._function is not None:
+            series = sorted(self._function().items())
+        else:
+            with self._lock:
+                series = sorted(self._series.items())
+        for values, value in series:
+            yield self.name, _labelText(self.labels, values), value
+# End of the class Gauge
+
+
+class _Timer:
+    __slots__ = ['_histogram', '_labels', '_start']
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labels)
+
+
+class _HistogramSeries:
+    """ Bucket counts of one series of a Histogram: since start, and per
+    time slot for the rolling window.
+    """
+    __slots__ = ['counts', 'sum', 'slots']
+
+    def __init__(self, buckets, window_slots):
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0
+        # [slot number, counts] for the latest `window_slots' slots
+        self.slots = [[-1, [0] * (buckets + 1)] for _ in range(window_slots)]
+
+
+class Histogram(Metric):
+    """ Distribution of observed values (e.g. latencies) in fixed buckets.
+
+    Besides the cumulative buckets scraped by Prometheus, every series
+    keeps the bucket counts of the last `window' seconds in a ring of
+    `window_slots' slots, from which the quantiles of recent traffic are
+    estimated in memory. Observing is a bisect and a few additions.
+    """
+    type = 'histogram'
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, window=60, window_slots=6):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._slot_seconds = window / window_slots
+        self._window_slots = window_slots
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        slot = int(time.monotonic() // self._slot_seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = _HistogramSeries(len(self.buckets), self._window_slots)
+            series.counts[i] += 1
+            series.sum += value
+            current = series.slots[slot % self._window_slots]
+            if current[0] != slot:
+                current[0] = slot
+                current[1] = [0] * (len(self.buckets) + 1)
+            current[1][i] += 1
+
+    def time(self, *labels):
+        """ Context manager observing the seconds spent in its block.
+        """
+        return _Timer(self, labels)
+
+    def _window(self, series):
+        oldest = int(time.monotonic() // self._slot_seconds) - self._window_slots
+        counts = [0] * (len(self.buckets) + 1)
+        for slot, slot_counts in series.slots:
+            if slot > oldest:
+                counts = [a + b for a, b in zip(counts, slot_counts)]
+        return counts
+
+    def quantile(self, q, counts):
+        """ Estimates quantile `q' from bucket `counts', interpolating
+        linearly inside the bucket (like Prometheus' histogram_quantile).
+        """
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def window(self, *labels):
+        """ Returns {quantile: value} over the rolling window of a series.
+        """
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                return {}
+            counts = self._window(series)
+        return {q: self.quantile(q, counts) for q in self.QUANTILES}
+
+    def samples(self):
+        with self._lock:
+            series = sorted((values, list(s.counts), s.sum, self._window(s))
+                            for values, s in self._series.items())
+        for values, counts, total, window in series:
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                seen += count
+                yield (self.name + '_bucket',
+                       _labelText(self.labels, values, [('le', _number(bound))]), seen)
+            yield self.name + '_sum', _labelText(self.labels, values), total
+            yield self.name + '_count', _labelText(self.labels, values), seen
+
+    def render(self):
+        text = super().render()
+        # Quantiles of the rolling window as a separate gauge family
+        name = self.name + '_window'
+        lines = [f'# HELP {name} {self.help} (last {self._slot_seconds * self._window_slots:g}s)',
+                 f'# TYPE {name} gauge']
+        with self._lock:
+            windows = sorted((values, self._window(s)) for values, s in self._series.items())
+        for values, counts in windows:
+            for q in self.QUANTILES:
+                value = self.quantile(q, counts)
+                if value is not None:
+                    lines.append(f'{name}{_labelText(self.labels, values, [("quantile", q)])} {_number(value)}')
+        return text + '\n' + '\n'.join(lines)
+# End of the class Histogram
+
+
+class Registry:
+    """ The metrics of this process, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+def _queueLengths():
+    from .models import DOCTORS
+    from .state import get_state
+
+    state = get_state()
+    return {(doctor,): state.queue_size(doctor) for doctor in DOCTORS}
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(Histogram(
+    'clinic_request_seconds', "Time spent serving a request, by route.", ['route', 'method']))
+RESPONSES = registry.register(Counter(
+    'clinic_responses', "Responses sent, by status code.", ['status']))
+STORE_SECONDS = registry.register(Histogram(
+    'clinic_store_seconds', "Time spent in appointment and history store I/O.", ['operation']))
+TREE_SEARCH_DEPTH = registry.register(Histogram(
+    'clinic_tree_search_depth', "Nodes visited by a history tree search.",
+    buckets=(1, 2, 4, 8, 12, 16, 20, 24, 32)))
+TREE_COMPARISONS = registry.register(Counter(
+    'clinic_tree_comparisons', "Key comparisons made by history tree searches."))
+QUEUE_LENGTH = registry.register(Gauge(
+    'clinic_queue_length', "Patients waiting, by doctor.", ['doctor'], function=_queueLengths))
+LOGINS_THROTTLED = registry.register(Counter(
+    'clinic_logins_throttled', "Login attempts turned away by the login throttle, by role.", ['role']))
+HISTORY_CACHE = registry.register(Counter(
+    'clinic_history_cache', "History page cache lookups, by result (hit, miss, prefetch).", ['result']))
+HISTORY_COLD_READS = registry.register(Counter(
+    'clinic_history_cold_reads', "Reads of history moved to the cold segments, by result (hit, miss).",
+    ['result']))
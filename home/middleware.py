@@ -0,0 +1,85 @@
+import re
+import time
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .log import request_id
+from .metrics import REQUEST_SECONDS, RESPONSES
+
+
+class MetricsMiddleware:
+    """ Times every request by route (the URL pattern, so the number of
+    series stays small) and counts the responses by status code.
+    Put it first in MIDDLEWARE to include the time of the other middleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def _record(request, response, seconds):
+        match = request.resolver_match
+        route = match.route if match is not None else '<unmatched>'
+        REQUEST_SECONDS.observe(seconds, route, request.method)
+        RESPONSES.inc(1, str(response.status_code))
+
+
+class RequestIdMiddleware:
+    """ Gives every request an id, stamped on its log records (see
+    home.log) and sent back in the X-Request-ID header. An id sent by a
+    proxy in X-Request-ID is kept if it looks sane.
+    """
+    sync_capable = True
+    async_capable = True
+    VALID = re.compile(r'[\w.-]{1,64}')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _start(self, request):
+        rid = request.META.get('HTTP_X_REQUEST_ID', '')
+        if not self.VALID.fullmatch(rid):
+            rid = uuid.uuid4().hex
+        request.id = rid
+        return request_id.set(rid)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = self._start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_id.reset(token)
+        response['X-Request-ID'] = request.id
+        return response
+
+    async def __acall__(self, request):
+        token = self._start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_id.reset(token)
+        response['X-Request-ID'] = request.id
+        return response
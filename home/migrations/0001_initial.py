@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:39
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Appointment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('age', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('email', models.CharField(blank=True, max_length=254)),
+                ('gender', models.CharField(blank=True, max_length=10)),
+                ('doctor', models.CharField(choices=[('csp', 'child specialist'), ('gendoc', 'general doctor')], max_length=10)),
+                ('phone', models.CharField(max_length=15)),
+                ('date', models.DateField(default=django.utils.timezone.localdate)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['doctor', 'date'], name='home_appoin_doctor_236f7c_idx'), models.Index(fields=['phone', 'doctor'], name='home_appoin_phone_e08840_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='HistoryEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doctor', models.CharField(choices=[('csp', 'child specialist'), ('gendoc', 'general doctor')], max_length=10)),
+                ('phone', models.CharField(max_length=15)),
+                ('entry', models.TextField()),
+                ('date', models.DateField(default=django.utils.timezone.localdate)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['phone', 'doctor'], name='home_histor_phone_3bd9de_idx'), models.Index(fields=['doctor', 'date'], name='home_histor_doctor_9479ce_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='QueueEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doctor', models.CharField(choices=[('csp', 'child specialist'), ('gendoc', 'general doctor')], max_length=10)),
+                ('level', models.PositiveSmallIntegerField()),
+                ('name', models.CharField(max_length=100)),
+                ('phone', models.CharField(max_length=15)),
+                ('date', models.DateField(default=django.utils.timezone.localdate)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['doctor', 'level', 'id'], name='home_queuee_doctor_bb35ca_idx'), models.Index(fields=['doctor', 'date'], name='home_queuee_doctor_36d4d5_idx')],
+                'constraints': [models.UniqueConstraint(fields=('phone', 'doctor'), name='unique_queue_patient')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doctor', models.CharField(choices=[('csp', 'child specialist'), ('gendoc', 'general doctor')], max_length=10)),
+                ('date', models.DateField()),
+                ('taken', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('doctor', 'date'), name='unique_slot_counter')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SlotHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doctor', models.CharField(choices=[('csp', 'child specialist'), ('gendoc', 'general doctor')], max_length=10)),
+                ('date', models.DateField()),
+                ('state', models.CharField(choices=[('held', 'held'), ('confirmed', 'confirmed'), ('released', 'released')], default='held', max_length=10)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['doctor', 'date', 'state', 'expires_at'], name='home_slotho_doctor_613891_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-16 21:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def register_patients(apps, schema_editor):
+    """ One Patient per phone number, with the details of its latest booking.
+    """
+    Appointment = apps.get_model('home', 'Appointment')
+    Patient = apps.get_model('home', 'Patient')
+    patients = {}
+    for appointment in Appointment.objects.order_by('id').iterator():
+        patient = patients.get(appointment.phone)
+        if patient is None:
+            patient = patients[appointment.phone] = Patient(phone=appointment.phone)
+        patient.name = appointment.name
+        patient.age = appointment.age
+        patient.email = appointment.email
+        patient.gender = appointment.gender
+    Patient.objects.bulk_create(patients.values(), batch_size=1000)
+    ids = dict(Patient.objects.values_list('phone', 'id'))
+    for phone, patient_id in ids.items():
+        Appointment.objects.filter(phone=phone).update(patient_id=patient_id)
+
+
+def unregister_patients(apps, schema_editor):
+    Appointment = apps.get_model('home', 'Appointment')
+    Patient = apps.get_model('home', 'Patient')
+    for patient in Patient.objects.iterator():
+        Appointment.objects.filter(patient_id=patient.id).update(
+            age=patient.age, email=patient.email, gender=patient.gender)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0002_slotcounter_slothold'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Patient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone', models.CharField(max_length=15, unique=True)),
+                ('name', models.CharField(max_length=100)),
+                ('age', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('email', models.CharField(blank=True, max_length=254)),
+                ('gender', models.CharField(blank=True, max_length=10)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='patient',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='appointments', to='home.patient'),
+        ),
+        migrations.RunPython(register_patients, unregister_patients),
+        migrations.RemoveField(
+            model_name='appointment',
+            name='age',
+        ),
+        migrations.RemoveField(
+            model_name='appointment',
+            name='email',
+        ),
+        migrations.RemoveField(
+            model_name='appointment',
+            name='gender',
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def partition_appointments(apps, schema_editor):
+    """ Partition 0 of every (doctor, day) that has appointments.
+    """
+    Appointment = apps.get_model('home', 'Appointment')
+    AppointmentPartition = apps.get_model('home', 'AppointmentPartition')
+    days = Appointment.objects.values_list('doctor', 'date').distinct()
+    for doctor, date in days.iterator():
+        partition = AppointmentPartition.objects.create(doctor=doctor, date=date)
+        Appointment.objects.filter(doctor=doctor, date=date).update(partition=partition)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0004_dailycount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentPartition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doctor', models.CharField(choices=[('csp', 'child specialist'), ('gendoc', 'general doctor')], max_length=10)),
+                ('date', models.DateField()),
+                ('number', models.PositiveSmallIntegerField(default=0)),
+                ('archived', models.BooleanField(default=False)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('data', models.BinaryField(blank=True, default=b'')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('doctor', 'date', 'number'), name='unique_appointment_partition')],
+                'indexes': [models.Index(fields=['archived', 'date'], name='home_appoin_archive_2eeb51_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='partition',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='appointments', to='home.appointmentpartition'),
+        ),
+        migrations.RunPython(partition_appointments, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,175 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
+
+DOCTOR_CHOICES = [
+    ('csp', 'child specialist'),
+    ('gendoc', 'general doctor'),
+]
+DOCTORS = tuple(code for code, label in DOCTOR_CHOICES)
+
+
+class Patient(models.Model):
+    """ Demographics of a patient, one row per phone number shared by
+    the appointments with every doctor.
+    """
+    phone = models.CharField(max_length=15, unique=True)
+    name = models.CharField(max_length=100)
+    age = models.PositiveSmallIntegerField(null=True, blank=True)
+    email = models.CharField(max_length=254, blank=True)
+    gender = models.CharField(max_length=10, blank=True)
+
+    def __str__(self):
+        return f'{self.name} ({self.phone})'
+
+
+class AppointmentPartition(models.Model):
+    """ The appointment book of a doctor for a day.
+
+    A day starts with partition 0; clearing the appointments of the day
+    opens the next partition instead of deleting the bookings. Once the
+    day is old, its bookings are moved out of the Appointment table into
+    `data', a zlib-compressed CSV, and the partition is `archived'.
+    """
+    doctor = models.CharField(max_length=10, choices=DOCTOR_CHOICES)
+    date = models.DateField()
+    number = models.PositiveSmallIntegerField(default=0)
+    archived = models.BooleanField(default=False)
+    count = models.PositiveIntegerField(default=0)
+    data = models.BinaryField(blank=True, default=b'')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'date', 'number'], name='unique_appointment_partition'),
+        ]
+        indexes = [
+            models.Index(fields=['archived', 'date']),
+        ]
+
+    def __str__(self):
+        return f'appointments {self.number} of {self.doctor} on {self.date}'
+
+
+class Appointment(models.Model):
+    """ A booking made through the patient form, in the partition of
+    its doctor and day. The demographics of the patient are kept once,
+    in `patient'.
+    """
+    name = models.CharField(max_length=100)
+    patient = models.ForeignKey(Patient, null=True, blank=True, on_delete=models.SET_NULL,
+                                related_name='appointments')
+    partition = models.ForeignKey(AppointmentPartition, null=True, blank=True, on_delete=models.CASCADE,
+                                  related_name='appointments')
+    doctor = models.CharField(max_length=10, choices=DOCTOR_CHOICES)
+    phone = models.CharField(max_length=15)
+    date = models.DateField(default=timezone.localdate)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['doctor', 'date']),
+            models.Index(fields=['phone', 'doctor']),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.phone}) with {self.doctor} on {self.date}'
+
+
+class QueueEntry(models.Model):
+    """ A patient waiting in the queue of a doctor.
+    Entries are served by triage level, then in the order they joined.
+    """
+    doctor = models.CharField(max_length=10, choices=DOCTOR_CHOICES)
+    level = models.PositiveSmallIntegerField()
+    name = models.CharField(max_length=100)
+    phone = models.CharField(max_length=15)
+    date = models.DateField(default=timezone.localdate)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['phone', 'doctor'], name='unique_queue_patient'),
+        ]
+        indexes = [
+            models.Index(fields=['doctor', 'level', 'id']),
+            models.Index(fields=['doctor', 'date']),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.phone}) waiting for {self.doctor}'
+
+
+class HistoryEntry(models.Model):
+    """ One entry ("symptoms [prescription],date") of a patient's history.
+    """
+    doctor = models.CharField(max_length=10, choices=DOCTOR_CHOICES)
+    phone = models.CharField(max_length=15)
+    entry = models.TextField()
+    date = models.DateField(default=timezone.localdate)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['phone', 'doctor']),
+            models.Index(fields=['doctor', 'date']),
+        ]
+
+    def __str__(self):
+        return self.entry
+
+
+class SlotCounter(models.Model):
+    """ Number of appointment slots of a doctor taken on a day,
+    including slots held by bookings that are not confirmed yet.
+    """
+    doctor = models.CharField(max_length=10, choices=DOCTOR_CHOICES)
+    date = models.DateField()
+    taken = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'date'], name='unique_slot_counter'),
+        ]
+
+    def __str__(self):
+        return f'{self.doctor} on {self.date}: {self.taken} taken'
+
+
+class SlotHold(models.Model):
+    """ A slot reserved for a booking in progress.
+    A hold that is not confirmed before `expires_at' gives its slot back.
+    """
+    HELD = 'held'
+    CONFIRMED = 'confirmed'
+    RELEASED = 'released'
+    STATE_CHOICES = [(HELD, 'held'), (CONFIRMED, 'confirmed'), (RELEASED, 'released')]
+
+    doctor = models.CharField(max_length=10, choices=DOCTOR_CHOICES)
+    date = models.DateField()
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=HELD)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['doctor', 'date', 'state', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.state} slot with {self.doctor} on {self.date}'
+
+
+class DailyCount(models.Model):
+    """ Number of times an event (booking, check-in, emergency, patient
+    seen, symptom `key') happened on a day with a doctor.
+    """
+    date = models.DateField()
+    doctor = models.CharField(max_length=10, choices=DOCTOR_CHOICES)
+    event = models.CharField(max_length=20)
+    key = models.CharField(max_length=100, blank=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'doctor', 'event', 'key'], name='unique_daily_count'),
+        ]
+
+    def __str__(self):
+        return f'{self.event} {self.key} with {self.doctor} on {self.date}: {self.count}'
@@ -0,0 +1,204 @@
+import heapq
+from collections import deque
+
+
+class queuepatientobject:
+    def __init__(self, p_name, p_doc, p_num):
+        self.patname = p_name
+        self.doc = p_doc
+        self.pnum = p_num
+
+
+class _QueueEntry:
+    """ A patient waiting in one lane of a PatientQueue.
+    """
+    __slots__ = ['patient', 'level', 'seq', 'removed']
+
+    def __init__(self, patient, level):
+        self.patient = patient
+        self.level = level
+        self.seq = 0
+        self.removed = False
+
+
+class _Lane:
+    """ FIFO lane of a PatientQueue.
+
+    Entries are numbered consecutively as they join the lane. A Fenwick
+    tree over those numbers counts the entries still waiting, so the rank
+    of an entry and the removal of an entry from the middle of the lane
+    are O(log n) and never shift the deque; removed entries are skipped
+    when they reach the front.
+    """
+
+    def __init__(self):
+        self._entries = deque()
+        self._tree = [0]
+        self.live = 0
+
+    def _add(self, seq, delta):
+        tree = self._tree
+        while seq < len(tree):
+            tree[seq] += delta
+            seq += seq & -seq
+
+    def _prefix(self, seq):
+        """ Number of waiting entries numbered 1..seq.
+        """
+        total = 0
+        tree = self._tree
+        while seq > 0:
+            total += tree[seq]
+            seq -= seq & -seq
+        return total
+
+    def append(self, entry):
+        seq = len(self._tree)
+        # A new Fenwick node covers (seq - lowbit(seq), seq]
+        self._tree.append(1 + self._prefix(seq - 1) - self._prefix(seq - (seq & -seq)))
+        entry.seq = seq
+        self._entries.append(entry)
+        self.live += 1
+
+    def popleft(self):
+        entries = self._entries
+        while entries and entries[0].removed:
+            entries.popleft()
+        if not entries:
+            return None
+        entry = entries[0]
+        self.discard(entry)
+        return entry
+
+    def discard(self, entry):
+        entry.removed = True
+        self._add(entry.seq, -1)
+        self.live -= 1
+        if self.live == 0:
+            # Start numbering again, so the tree never outgrows the lane
+            self._entries.clear()
+            self._tree = [0]
+
+    def rank(self, entry):
+        """ Number of entries waiting ahead of `entry' in this lane.
+        """
+        return self._prefix(entry.seq - 1)
+
+    def __iter__(self):
+        for entry in self._entries:
+            if not entry.removed:
+                yield entry
+
+
+class PatientQueue:
+    """ Waiting queue of one doctor.
+
+    Patients wait in lanes, one per triage level: emergencies in the
+    lanes 1 (most urgent) .. REGULAR-1 and booked patients in the REGULAR
+    lane. A heap of the non-empty levels picks the lane to serve next and
+    every lane is first come, first served.
+
+    Patients are indexed by phone number, so enqueue, dequeue, the
+    position of a patient and the removal of a patient are O(1) or
+    O(log n) no matter how long the queue gets.
+    """
+
+    EMERGENCY = 1
+    REGULAR = 4
+
+    def __init__(self, d_name):
+        self.doc = d_name
+        self._lanes = {}
+        self._levels = []
+        self._active = set()
+        self._index = {}
+
+    def _lane(self, level):
+        lane = self._lanes.get(level)
+        if lane is None:
+            lane = self._lanes[level] = _Lane()
+        if level not in self._active:
+            heapq.heappush(self._levels, level)
+            self._active.add(level)
+        return lane
+
+    def enqueue(self, patient, level=REGULAR):
+        """ Adds `patient' to the back of the lane of triage `level'.
+        A patient who is already waiting at the same or a more urgent
+        level keeps their place; one waiting at a less urgent level is
+        moved up to the new lane. Returns `True' if the patient joined
+        or moved.
+        """
+        old = self._index.get(patient.pnum)
+        if old is not None:
+            if old.level <= level:
+                return False
+            self._discard(old)
+        entry = _QueueEntry(patient, level)
+        self._lane(level).append(entry)
+        self._index[patient.pnum] = entry
+        return True
+
+    def emergency(self, patient, level=EMERGENCY):
+        """ Adds `patient' ahead of every booked patient.
+        """
+        if not 1 <= level < self.REGULAR:
+            raise ValueError(f"Triage level must be between 1 and {self.REGULAR - 1}.")
+        return self.enqueue(patient, level)
+
+    def _discard(self, entry):
+        self._lanes[entry.level].discard(entry)
+        del self._index[entry.patient.pnum]
+
+    def dequeue(self):
+        """ Removes and returns the next patient, or `None' if empty.
+        """
+        levels = self._levels
+        while levels:
+            lane = self._lanes[levels[0]]
+            if lane.live == 0:
+                self._active.discard(heapq.heappop(levels))
+                continue
+            entry = lane.popleft()
+            del self._index[entry.patient.pnum]
+            return entry.patient
+        return None
+
+    def remove(self, pnum):
+        """ Removes the patient with phone number `pnum' from the queue.
+        Returns the patient, or `None' if they are not waiting.
+        """
+        entry = self._index.get(pnum)
+        if entry is None:
+            return None
+        self._discard(entry)
+        return entry.patient
+
+    def position(self, pnum):
+        """ Returns the 1-based position of the patient with phone number
+        `pnum' (1 is served next), or `None' if they are not waiting.
+        """
+        entry = self._index.get(pnum)
+        if entry is None:
+            return None
+        ahead = sum(lane.live for level, lane in self._lanes.items() if level < entry.level)
+        return ahead + self._lanes[entry.level].rank(entry) + 1
+
+    def __contains__(self, pnum):
+        return pnum in self._index
+
+    def __iter__(self):
+        """ Iterates over the waiting patients in the order they will be served.
+        """
+        for level in sorted(self._lanes):
+            for entry in self._lanes[level]:
+                yield entry.patient
+
+    def __len__(self):
+        return len(self._index)
+
+    def is_empty(self):
+        return len(self._index) == 0
+
+    def size(self):
+        return len(self._index)
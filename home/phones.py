@@ -0,0 +1,57 @@
+import string
+
+from django.conf import settings
+
+
+# Longest phone number allowed by E.164, so every key fits in 64 bits
+MAX_DIGITS = 15
+
+
+class InvalidPhone(ValueError):
+    pass
+
+
+def phone_key(value):
+    """ Returns the canonical integer key of the phone number `value'
+    (a string as typed in a form, or a key already).
+
+    Separators and the trunk prefix 0 are dropped, and so is the country
+    code CLINIC_PHONE_COUNTRY_CODE in front of a national number of
+    CLINIC_PHONE_DIGITS digits, so '07896543210', '+91 78965 43210' and
+    '7896543210' are the same patient. Raises InvalidPhone if `value'
+    holds no number, or digits other than 0-9.
+    """
+    if isinstance(value, int):
+        if not 0 < value < 10 ** MAX_DIGITS:
+            raise InvalidPhone(f'Invalid phone number key: {value}')
+        return value
+    text = str(value or '')
+    # Other digits ('²', '٣', ...) are refused rather than read as
+    # separators: int() cannot read all of them, and they would make a
+    # different number out of the rest
+    if any(ch.isdigit() and ch not in string.digits for ch in text):
+        raise InvalidPhone(f'Invalid phone number: {value!r}')
+    digits = ''.join(ch for ch in text if ch in string.digits).lstrip('0')
+    country = settings.CLINIC_PHONE_COUNTRY_CODE
+    if len(digits) == len(country) + settings.CLINIC_PHONE_DIGITS and digits.startswith(country):
+        digits = digits[len(country):]
+    if not digits or len(digits) > MAX_DIGITS:
+        raise InvalidPhone(f'Invalid phone number: {value!r}')
+    return int(digits)
+
+
+def phone_text(key):
+    """ Returns the canonical phone number of a key, as stored in the
+    appointments, queues and history.
+    """
+    return str(key)
+
+
+def canonical_phone(value):
+    """ Returns the canonical form of the phone number `value', or `None'
+    if it is not a phone number.
+    """
+    try:
+        return phone_text(phone_key(value))
+    except InvalidPhone:
+        return None
@@ -0,0 +1,99 @@
+import sys
+import threading
+from collections import namedtuple
+
+from django.db import IntegrityError, transaction
+
+from .models import Patient
+
+
+class Demographics(namedtuple('Demographics', ['name', 'age', 'email', 'gender'])):
+    __slots__ = ()
+
+    @classmethod
+    def make(cls, name, age, email, gender):
+        age = str(age or '').strip()
+        # Names, e-mail domains and genders repeat a lot: keep one copy
+        return cls(sys.intern(name or ''), int(age) if age.isdigit() else None,
+                   sys.intern(email or ''), sys.intern(gender or ''))
+
+
+class PatientRegistry:
+    """ The patients of the clinic, one Patient row per phone number
+    whatever doctors they see; appointments reference it instead of
+    carrying their own copy of the demographics.
+
+    The demographics of the patients seen by this process are cached
+    with their row id, so booking a patient whose details did not change
+    writes (and reads) nothing, and writes scale with the number of
+    patients rather than bookings.
+
+    The registry holds the demographics only: the visits stay in the
+    per-doctor history of the state backend, and the history of a
+    patient with every doctor is merged from there (patient_history()).
+    """
+
+    def __init__(self):
+        self._patients = {}
+        self._lock = threading.Lock()
+
+    def register(self, phone, name, age, email, gender):
+        """ Records the demographics of patient `phone', creating or
+        updating its Patient row if they changed. Returns the row id.
+        """
+        demographics = Demographics.make(name, age, email, gender)
+        with self._lock:
+            cached = self._patients.get(phone)
+        if cached is not None and cached[1] == demographics:
+            return cached[0]
+        with self._lock:
+            # Until the write commits, the row is not the one cached
+            self._patients.pop(phone, None)
+        rows = Patient.objects.filter(phone=phone)
+        # Write first, so a transaction never reads before it writes (with
+        # SQLite, such a transaction fails at once if another one wrote)
+        if not rows.update(**demographics._asdict()):
+            try:
+                with transaction.atomic():
+                    Patient.objects.create(phone=phone, **demographics._asdict())
+            except IntegrityError:
+                # Another worker registered the patient first
+                rows.update(**demographics._asdict())
+        patient_id = rows.values_list('pk', flat=True).get()
+        self._remember(phone, patient_id, demographics)
+        return patient_id
+
+    def _remember(self, phone, patient_id, demographics):
+        """ Caches the row of patient `phone' once the transaction that
+        wrote or read it commits: the row of a rolled back transaction
+        (e.g. a failed import) is gone.
+        """
+        def remember():
+            with self._lock:
+                self._patients[phone] = (patient_id, demographics)
+        transaction.on_commit(remember)
+
+    def get(self, phone):
+        """ Returns the Demographics of patient `phone', or `None'.
+        """
+        with self._lock:
+            cached = self._patients.get(phone)
+        if cached is not None:
+            return cached[1]
+        patient = Patient.objects.filter(phone=phone).first()
+        if patient is None:
+            return None
+        demographics = Demographics.make(patient.name, patient.age, patient.email, patient.gender)
+        self._remember(phone, patient.pk, demographics)
+        return demographics
+
+    def forget(self):
+        """ Drops the cached demographics (e.g. after the rows were changed
+        outside this registry).
+        """
+        with self._lock:
+            self._patients.clear()
+# End of the class PatientRegistry
+
+
+registry = PatientRegistry()
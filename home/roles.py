@@ -0,0 +1,142 @@
+import hashlib
+import inspect
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.shortcuts import redirect
+
+from .metrics import LOGINS_THROTTLED
+
+
+# Roles of the clinic staff and patients, told apart by the suffix of
+# their username
+ROLE_SUFFIXES = {
+    'patient': 'pat',
+    'doctor': 'doc',
+    'receptionist': 'rep',
+}
+
+# Login page of each role, where role_required sends requests without it
+LOGIN_PAGES = {
+    'patient': 'patient',
+    'doctor': 'doctor',
+    'receptionist': 'receptionist',
+}
+
+# Session keys of the resolved role
+ROLE_KEY = 'clinic_role'
+DOCTOR_KEY = 'clinic_doctor'
+
+
+def resolve(username):
+    """ Returns the (role, doctor) of `username'; `doctor' is the doctor
+    a doctor account works as (see CLINIC_DOCTOR_ACCOUNTS) and `None' for
+    the other roles. `role' is `None' if the username has no known suffix.
+    """
+    for role, suffix in ROLE_SUFFIXES.items():
+        if username.endswith(suffix):
+            if role == 'doctor':
+                return role, settings.CLINIC_DOCTOR_ACCOUNTS.get(username)
+            return role, None
+    return None, None
+
+
+def remember(request, role, doctor=None):
+    """ Stores the resolved role in the session of a user who just logged
+    in, so later requests read it from the session instead of the database.
+    """
+    request.session[ROLE_KEY] = role
+    request.session[DOCTOR_KEY] = doctor
+
+
+def session_role(request):
+    """ Returns the (role, doctor) stored in the session by remember(),
+    or (None, None).
+    """
+    return request.session.get(ROLE_KEY), request.session.get(DOCTOR_KEY)
+
+
+def role_required(role, doctor=None):
+    """ View decorator: sets request.clinic_role and request.clinic_doctor
+    from the session. If CLINIC_REQUIRE_ROLES is set, requests of users
+    who did not log in as `role' (one role or a tuple of roles), and as
+    `doctor' if given, are sent to the login page of the (first) role.
+    Only the session is read, never the user. Async views are wrapped
+    by an async wrapper, which checks the role before the view runs.
+    """
+    roles = (role,) if isinstance(role, str) else tuple(role)
+
+    def denied(request):
+        request.clinic_role, request.clinic_doctor = session_role(request)
+        if settings.CLINIC_REQUIRE_ROLES and (
+                request.clinic_role not in roles
+                or (doctor is not None and request.clinic_doctor != doctor)):
+            return redirect(LOGIN_PAGES[roles[0]])
+        return None
+
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                # The session is loaded from the cache or the database
+                response = await sync_to_async(denied)(request)
+                if response is not None:
+                    return response
+                return await view(request, *args, **kwargs)
+        else:
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                response = denied(request)
+                if response is not None:
+                    return response
+                return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class LoginThrottle:
+    """ Limits the login attempts of each username to `attempts' per
+    `seconds' (CLINIC_LOGIN_THROTTLE).
+
+    Attempts are counted in the Django cache, so a throttled login is
+    turned away before its password is hashed. The limit is kept per
+    username, not per address: the staff share the clinic's address, and
+    a burst of logins at shift change never makes the other users wait.
+    """
+
+    def __init__(self, attempts=None, seconds=None):
+        default_attempts, default_seconds = settings.CLINIC_LOGIN_THROTTLE
+        self._attempts = attempts if attempts is not None else default_attempts
+        self._seconds = seconds if seconds is not None else default_seconds
+
+    @staticmethod
+    def _key(username):
+        # Hashed, since usernames may hold characters the cache refuses
+        return 'clinic:login:' + hashlib.sha1(username.encode()).hexdigest()
+
+    def _hit(self, key):
+        if cache.add(key, 1, self._seconds):
+            return 1
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.add(key, 1, self._seconds)
+            return 1
+
+    def allow(self, username, role):
+        """ Counts a login attempt of `username'. Returns `False' if it is
+        over the limit and must be turned away.
+        """
+        if self._hit(self._key(username)) > self._attempts:
+            LOGINS_THROTTLED.inc(1, role)
+            return False
+        return True
+
+    def succeeded(self, username):
+        """ Forgets the attempts of `username' once it logged in.
+        """
+        cache.delete(self._key(username))
+# End of the class LoginThrottle
@@ -0,0 +1,17 @@
+from django.dispatch import Signal
+
+
+# Sent by the state backends after a queue changed. Arguments:
+#   doctor   -- the doctor whose queue changed
+#   event    -- 'enqueue', 'emergency', 'dequeue' or 'remove'
+#   patient  -- the queuepatientobject that joined or left the queue
+#   position -- 1-based place of a patient who joined, else None
+queue_changed = Signal()
+
+# Sent by the state backends after the history of a patient changed.
+# Arguments: doctor, pat_num
+history_changed = Signal()
+
+# Sent by AppointmentStore after an appointment was booked and committed.
+# Arguments: doctor, name, phone, date (the day of the appointment)
+appointment_booked = Signal()
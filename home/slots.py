@@ -0,0 +1,97 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import SlotCounter, SlotHold
+
+
+class SlotReservations:
+    """ Daily appointment slots of the doctors.
+
+    Every (doctor, day) has one SlotCounter row. A slot is reserved with
+    a single conditional UPDATE (taken = taken + 1 WHERE taken < capacity),
+    an atomic compare-and-increment, so concurrent bookings can never
+    overbook and only bookings for the same doctor and day contend.
+    The reservation is recorded as a SlotHold which the booking confirms
+    once the appointment is saved; holds left unconfirmed (the booking
+    failed or its worker died) expire and give their slot back.
+    """
+
+    def __init__(self, capacity=None, hold_seconds=None):
+        self._capacity = capacity if capacity is not None else settings.CLINIC_DAILY_CAPACITY
+        self._hold = timedelta(seconds=hold_seconds if hold_seconds is not None
+                               else settings.CLINIC_SLOT_HOLD_SECONDS)
+
+    def capacity(self, doctor):
+        """ Returns the number of appointments `doctor' takes per day.
+        """
+        return self._capacity[doctor]
+
+    def _counter(self, doctor, date):
+        counter, created = SlotCounter.objects.get_or_create(doctor=doctor, date=date)
+        return counter
+
+    def _give_back(self, hold_id, doctor, date):
+        """ Releases a held slot, unless it was confirmed or released already.
+        """
+        with transaction.atomic():
+            if SlotHold.objects.filter(pk=hold_id, state=SlotHold.HELD).update(state=SlotHold.RELEASED):
+                SlotCounter.objects.filter(doctor=doctor, date=date).update(taken=F('taken') - 1)
+
+    def expire(self, doctor, date=None):
+        """ Gives back the slots of expired holds of `doctor' on `date'.
+        """
+        date = date if date is not None else timezone.localdate()
+        expired = SlotHold.objects.filter(doctor=doctor, date=date, state=SlotHold.HELD,
+                                          expires_at__lte=timezone.now())
+        for hold_id in expired.values_list('id', flat=True):
+            self._give_back(hold_id, doctor, date)
+
+    def reserve(self, doctor, date=None):
+        """ Holds a slot of `doctor' on `date' (today by default).
+        Returns the SlotHold, or `None' if the day is fully booked.
+        """
+        date = date if date is not None else timezone.localdate()
+        counter = self._counter(doctor, date)
+        if counter.taken >= self.capacity(doctor):
+            # Only look for expired holds when the day looks full
+            self.expire(doctor, date)
+        # The slot is taken and held together: a failed hold takes nothing
+        with transaction.atomic():
+            taken = (SlotCounter.objects.filter(pk=counter.pk, taken__lt=self.capacity(doctor))
+                     .update(taken=F('taken') + 1))
+            if not taken:
+                return None
+            return SlotHold.objects.create(doctor=doctor, date=date,
+                                           expires_at=timezone.now() + self._hold)
+
+    def confirm(self, hold):
+        """ Makes a held slot permanent. Returns `False' if the hold has
+        expired and its slot was given back in the meantime.
+        """
+        return SlotHold.objects.filter(pk=hold.pk, state=SlotHold.HELD).update(
+            state=SlotHold.CONFIRMED) == 1
+
+    def release(self, hold):
+        """ Gives back a held slot.
+        """
+        self._give_back(hold.pk, hold.doctor, hold.date)
+
+    def available(self, doctor, date=None):
+        """ Returns the number of free slots of `doctor' on `date'.
+        """
+        date = date if date is not None else timezone.localdate()
+        counter = SlotCounter.objects.filter(doctor=doctor, date=date).first()
+        taken = counter.taken if counter is not None else 0
+        return max(self.capacity(doctor) - taken, 0)
+
+    def reset(self, doctor, date=None):
+        """ Frees every slot of `doctor' on `date'.
+        """
+        date = date if date is not None else timezone.localdate()
+        SlotHold.objects.filter(doctor=doctor, date=date, state=SlotHold.HELD).update(
+            state=SlotHold.RELEASED)
+        SlotCounter.objects.filter(doctor=doctor, date=date).update(taken=0)
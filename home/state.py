@@ -0,0 +1,362 @@
+import threading
+from datetime import date
+from abc import ABC, abstractmethod
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .models import DOCTORS, HistoryEntry, QueueEntry
+from .history import HistoryRecord, HistoryRecords, HistoryStore, parse_entry
+from .patientqueue import PatientQueue, queuepatientobject
+from .signals import history_changed, queue_changed
+
+
+class StateBackend(ABC):
+    """ Abstract Base Class for the queue and history state of the clinic.
+    The views only talk to the clinic state through these methods, so a
+    backend decides where the state lives and how it is shared between
+    worker processes. Every method is atomic.
+    """
+
+    # Whether other worker processes change the same state: only then do
+    # the indexes built from it need rebuilding to see their changes
+    shared = False
+
+    def _changed(self, doctor, event, patient, position=None):
+        """ Tells the receivers of `queue_changed' about a queue change.
+        Backends call it once the change is made and their locks are released.
+        """
+        queue_changed.send(sender=self.__class__, doctor=doctor, event=event,
+                           patient=patient, position=position)
+
+    def _historyChanged(self, doctor, pat_num):
+        history_changed.send(sender=self.__class__, doctor=doctor, pat_num=pat_num)
+
+    @staticmethod
+    def _joined(level):
+        return 'emergency' if level < PatientQueue.REGULAR else 'enqueue'
+
+    @abstractmethod
+    def enqueue(self, doctor, patient, level=PatientQueue.REGULAR):
+        """ Adds `patient' to the queue of `doctor' at triage `level'.
+        Returns `True' if the patient joined (or moved up in) the queue.
+        """
+
+    def emergency(self, doctor, patient, level=PatientQueue.EMERGENCY):
+        """ Adds `patient' to the queue of `doctor' ahead of every booked patient.
+        """
+        if not 1 <= level < PatientQueue.REGULAR:
+            raise ValueError(f"Triage level must be between 1 and {PatientQueue.REGULAR - 1}.")
+        return self.enqueue(doctor, patient, level)
+
+    @abstractmethod
+    def dequeue(self, doctor):
+        """ Removes and returns the next patient of `doctor', or `None'.
+        """
+
+    @abstractmethod
+    def remove(self, doctor, pnum):
+        """ Removes the patient with phone number `pnum' from the queue
+        of `doctor'. Returns the patient, or `None' if not waiting.
+        """
+
+    @abstractmethod
+    def position(self, doctor, pnum):
+        """ Returns the 1-based position of patient `pnum' in the queue
+        of `doctor', or `None' if not waiting.
+        """
+
+    @abstractmethod
+    def queue(self, doctor):
+        """ Returns the list of patients waiting for `doctor', in order.
+        """
+
+    @abstractmethod
+    def queue_size(self, doctor):
+        """ Returns the number of patients waiting for `doctor'.
+        """
+
+    @abstractmethod
+    def history(self, doctor, pat_num):
+        """ Returns the history list of patient `pat_num' with `doctor',
+        or `None' if the patient has no history.
+        """
+
+    @abstractmethod
+    def patient_history(self, pat_num):
+        """ Returns the history of patient `pat_num' with every doctor, as
+        HistoryRecords in date order, or `None' if the patient has no history.
+        """
+
+    @abstractmethod
+    def history_page(self, doctor, pat_num, since=None, cursor=None, limit=20):
+        """ Returns (entries, next_cursor): up to `limit' history entries of
+        patient `pat_num' with `doctor', oldest first, dated `since' or
+        later and starting at the opaque `cursor' of a previous page.
+        `next_cursor' is `None' on the last page. Returns `None' if the
+        patient has no history.
+        """
+
+    def valid_cursor(self, cursor):
+        """ Returns `True' if `cursor' has the format of the cursors of
+        history_page(); other values must not be passed to it.
+        """
+        return cursor.isdigit()
+
+    @abstractmethod
+    def history_patients(self, doctor):
+        """ Returns the phone numbers of the patients of `doctor' with history.
+        """
+
+    def all_history(self, doctor):
+        """ Yields (pat_num, history list) of every patient of `doctor'
+        with history.
+        """
+        for pat_num in self.history_patients(doctor):
+            entries = self.history(doctor, pat_num)
+            if entries is not None:
+                yield pat_num, entries
+
+    @abstractmethod
+    def add_history(self, doctor, pat_num, entries):
+        """ Appends the history `entries' (a list) of patient `pat_num'.
+        """
+
+    @abstractmethod
+    def amend_history(self, doctor, pat_num, entry):
+        """ Replaces the latest history entry of patient `pat_num'.
+        """
+# End of the class StateBackend
+
+
+class LocalStateBackend(StateBackend):
+    """ State held in the memory of this process.
+    Queues are PatientQueues and the history is a HistoryStore.
+    Fastest backend, but every worker process gets its own state,
+    so it must only be used with a single worker.
+    """
+
+    def __init__(self, doctors=DOCTORS, history_dir=None):
+        self.queues = {doctor: PatientQueue(doctor) for doctor in doctors}
+        self.store = HistoryStore(history_dir or settings.HISTORY_DIR, doctors,
+                                  snapshot_every=settings.HISTORY_SNAPSHOT_EVERY,
+                                  fsync=settings.HISTORY_FSYNC,
+                                  tree_class=import_string(settings.HISTORY_TREE),
+                                  hot_days=settings.HISTORY_HOT_DAYS,
+                                  cold_cache=settings.HISTORY_COLD_CACHE,
+                                  cold_segments=settings.HISTORY_COLD_SEGMENTS)
+        self._lock = threading.Lock()
+
+    def enqueue(self, doctor, patient, level=PatientQueue.REGULAR):
+        with self._lock:
+            queue = self.queues[doctor]
+            if not queue.enqueue(patient, level):
+                return False
+            position = queue.position(patient.pnum)
+        self._changed(doctor, self._joined(level), patient, position)
+        return True
+
+    def dequeue(self, doctor):
+        with self._lock:
+            patient = self.queues[doctor].dequeue()
+        if patient is not None:
+            self._changed(doctor, 'dequeue', patient)
+        return patient
+
+    def remove(self, doctor, pnum):
+        with self._lock:
+            patient = self.queues[doctor].remove(pnum)
+        if patient is not None:
+            self._changed(doctor, 'remove', patient)
+        return patient
+
+    def position(self, doctor, pnum):
+        with self._lock:
+            return self.queues[doctor].position(pnum)
+
+    def queue(self, doctor):
+        with self._lock:
+            return list(self.queues[doctor])
+
+    def queue_size(self, doctor):
+        return len(self.queues[doctor])
+
+    def history(self, doctor, pat_num):
+        return self.store.search(doctor, pat_num)
+
+    def patient_history(self, pat_num):
+        return self.store.patient(pat_num)
+
+    def history_page(self, doctor, pat_num, since=None, cursor=None, limit=20):
+        return self.store.page(doctor, pat_num, since, cursor, limit)
+
+    def history_patients(self, doctor):
+        return self.store.patients(doctor)
+
+    def add_history(self, doctor, pat_num, entries):
+        self.store.add(doctor, pat_num, entries)
+        self._historyChanged(doctor, pat_num)
+
+    def amend_history(self, doctor, pat_num, entry):
+        self.store.amend(doctor, pat_num, entry)
+        self._historyChanged(doctor, pat_num)
+# End of the class LocalStateBackend
+
+
+class DatabaseStateBackend(StateBackend):
+    """ State kept in the Django database (QueueEntry and HistoryEntry).
+    Every worker process sees the same queues and history. Operations
+    that take a patient out of a queue are compare-and-delete statements
+    (only one worker can delete a given row), so they are atomic across
+    workers without holding a lock over the whole queue. With SQLite the
+    database runs in WAL mode (see HomeConfig), so readers are never
+    blocked by a writer.
+    """
+
+    shared = True
+
+    def enqueue(self, doctor, patient, level=PatientQueue.REGULAR):
+        while True:
+            old = QueueEntry.objects.filter(doctor=doctor, phone=patient.pnum).first()
+            if old is not None and old.level <= level:
+                return False
+            try:
+                # The patient moves to the end of the new lane: the old
+                # entry goes and the new one comes in one transaction
+                with transaction.atomic():
+                    if old is not None and not QueueEntry.objects.filter(pk=old.pk, level=old.level).delete()[0]:
+                        # Taken or moved by another worker meanwhile
+                        raise IntegrityError
+                    QueueEntry.objects.create(doctor=doctor, level=level,
+                                              name=patient.patname, phone=patient.pnum)
+            except IntegrityError:
+                # Another worker changed the entry of the same patient; look again
+                continue
+            self._changed(doctor, self._joined(level), patient, self.position(doctor, patient.pnum))
+            return True
+
+    def _take(self, entries):
+        """ Deletes the first of `entries' that no other worker took first.
+        """
+        while True:
+            entry = entries.first()
+            if entry is None:
+                return None
+            deleted, _ = QueueEntry.objects.filter(pk=entry.pk).delete()
+            if deleted:
+                return queuepatientobject(entry.name, entry.doctor, entry.phone)
+
+    def dequeue(self, doctor):
+        patient = self._take(QueueEntry.objects.filter(doctor=doctor).order_by('level', 'id'))
+        if patient is not None:
+            self._changed(doctor, 'dequeue', patient)
+        return patient
+
+    def remove(self, doctor, pnum):
+        patient = self._take(QueueEntry.objects.filter(doctor=doctor, phone=pnum))
+        if patient is not None:
+            self._changed(doctor, 'remove', patient)
+        return patient
+
+    def position(self, doctor, pnum):
+        entry = QueueEntry.objects.filter(doctor=doctor, phone=pnum).first()
+        if entry is None:
+            return None
+        ahead = QueueEntry.objects.filter(
+            Q(level__lt=entry.level) | Q(level=entry.level, id__lt=entry.id),
+            doctor=doctor,
+        ).count()
+        return ahead + 1
+
+    def queue(self, doctor):
+        rows = (QueueEntry.objects.filter(doctor=doctor).order_by('level', 'id')
+                .values_list('name', 'phone'))
+        return [queuepatientobject(name, doctor, phone) for name, phone in rows]
+
+    def queue_size(self, doctor):
+        return QueueEntry.objects.filter(doctor=doctor).count()
+
+    def history(self, doctor, pat_num):
+        entries = list(HistoryEntry.objects.filter(phone=pat_num, doctor=doctor)
+                       .order_by('date', 'id').values_list('entry', flat=True))
+        return entries or None
+
+    def patient_history(self, pat_num):
+        rows = (HistoryEntry.objects.filter(phone=pat_num).order_by('date', 'id')
+                .values_list('doctor', 'entry'))
+        records = [HistoryRecord.parse(entry, doctor) for doctor, entry in rows]
+        return HistoryRecords(records) if records else None
+
+    def valid_cursor(self, cursor):
+        day, sep, pk = cursor.partition('_')
+        try:
+            date.fromisoformat(day)
+        except ValueError:
+            return False
+        return pk.isdigit()
+
+    def history_page(self, doctor, pat_num, since=None, cursor=None, limit=20):
+        entries = HistoryEntry.objects.filter(phone=pat_num, doctor=doctor)
+        if not entries.exists():
+            return None
+        if since is not None:
+            entries = entries.filter(date__gte=since)
+        if cursor is not None:
+            # Keyset pagination on (date, id)
+            day, pk = cursor.split('_')
+            entries = entries.filter(Q(date__gt=day) | Q(date=day, id__gt=pk))
+        rows = list(entries.order_by('date', 'id').values_list('id', 'date', 'entry')[:limit + 1])
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f'{rows[-1][1].isoformat()}_{rows[-1][0]}'
+        return [row[2] for row in rows], next_cursor
+
+    def history_patients(self, doctor):
+        return list(HistoryEntry.objects.filter(doctor=doctor).order_by()
+                    .values_list('phone', flat=True).distinct())
+
+    def all_history(self, doctor):
+        # One ordered query instead of one per patient
+        rows = (HistoryEntry.objects.filter(doctor=doctor).order_by('phone', 'date', 'id')
+                .values_list('phone', 'entry'))
+        for pat_num, group in groupby(rows.iterator(), key=itemgetter(0)):
+            yield pat_num, [entry for _, entry in group]
+
+    def add_history(self, doctor, pat_num, entries):
+        HistoryEntry.objects.bulk_create(
+            [HistoryEntry(doctor=doctor, phone=pat_num, entry=entry, date=parse_entry(entry)[1])
+             for entry in entries])
+        self._historyChanged(doctor, pat_num)
+
+    def amend_history(self, doctor, pat_num, entry):
+        day = parse_entry(entry)[1]
+        latest = (HistoryEntry.objects.filter(phone=pat_num, doctor=doctor)
+                  .order_by('-date', '-id').values('id')[:1])
+        # A single UPDATE: on SQLite a transaction that reads and then
+        # writes fails at once if another worker wrote in between
+        if not HistoryEntry.objects.filter(pk__in=latest).update(entry=entry, date=day):
+            HistoryEntry.objects.create(doctor=doctor, phone=pat_num, entry=entry, date=day)
+        self._historyChanged(doctor, pat_num)
+# End of the class DatabaseStateBackend
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state():
+    """ Returns the state backend configured by CLINIC_STATE_BACKEND,
+    creating it with CLINIC_STATE_OPTIONS on first use.
+    """
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                backend = import_string(settings.CLINIC_STATE_BACKEND)
+                _state = backend(**settings.CLINIC_STATE_OPTIONS)
+    return _state
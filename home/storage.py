@@ -0,0 +1,38 @@
+import gzip
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+
+class GzipManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ ManifestStaticFilesStorage that also writes a precompressed
+    `<name>.gz' next to every collected text file (CSS, JS, ...), so a
+    server can send it as is to clients accepting gzip.
+    """
+    GZIP_EXTENSIONS = ('.css', '.js', '.json', '.svg', '.txt', '.html')
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in list(self.hashed_files.values()) + list(paths):
+            if name.endswith(self.GZIP_EXTENSIONS) and self.exists(name):
+                compressed = self._compress(name)
+                if compressed:
+                    yield name, compressed, True
+
+    def _compress(self, name):
+        """ Writes `name'.gz if it is smaller than `name'. Returns its name.
+        """
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        # mtime=0 keeps the output identical between runs
+        packed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(packed) >= len(data):
+            return None
+        target = path + '.gz'
+        if not os.path.exists(target) or os.path.getsize(target) != len(packed):
+            with open(target, 'wb') as f:
+                f.write(packed)
+        return name + '.gz'
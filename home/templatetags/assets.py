@@ -0,0 +1,16 @@
+from django import template
+
+from home.assets import optimized_url
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def optimized(name, fmt=None, width=None):
+    """ {% optimized 'background.jpg' %} -- URL of the resized, recompressed
+    (and, once collected, content-hashed) variant of a static image.
+    {% optimized 'background.jpg' 'webp' 640 %} asks for a WebP variant
+    at least 640 pixels wide.
+    """
+    return optimized_url(name, fmt, int(width) if width else None)
@@ -0,0 +1,82 @@
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.template import TemplateSyntaxError, engines
+
+from .signals import history_changed, queue_changed
+
+
+logger = logging.getLogger(__name__)
+
+
+def precompile():
+    """ Loads every template of the template directories once, so the
+    cached loader has them compiled before the first request.
+    Returns the number of templates compiled.
+    """
+    compiled = 0
+    for engine in engines.all():
+        for directory in engine.template_dirs:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    if not name.endswith('.html'):
+                        continue
+                    path = os.path.relpath(os.path.join(root, name), directory)
+                    try:
+                        engine.get_template(path.replace(os.sep, '/'))
+                    except TemplateSyntaxError:
+                        logger.exception('Template %s does not compile', path)
+                        continue
+                    compiled += 1
+    return compiled
+
+
+# Version counters of the cached page fragments. A counter lives in the
+# Django cache and is bumped whenever the data behind the fragment
+# changes, so a fragment cached under an older version is never used
+# again and simply expires. Counters start from the clock, so one that
+# was evicted never comes back with a version still in the cache.
+
+def _version(key):
+    return cache.get_or_set(key, time.time_ns(), None)
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), None)
+
+
+def queue_version(doctor):
+    return _version(f'clinic:queue:{doctor}')
+
+
+def history_version(doctor, pat_num):
+    return _version(f'clinic:history:{doctor}:{pat_num}')
+
+
+def fragment_cached(fragment_name, *vary_on):
+    """ Returns `True' if the {% cache %} fragment `fragment_name' is
+    cached for the given `vary_on' values.
+    """
+    return cache.get(make_template_fragment_key(fragment_name, vary_on)) is not None
+
+
+def _queueChanged(sender, doctor, **kwargs):
+    _bump(f'clinic:queue:{doctor}')
+
+
+def _historyChanged(sender, doctor, pat_num, **kwargs):
+    _bump(f'clinic:history:{doctor}:{pat_num}')
+
+
+def connect():
+    queue_changed.connect(_queueChanged, dispatch_uid='home.templating.queue')
+    history_changed.connect(_historyChanged, dispatch_uid='home.templating.history')
+    if settings.CLINIC_PRECOMPILE_TEMPLATES:
+        precompile()
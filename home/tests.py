@@ -1,3 +1,1557 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, transaction
+from django.db.models import QuerySet
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .analytics import ATTENDED, BOOKED, CHECKIN, EMERGENCY, FULL, SEEN, SYMPTOM, DailyStats, symptom_phrases
+from .appointments import AppointmentStore
+from .arraytree import ArrayBinarySearchTree
+from .assets import optimized_url
+from .benchmark import ClinicDay, compare, percentile
+from .events import feed
+from .fulltext import HistoryIndex, tokenize
+from .history import HistoryRecord, HistoryRecords, HistoryStore
+from .historycache import HistoryCache
+from .log import BatchingHandler, JsonFormatter, SamplingFilter
+from .lookup import PatientLookup
+from .metrics import Counter, Gauge, Histogram, Registry
+from .models import Appointment, AppointmentPartition, DailyCount, Patient, QueueEntry, SlotCounter, SlotHold
+from .patientqueue import PatientQueue, queuepatientobject
+from .phones import InvalidPhone, canonical_phone, phone_key
+from .registry import Demographics, PatientRegistry
+from .roles import DOCTOR_KEY, ROLE_KEY, LoginThrottle, resolve, role_required
+from .signals import appointment_booked, history_changed
+from .slots import SlotReservations
+from .state import DatabaseStateBackend, LocalStateBackend
+from .templating import fragment_cached, history_version, queue_version
+from .trees import BinarySearchTree
+from .waittime import P2Quantile, WaitEstimator
+
+
+class AppointmentBookTests(TestCase):
+    """ Bookings are Appointment rows, counted and looked up per doctor
+    and day, and copied in and out in the CSV format.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.store = AppointmentStore(SlotReservations(capacity={'csp': 2, 'gendoc': 2}, hold_seconds=600),
+                                      PatientRegistry())
+        # Archive in the test, not in a background thread
+        patcher = mock.patch.object(self.store, 'archive_later')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.today = timezone.localdate()
+
+    @staticmethod
+    def _row(name, phone, doctor='csp'):
+        return [name, '34', f'{name.lower()}@example.com', 'female', doctor, phone]
+
+    def test_book_up_to_capacity(self):
+        self.assertTrue(self.store.book('csp', self._row('Asha', '9999900000')))
+        self.assertTrue(self.store.book('csp', self._row('Ravi', '7896543210')))
+        self.assertFalse(self.store.book('csp', self._row('Gita', '9000000001')))
+        self.assertEqual((self.store.count('csp'), self.store.count('gendoc')), (2, 0))
+        self.assertEqual(self.store.find('csp', 'Asha', '9999900000').name, 'Asha')
+        self.assertIsNone(self.store.find('csp', 'Gita', '9000000001'))
+        self.assertIsNone(self.store.find('gendoc', 'Asha', '9999900000'))
+        self.assertIsNone(self.store.find('csp', 'Asha', '9999900000', self.today - timedelta(days=1)))
+
+    def test_signals_confirmed_bookings_only(self):
+        booked = mock.Mock()
+        appointment_booked.connect(booked, weak=False, dispatch_uid='test-booked')
+        self.addCleanup(appointment_booked.disconnect, dispatch_uid='test-booked')
+        with self.captureOnCommitCallbacks(execute=True):
+            # The hold expired before the booking could confirm it
+            with mock.patch.object(self.store.slots, 'confirm', return_value=False):
+                self.assertFalse(self.store.book('csp', self._row('Asha', '9999900000')))
+            self.assertTrue(self.store.book('csp', self._row('Ravi', '7896543210')))
+        self.assertEqual([call.kwargs['phone'] for call in booked.call_args_list], ['7896543210'])
+        self.assertIsNone(self.store.find('csp', 'Asha', '9999900000'))
+
+    def test_import_export_and_rollover(self):
+        old = self.today - timedelta(days=3)
+        rows = [self._row('Asha', '9999900000', 'gendoc'), self._row('Ravi', '7896543210', 'gendoc')]
+        source = os.path.join(self.dir, 'import.csv')
+        with open(source, 'w', newline="") as f:
+            csv.writer(f).writerows([rows[0], [], rows[1]])
+        self.assertEqual(self.store.import_csv('gendoc', source, old, batch_size=1), 2)
+        self.assertEqual((self.store.count('gendoc'), self.store.count('gendoc', old)), (0, 2))
+        target = os.path.join(self.dir, 'export.csv')
+        self.store.export_csv('gendoc', target, old)
+        with open(target, 'r', newline="") as f:
+            self.assertEqual(list(csv.reader(f)), rows)
+
+        self.store.rollover('gendoc', old)
+        self.assertEqual(self.store.count('gendoc', old), 0)
+        self.assertIsNone(self.store.find('gendoc', 'Asha', '9999900000', old))
+
+    def test_import_signals_once_committed(self):
+        old = self.today - timedelta(days=3)
+        source = os.path.join(self.dir, 'import.csv')
+        with open(source, 'w', newline="") as f:
+            csv.writer(f).writerows([self._row('Asha', '9999900000'), self._row('Ravi', '7896543210')])
+        booked = mock.Mock()
+        appointment_booked.connect(booked, weak=False, dispatch_uid='test-booked')
+        self.addCleanup(appointment_booked.disconnect, dispatch_uid='test-booked')
+        create = Appointment.objects.bulk_create
+        calls = []
+
+        def failing(appointments):
+            calls.append(appointments)
+            if len(calls) == 2:
+                raise DatabaseError('disk full')
+            return create(appointments)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with mock.patch.object(Appointment.objects, 'bulk_create', side_effect=failing):
+                with self.assertRaises(DatabaseError):
+                    self.store.import_csv('csp', source, old, batch_size=1)
+        # The rolled back import booked nobody
+        booked.assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.store.import_csv('csp', source, old), 2)
+        self.assertEqual([(call.kwargs['phone'], call.kwargs['date']) for call in booked.call_args_list],
+                         [('9999900000', old), ('7896543210', old)])
+
+
+def _records(*entries, doctor='csp'):
+    return HistoryRecords(HistoryRecord.parse(entry, doctor) for entry in entries)
+
+
+def _inorder(tree, pos):
+    """ Returns the keys of the subtree at `pos' in order.
+    """
+    if pos is None:
+        return []
+    return _inorder(tree, tree.left(pos)) + [pos.pat_num] + _inorder(tree, tree.right(pos))
+
+
+def _checkBalanced(test, tree, pos):
+    """ Checks the AVL property and the stored heights of the subtree at
+    `pos'. Returns its height.
+    """
+    if pos is None:
+        return -1
+    left = _checkBalanced(test, tree, tree.left(pos))
+    right = _checkBalanced(test, tree, tree.right(pos))
+    test.assertLessEqual(abs(left - right), 1)
+    test.assertEqual(tree.height(pos), 1 + max(left, right))
+    return 1 + max(left, right)
+
+
+class BinarySearchTreeTests(TestCase):
+    """ The AVL history tree stays balanced and keeps every patient.
+    """
+
+    tree_class = BinarySearchTree
+
+    def test_sorted_inserts_stay_balanced(self):
+        tree = self.tree_class()
+        for key in range(1, 1025):
+            tree.insert(key, _records(f'visit {key},2024-01-01'), 'csp')
+        self.assertEqual(len(tree), 1024)
+        self.assertEqual(_inorder(tree, tree.root()), list(range(1, 1025)))
+        _checkBalanced(self, tree, tree.root())
+        self.assertLessEqual(tree.height(), 1.45 * math.log2(1025))
+        self.assertEqual(tree.search(700).pat_his[0].text, 'visit 700')
+        self.assertIsNone(tree.search(2000))
+
+    def test_insert_extends_the_patient_history(self):
+        tree = self.tree_class()
+        tree.insert(42, _records('fever,2024-01-05'), 'csp')
+        tree.insert(42, _records('cough,2024-01-02', 'checkup,2024-02-01'), 'csp')
+        self.assertEqual(len(tree), 1)
+        self.assertEqual([str(record) for record in tree.search(42).pat_his],
+                         ['cough,2024-01-02', 'fever,2024-01-05', 'checkup,2024-02-01'])
+
+    def test_random_inserts(self):
+        rnd = random.Random(7)
+        keys = rnd.sample(range(1, 10 ** 10), 2000)
+        tree = self.tree_class()
+        for key in keys:
+            tree.insert(key, _records(f'{key},2024-03-01'), 'gendoc')
+        self.assertEqual(_inorder(tree, tree.root()), sorted(keys))
+        _checkBalanced(self, tree, tree.root())
+        for key in keys[::50]:
+            pos = tree.search(key)
+            self.assertEqual((pos.pat_num, pos.pat_docass), (key, 'gendoc'))
+
+
+class BinarySearchTreeDeleteTests(TestCase):
+    """ Deleting patients keeps the AVL tree ordered and balanced.
+    """
+
+    def test_delete(self):
+        tree = BinarySearchTree()
+        for key in range(1, 513):
+            tree.insert(key, _records(f'{key},2024-01-01'), 'csp')
+        for key in range(1, 513, 2):
+            self.assertEqual(tree.delete(key).pat_num, key)
+        self.assertIsNone(tree.delete(1))
+        self.assertEqual(len(tree), 256)
+        self.assertEqual(_inorder(tree, tree.root()), list(range(2, 513, 2)))
+        _checkBalanced(self, tree, tree.root())
+        self.assertEqual(tree.search(100).pat_his[0].text, '100')
+
+
+class HistoryStoreRecoveryTests(TestCase):
+    """ The history store comes back from its snapshot and log after the
+    process dies, whether or not it was closed.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='clinictest')
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def _open(self, **options):
+        store = HistoryStore(self.dir, **options)
+        self.addCleanup(store.close)
+        return store
+
+    @staticmethod
+    def _history(store, doctor, pat_num):
+        records = store.search(doctor, pat_num)
+        return [str(record) for record in records] if records is not None else None
+
+    def test_log_replayed_after_crash(self):
+        store = self._open()
+        store.add('csp', '9876543210', ['fever,2024-01-02'])
+        store.add('csp', '9876543210', ['cough,2024-01-09'])
+        store.amend('csp', '9876543210', 'dry cough,2024-01-09')
+        store.add('gendoc', '9123456780', ['checkup,2024-02-01'])
+        # No close(): the process died with every change in the log only
+        recovered = self._open()
+        self.assertEqual(self._history(recovered, 'csp', '9876543210'),
+                         ['fever,2024-01-02', 'dry cough,2024-01-09'])
+        self.assertEqual(self._history(recovered, 'gendoc', '9123456780'), ['checkup,2024-02-01'])
+        self.assertIsNone(recovered.search('gendoc', '9876543210'))
+
+    def test_torn_last_record_dropped(self):
+        store = self._open()
+        store.add('csp', '9876543210', ['fever,2024-01-02'])
+        # The process died in the middle of the next append
+        with open(os.path.join(self.dir, 'history.0.wal'), 'a') as f:
+            f.write('{"op": "add", "doctor": "csp", "num": 98765')
+        recovered = self._open()
+        self.assertEqual(self._history(recovered, 'csp', '9876543210'), ['fever,2024-01-02'])
+        # The torn record was cut off, so the log takes new records again
+        recovered.add('csp', '9876543210', ['cough,2024-01-09'])
+        self.assertEqual(self._history(self._open(), 'csp', '9876543210'),
+                         ['fever,2024-01-02', 'cough,2024-01-09'])
+
+    def test_snapshot_and_log_tail(self):
+        store = self._open(snapshot_every=3)
+        for day in range(1, 6):
+            store.add('csp', '9876543210', [f'visit {day},2024-03-0{day}'])
+        # Waits for the snapshot written in the background
+        store.close()
+        self.assertTrue(os.path.exists(os.path.join(self.dir, HistoryStore.SNAPSHOT)))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'history.0.wal')))
+        recovered = self._open(snapshot_every=3)
+        self.assertEqual(self._history(recovered, 'csp', '9876543210'),
+                         [f'visit {day},2024-03-0{day}' for day in range(1, 6)])
+        self.assertEqual(sorted(recovered.patients('csp')), ['9876543210'])
+
+    def test_changes_during_snapshot(self):
+        for tree_class in (BinarySearchTree, ArrayBinarySearchTree):
+            with self.subTest(tree_class=tree_class.__name__):
+                shutil.rmtree(self.dir)
+                store = self._open(snapshot_every=2, tree_class=tree_class)
+                write, started, resume = store._writeSnapshot, threading.Event(), threading.Event()
+
+                def slow(*args):
+                    started.set()
+                    resume.wait(5)
+                    return write(*args)
+
+                with mock.patch.object(store, '_writeSnapshot', side_effect=slow):
+                    store.add('csp', '9876543210', ['fever,2024-01-02'])
+                    store.add('csp', '9123456780', ['checkup,2024-01-03'])
+                    self.assertTrue(started.wait(5))
+                    # Requests go on while the snapshot is written
+                    store.add('csp', '9876543210', ['cough,2024-01-09'])
+                    store.amend('csp', '9123456780', 'follow-up,2024-01-10')
+                    resume.set()
+                    store.close()
+                expected = {'9876543210': ['fever,2024-01-02', 'cough,2024-01-09'],
+                            '9123456780': ['follow-up,2024-01-10']}
+                for pat_num, history in expected.items():
+                    self.assertEqual(self._history(store, 'csp', pat_num), history)
+                self.assertEqual(sorted(os.listdir(self.dir)), ['history.1.wal', HistoryStore.SNAPSHOT])
+                recovered = self._open(tree_class=tree_class)
+                for pat_num, history in expected.items():
+                    self.assertEqual(self._history(recovered, 'csp', pat_num), history)
+
+    def test_failed_snapshot_keeps_the_logs(self):
+        store = self._open(snapshot_every=2)
+        with mock.patch.object(store, '_writeSnapshot', side_effect=OSError('disk full')), \
+                self.assertLogs('home.history', 'ERROR'):
+            store.add('csp', '9876543210', ['fever,2024-01-02'])
+            store.add('csp', '9876543210', ['cough,2024-01-09'])
+            store.close()
+        self.assertEqual(sorted(os.listdir(self.dir)), ['history.0.wal', 'history.1.wal'])
+        recovered = self._open()
+        recovered.add('csp', '9876543210', ['rash,2024-01-12'])
+        self.assertEqual(self._history(self._open(), 'csp', '9876543210'),
+                         ['fever,2024-01-02', 'cough,2024-01-09', 'rash,2024-01-12'])
+
+    def test_unappliable_changes(self):
+        store = self._open()
+        for doctor, entries in (('nobody', ['fever,2024-01-02']), ('csp', [None])):
+            with self.assertRaises(ValueError):
+                store.add(doctor, '9876543210', entries)
+        store.add('csp', '9876543210', ['fever,2024-01-02'])
+        store.close()
+        with open(os.path.join(self.dir, 'history.0.wal'), 'r') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        # A record no store can apply (e.g. of a doctor who left) is skipped
+        with open(os.path.join(self.dir, 'history.0.wal'), 'a') as f:
+            f.write(json.dumps({'op': 'add', 'doctor': 'nobody', 'num': 9876543210, 'entries': ['x']}) + '\n')
+            f.write(json.dumps({'op': 'add', 'doctor': 'csp', 'num': 9876543210,
+                                'entries': ['cough,2024-01-09']}) + '\n')
+        with self.assertLogs('home.history', 'ERROR'):
+            recovered = self._open()
+        self.assertEqual(self._history(recovered, 'csp', '9876543210'), ['fever,2024-01-02', 'cough,2024-01-09'])
+
+    def test_search_returns_a_copy(self):
+        store = self._open()
+        store.add('csp', '9876543210', ['fever,2024-01-02'])
+        records = store.search('csp', '9876543210')
+        records.add(HistoryRecord.parse('rash,2024-01-05', 'csp'))
+        store.amend('csp', '9876543210', 'dry cough,2024-01-02')
+        self.assertEqual([str(record) for record in records], ['fever,2024-01-02', 'rash,2024-01-05'])
+        self.assertEqual(self._history(store, 'csp', '9876543210'), ['dry cough,2024-01-02'])
+
+
+def _patient(pnum, doctor='csp'):
+    return queuepatientobject(f'patient {pnum}', doctor, pnum)
+
+
+class PatientQueueTests(TestCase):
+    """ Triage lanes are served in order, each first come, first served,
+    and positions stay right as patients join, move up and leave.
+    """
+
+    def _positions(self, queue):
+        return [queue.position(patient.pnum) for patient in queue]
+
+    def test_emergencies_go_first(self):
+        queue = PatientQueue('csp')
+        for pnum in ('1', '2', '3'):
+            self.assertTrue(queue.enqueue(_patient(pnum)))
+        queue.emergency(_patient('4'), 2)
+        queue.emergency(_patient('5'))
+        queue.emergency(_patient('6'), 2)
+        self.assertEqual([patient.pnum for patient in queue], ['5', '4', '6', '1', '2', '3'])
+        self.assertEqual(self._positions(queue), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(queue.position('2'), 5)
+        self.assertEqual([queue.dequeue().pnum for _ in range(6)], ['5', '4', '6', '1', '2', '3'])
+        self.assertIsNone(queue.dequeue())
+        self.assertEqual(len(queue), 0)
+
+    def test_move_up_and_remove(self):
+        queue = PatientQueue('csp')
+        for pnum in ('1', '2', '3', '4'):
+            queue.enqueue(_patient(pnum))
+        # Already waiting: a second check-in keeps the place
+        self.assertFalse(queue.enqueue(_patient('2')))
+        self.assertTrue(queue.emergency(_patient('3')))
+        self.assertFalse(queue.enqueue(_patient('3')))
+        self.assertEqual(queue.position('3'), 1)
+        self.assertEqual(queue.position('4'), 4)
+        self.assertEqual(queue.remove('1').pnum, '1')
+        self.assertIsNone(queue.remove('1'))
+        self.assertIsNone(queue.position('1'))
+        self.assertEqual([patient.pnum for patient in queue], ['3', '2', '4'])
+        self.assertEqual(self._positions(queue), [1, 2, 3])
+        with self.assertRaises(ValueError):
+            queue.emergency(_patient('9'), PatientQueue.REGULAR)
+
+    def test_positions_match_a_list(self):
+        rnd = random.Random(11)
+        queue = PatientQueue('csp')
+        # (level, step joined, phone) of the waiting patients, in order
+        expected = []
+        for step in range(3000):
+            action = rnd.random()
+            if action < 0.5:
+                pnum = str(rnd.randint(1, 200))
+                level = PatientQueue.REGULAR if rnd.random() < 0.8 else rnd.randint(1, 3)
+                waiting = next((entry for entry in expected if entry[2] == pnum), None)
+                joined = waiting is None or waiting[0] > level
+                self.assertEqual(queue.enqueue(_patient(pnum), level), joined)
+                if joined:
+                    if waiting is not None:
+                        expected.remove(waiting)
+                    expected.append((level, step, pnum))
+            elif action < 0.8:
+                patient = queue.dequeue()
+                if expected:
+                    first = min(expected)
+                    expected.remove(first)
+                    self.assertEqual(patient.pnum, first[2])
+                else:
+                    self.assertIsNone(patient)
+            elif expected:
+                entry = rnd.choice(expected)
+                expected.remove(entry)
+                self.assertEqual(queue.remove(entry[2]).pnum, entry[2])
+            expected.sort()
+            self.assertEqual(len(queue), len(expected))
+            for position, (level, joined_at, pnum) in enumerate(expected[:20], 1):
+                self.assertEqual(queue.position(pnum), position)
+
+
+class LocalStateBackendTests(TestCase):
+    """ The queues and history held in the memory of a single worker.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.state = LocalStateBackend(history_dir=self.dir)
+        self.addCleanup(self.state.store.close)
+        # The receivers of the queue and history changes read this backend
+        patcher = mock.patch('home.state.get_state', return_value=self.state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _waiting(pnum, doctor='csp'):
+        return queuepatientobject(f'Patient {pnum}', doctor, pnum)
+
+    def test_queue_order_and_positions(self):
+        for pnum in ('1', '2', '3'):
+            self.state.enqueue('csp', self._waiting(pnum))
+        self.state.emergency('csp', self._waiting('3'), 2)
+        self.state.emergency('csp', self._waiting('4'))
+        self.state.enqueue('gendoc', self._waiting('1', 'gendoc'))
+        self.assertEqual([patient.pnum for patient in self.state.queue('csp')], ['4', '3', '1', '2'])
+        self.assertEqual([self.state.position('csp', pnum) for pnum in ('4', '3', '1', '2')], [1, 2, 3, 4])
+        self.assertEqual((self.state.queue_size('csp'), self.state.queue_size('gendoc')), (4, 1))
+        with self.assertRaises(ValueError):
+            self.state.emergency('csp', self._waiting('5'), PatientQueue.REGULAR)
+
+        self.assertEqual(self.state.remove('csp', '1').pnum, '1')
+        self.assertIsNone(self.state.remove('csp', '1'))
+        self.assertIsNone(self.state.position('csp', '1'))
+        self.assertEqual(self.state.dequeue('csp').pnum, '4')
+        self.assertEqual([patient.pnum for patient in self.state.queue('csp')], ['3', '2'])
+        self.assertEqual(self.state.dequeue('gendoc').pnum, '1')
+        self.assertIsNone(self.state.dequeue('gendoc'))
+
+    def test_history_survives_a_restart(self):
+        self.state.add_history('csp', '9876543210', ['fever,2024-01-02', 'cough,2024-01-09'])
+        self.state.amend_history('csp', '9876543210', 'dry cough,2024-01-09')
+        self.state.add_history('gendoc', '9876543210', ['checkup,2024-01-05'])
+        self.assertEqual([str(entry) for entry in self.state.history('csp', '9876543210')],
+                         ['fever,2024-01-02', 'dry cough,2024-01-09'])
+        self.assertIsNone(self.state.history('csp', '9123456780'))
+        self.state.store.close()
+
+        state = LocalStateBackend(history_dir=self.dir)
+        self.addCleanup(state.store.close)
+        self.assertEqual([str(entry) for entry in state.history('csp', '9876543210')],
+                         ['fever,2024-01-02', 'dry cough,2024-01-09'])
+        self.assertEqual([str(entry) for entry in state.history('gendoc', '9876543210')],
+                         ['checkup,2024-01-05'])
+        # Queues are not kept across restarts
+        self.assertEqual(state.queue('csp'), [])
+
+
+class DatabaseStateBackendTests(TestCase):
+    """ The queues and history kept in the database.
+    """
+
+    def setUp(self):
+        self.state = DatabaseStateBackend()
+
+    def test_queue_order_and_positions(self):
+        for pnum in ('1', '2', '3'):
+            self.assertTrue(self.state.enqueue('csp', _patient(pnum)))
+        self.assertFalse(self.state.enqueue('csp', _patient('1')))
+        self.assertTrue(self.state.emergency('csp', _patient('3'), 2))
+        self.assertTrue(self.state.emergency('csp', _patient('4')))
+        self.assertTrue(self.state.enqueue('gendoc', _patient('1', 'gendoc')))
+        self.assertEqual([patient.pnum for patient in self.state.queue('csp')], ['4', '3', '1', '2'])
+        self.assertEqual([self.state.position('csp', pnum) for pnum in ('4', '3', '1', '2')], [1, 2, 3, 4])
+        self.assertEqual(self.state.position('gendoc', '1'), 1)
+        self.assertEqual(self.state.queue_size('csp'), 4)
+        self.assertEqual(self.state.remove('csp', '1').pnum, '1')
+        self.assertIsNone(self.state.remove('csp', '1'))
+        self.assertEqual(self.state.position('csp', '2'), 3)
+
+    def test_move_up_is_atomic(self):
+        self.state.enqueue('csp', _patient('1'))
+        self.state.enqueue('csp', _patient('2'))
+        with mock.patch.object(QueueEntry.objects, 'create', side_effect=DatabaseError('disk full')):
+            with self.assertRaises(DatabaseError):
+                self.state.emergency('csp', _patient('2'))
+        # The failed move left the patient waiting where they were
+        self.assertEqual(QueueEntry.objects.get(doctor='csp', phone='2').level, PatientQueue.REGULAR)
+        self.assertTrue(self.state.emergency('csp', _patient('2')))
+        self.assertEqual([patient.pnum for patient in self.state.queue('csp')], ['2', '1'])
+        self.assertEqual(QueueEntry.objects.filter(doctor='csp', phone='2').count(), 1)
+
+    @override_settings(CLINIC_REQUIRE_ROLES=False, STORAGES={
+        **settings.STORAGES,
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    })
+    def test_emergency_form_triage(self):
+        with mock.patch('home.views.state', self.state):
+            for pnum, triage in (('9876543211', '2'), ('9876543212', 'urgent'), ('9876543213', '9'),
+                                 ('9876543214', None)):
+                form = {'submit': '1', 'p_name': 'patient', 'doc_ass': 'csp', 'p_num': pnum}
+                if triage is not None:
+                    form['triage'] = triage
+                response = self.client.post('/receptionist/recephome/emergency', form)
+                self.assertEqual(response.status_code, 200)
+        # Triage levels that cannot be read fall back to the most urgent one
+        self.assertEqual([(entry.phone, entry.level) for entry in QueueEntry.objects.order_by('level', 'pk')],
+                         [('9876543212', 1), ('9876543213', 1), ('9876543214', 1), ('9876543211', 2)])
+
+    def test_history(self):
+        self.state.add_history('csp', '9876543210', ['fever,2024-01-02', 'cough,2024-01-09'])
+        self.state.amend_history('csp', '9876543210', 'dry cough,2024-01-09')
+        self.state.add_history('gendoc', '9876543210', ['checkup,2024-01-05'])
+        self.assertEqual(self.state.history('csp', '9876543210'), ['fever,2024-01-02', 'dry cough,2024-01-09'])
+        self.assertIsNone(self.state.history('csp', '9123456780'))
+        self.assertEqual([str(record) for record in self.state.patient_history('9876543210')],
+                         ['fever,2024-01-02', 'checkup,2024-01-05', 'dry cough,2024-01-09'])
+        entries, cursor = self.state.history_page('csp', '9876543210', limit=1)
+        self.assertEqual(entries, ['fever,2024-01-02'])
+        self.assertTrue(self.state.valid_cursor(cursor))
+        self.assertEqual(self.state.history_page('csp', '9876543210', cursor=cursor, limit=1),
+                         (['dry cough,2024-01-09'], None))
+
+
+class SlotReservationsTests(TestCase):
+    """ A day never takes more bookings than the doctor's capacity, and
+    the slots of failed bookings come back.
+    """
+
+    day = date(2024, 5, 6)
+
+    def test_full_day_is_never_overbooked(self):
+        slots = SlotReservations(capacity={'csp': 3, 'gendoc': 1}, hold_seconds=600)
+        holds = [slots.reserve('csp', self.day) for _ in range(5)]
+        self.assertEqual(sum(hold is not None for hold in holds), 3)
+        self.assertIsNone(holds[-1])
+        self.assertEqual(SlotCounter.objects.get(doctor='csp', date=self.day).taken, 3)
+        self.assertEqual(slots.available('csp', self.day), 0)
+        # Days and doctors are counted apart
+        self.assertIsNotNone(slots.reserve('gendoc', self.day))
+        self.assertIsNotNone(slots.reserve('csp', date(2024, 5, 7)))
+
+    def test_released_slot_is_booked_again(self):
+        slots = SlotReservations(capacity={'csp': 2, 'gendoc': 2}, hold_seconds=600)
+        first = slots.reserve('csp', self.day)
+        second = slots.reserve('csp', self.day)
+        self.assertTrue(slots.confirm(first))
+        slots.release(second)
+        # Releasing twice gives the slot back once
+        slots.release(second)
+        self.assertEqual(slots.available('csp', self.day), 1)
+        self.assertIsNotNone(slots.reserve('csp', self.day))
+        self.assertIsNone(slots.reserve('csp', self.day))
+        self.assertEqual(SlotCounter.objects.get(doctor='csp', date=self.day).taken, 2)
+
+    def test_expired_holds_give_their_slot_back(self):
+        slots = SlotReservations(capacity={'csp': 1, 'gendoc': 1}, hold_seconds=0)
+        stale = slots.reserve('csp', self.day)
+        # The day looks full: the expired hold is given back first
+        fresh = slots.reserve('csp', self.day)
+        self.assertIsNotNone(fresh)
+        self.assertEqual(SlotHold.objects.get(pk=stale.pk).state, SlotHold.RELEASED)
+        self.assertFalse(slots.confirm(stale))
+        self.assertTrue(slots.confirm(fresh))
+        self.assertEqual(SlotCounter.objects.get(doctor='csp', date=self.day).taken, 1)
+
+    def test_failed_hold_takes_no_slot(self):
+        slots = SlotReservations(capacity={'csp': 1, 'gendoc': 1}, hold_seconds=600)
+        with mock.patch.object(SlotHold.objects, 'create', side_effect=DatabaseError('disk full')):
+            with self.assertRaises(DatabaseError):
+                slots.reserve('csp', self.day)
+        self.assertEqual(slots.available('csp', self.day), 1)
+        self.assertIsNotNone(slots.reserve('csp', self.day))
+
+
+class BenchmarkTests(TestCase):
+    """ The synthetic clinic day, percentiles and the baseline comparison
+    of the benchmark harness.
+    """
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, p) for p in (0, 50, 95, 99, 100)], [1, 50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_compare(self):
+        baseline = {'endpoints': {
+            'makeappointment': {'p95_ms': 10.0, 'peak_memory_kb': 100.0, 'throughput_rps': 50.0},
+            'dequeuecsp': {'p95_ms': 2.0, 'peak_memory_kb': 0, 'throughput_rps': 80.0},
+            'retired': {'p95_ms': 1.0},
+        }}
+        results = {'endpoints': {
+            'makeappointment': {'p95_ms': 13.0, 'peak_memory_kb': 110.0, 'throughput_rps': 30.0},
+            'dequeuecsp': {'p95_ms': 2.2, 'peak_memory_kb': 50.0, 'throughput_rps': 100.0},
+            'emergency': {'p95_ms': 5.0},
+        }}
+        self.assertEqual(compare(results, baseline), [
+            'makeappointment: p95_ms 10.00 -> 13.00 (+30%)',
+            'makeappointment: throughput_rps 50.00 -> 30.00 (-40%)',
+        ])
+        self.assertEqual(compare(results, baseline, tolerance=0.5), [])
+        self.assertEqual(compare(baseline, baseline), [])
+
+    def test_clinic_day_is_reproducible(self):
+        requests = list(ClinicDay(30, seed=3).requests())
+        self.assertEqual(list(ClinicDay(30, seed=3).requests()), requests)
+        self.assertNotEqual(list(ClinicDay(30, seed=4).requests()), requests)
+        # Every visit is called in from the queue once
+        self.assertEqual(sum(endpoint.startswith('dequeue') for endpoint, path, data in requests), 30)
+        phones = {data['p_num'] for endpoint, path, data in requests if data and 'p_num' in data}
+        self.assertTrue(all(len(phone) == 10 and phone[0] in '6789' for phone in phones))
+
+
+class MetricsTests(TestCase):
+    """ The metrics registry and its Prometheus text rendering.
+    """
+
+    def test_counter_and_gauges(self):
+        registry = Registry()
+        responses = registry.register(Counter('t_responses', "Responses.", ['status']))
+        waiting = registry.register(Gauge('t_waiting', "Waiting.", ['doctor']))
+        registry.register(Gauge('t_length', "Length.", ['doctor'], function=lambda: {('csp',): 3}))
+        responses.inc(1, '200')
+        responses.inc(2, '200')
+        responses.inc(1, 'say "hi"\n')
+        waiting.set(4, 'gendoc')
+        waiting.set(2, 'gendoc')
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP t_responses Responses.',
+            '# TYPE t_responses counter',
+            't_responses_total{status="200"} 3',
+            't_responses_total{status="say \\"hi\\"\\n"} 1',
+            '# HELP t_waiting Waiting.',
+            '# TYPE t_waiting gauge',
+            't_waiting{doctor="gendoc"} 2',
+            '# HELP t_length Length.',
+            '# TYPE t_length gauge',
+            't_length{doctor="csp"} 3',
+        ]) + '\n')
+
+    def test_histogram_buckets_and_window(self):
+        histogram = Histogram('t_seconds', "Time.", ['operation'], buckets=(1, 2, 4))
+        for value in (0.5, 1.5, 3, 10):
+            histogram.observe(value, 'book')
+        text = histogram.render().splitlines()
+        self.assertEqual(text[2:8], [
+            't_seconds_bucket{operation="book",le="1"} 1',
+            't_seconds_bucket{operation="book",le="2"} 2',
+            't_seconds_bucket{operation="book",le="4"} 3',
+            't_seconds_bucket{operation="book",le="+Inf"} 4',
+            't_seconds_sum{operation="book"} 15.0',
+            't_seconds_count{operation="book"} 4',
+        ])
+        self.assertIn('# TYPE t_seconds_window gauge', text)
+        self.assertIn('t_seconds_window{operation="book",quantile="0.5"} 2.0', text)
+        # Values over the last bucket are reported as its bound
+        self.assertEqual(histogram.window('book'), {0.5: 2.0, 0.95: 4, 0.99: 4})
+        self.assertEqual(histogram.window('find'), {})
+        with histogram.time('find'):
+            pass
+        self.assertEqual(histogram.window('find')[0.5], 0.5)
+
+    def test_metrics_view(self):
+        # The queue lengths are read from the state backend
+        with mock.patch('home.state.get_state', return_value=DatabaseStateBackend()):
+            self.client.get('/metrics')
+            response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('clinic_request_seconds_count{route="metrics",method="GET"}', text)
+        self.assertIn('clinic_queue_length{doctor="csp"}', text)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.7').status_code, 403)
+
+
+class _BlockingStream(io.StringIO):
+    """ Stream whose writes wait until `release' is set.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.writing = threading.Event()
+        self.release = threading.Event()
+        self.text = None
+
+    def write(self, text):
+        self.writing.set()
+        self.release.wait(5)
+        return super().write(text)
+
+    def close(self):
+        self.text = self.getvalue()
+        super().close()
+
+
+class StructuredLoggingTests(TestCase):
+    """ JSON log lines, per-event sampling and the batching handler.
+    """
+
+    @staticmethod
+    def _record(event, level=logging.INFO, **fields):
+        return logging.getLogger('home.tests').makeRecord(
+            'home.tests', level, __file__, 1, event, (), None, extra={'event': event, 'fields': fields})
+
+    def test_json_formatter(self):
+        record = self._record('queue.checkin', doctor='csp', position=2)
+        record.request_id = 'abc123'
+        data = json.loads(JsonFormatter().format(record))
+        self.assertRegex(data.pop('time'), r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z$')
+        self.assertEqual(data, {'level': 'INFO', 'logger': 'home.tests', 'event': 'queue.checkin',
+                                'message': 'queue.checkin', 'request_id': 'abc123',
+                                'doctor': 'csp', 'position': 2})
+
+    def test_sampling_filter(self):
+        sampling = SamplingFilter({'tree.search': 0, 'queue.checkin': 0.5})
+        self.assertFalse(sampling.filter(self._record('tree.search')))
+        # Warnings and errors are always kept, as are events without a rate
+        self.assertTrue(sampling.filter(self._record('tree.search', logging.WARNING)))
+        self.assertTrue(sampling.filter(self._record('auth.login')))
+        with mock.patch.object(random, 'random', return_value=0.4):
+            self.assertTrue(sampling.filter(self._record('queue.checkin')))
+        with mock.patch.object(random, 'random', return_value=0.6):
+            self.assertFalse(sampling.filter(self._record('queue.checkin')))
+
+    def test_batching_handler_drops_when_full(self):
+        stream = _BlockingStream()
+        handler = BatchingHandler(stream, batch_size=10, flush_interval=0.05, capacity=1)
+        handler.emit(self._record('first'))
+        # The writer thread is now busy with the first record
+        self.assertTrue(stream.writing.wait(5))
+        handler.emit(self._record('second'))
+        handler.emit(self._record('third'))
+        self.assertEqual(handler.dropped, 1)
+        stream.release.set()
+        handler.close()
+        self.assertEqual(stream.text, 'first\nsecond\n')
+
+    def test_request_id(self):
+        response = self.client.get('/nowhere', HTTP_X_REQUEST_ID='proxy-42')
+        self.assertEqual(response['X-Request-ID'], 'proxy-42')
+        response = self.client.get('/nowhere', HTTP_X_REQUEST_ID='not a sane id')
+        self.assertRegex(response['X-Request-ID'], r'^[0-9a-f]{32}$')
+
+
+class FragmentVersionTests(TestCase):
+    """ Cached queue and history fragments are keyed on version counters
+    bumped by the state change signals.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_queue_version(self):
+        csp, gendoc = queue_version('csp'), queue_version('gendoc')
+        self.assertEqual(queue_version('csp'), csp)
+        DatabaseStateBackend().enqueue('csp', queuepatientobject('Asha', 'csp', '9876543210'))
+        self.assertGreater(queue_version('csp'), csp)
+        self.assertEqual(queue_version('gendoc'), gendoc)
+
+    def test_history_version(self):
+        version = history_version('csp', '9876543210')
+        other = history_version('gendoc', '9876543210')
+        DatabaseStateBackend().add_history('csp', '9876543210', ['fever,2024-01-02'])
+        self.assertGreater(history_version('csp', '9876543210'), version)
+        self.assertEqual(history_version('gendoc', '9876543210'), other)
+
+    def test_evicted_counter_is_not_reused(self):
+        version = queue_version('csp')
+        cache.delete('clinic:queue:csp')
+        DatabaseStateBackend().enqueue('csp', queuepatientobject('Asha', 'csp', '9876543210'))
+        self.assertNotEqual(queue_version('csp'), version)
+
+    def test_fragment_cached(self):
+        template = Template('{% load cache %}{% cache 600 queuetable doctor version %}x{% endcache %}')
+        version = queue_version('csp')
+        self.assertFalse(fragment_cached('queuetable', 'csp', version))
+        template.render(Context({'doctor': 'csp', 'version': version}))
+        self.assertTrue(fragment_cached('queuetable', 'csp', version))
+        self.assertFalse(fragment_cached('queuetable', 'gendoc', version))
+        self.assertFalse(fragment_cached('queuetable', 'csp', version + 1))
+
+
+class StaticAssetTests(TestCase):
+    """ Hashed, gzipped static files and the choice of image variants.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.source = os.path.join(self.dir, 'source')
+        self.root = os.path.join(self.dir, 'root')
+        os.makedirs(self.source)
+        with open(os.path.join(self.source, 'site.css'), 'w') as f:
+            f.write('body { background: url("bg.png"); }\n' + '.row { margin: 0; }\n' * 50)
+        with open(os.path.join(self.source, 'bg.png'), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + bytes(range(256)))
+        with open(os.path.join(self.source, 'tiny.txt'), 'w') as f:
+            f.write('x')
+
+    def _collect(self):
+        with override_settings(STATICFILES_DIRS=[self.source], STATIC_ROOT=self.root,
+                               STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder']):
+            call_command('collectstatic', interactive=False, verbosity=0)
+        with open(os.path.join(self.root, 'staticfiles.json')) as f:
+            return json.load(f)['paths']
+
+    def test_collect_hashes_and_compresses(self):
+        paths = self._collect()
+        self.assertRegex(paths['site.css'], r'^site\.[0-9a-f]{12}\.css$')
+        with open(os.path.join(self.root, paths['site.css']), 'rb') as f:
+            css = f.read()
+        self.assertIn(paths['bg.png'].encode(), css)
+        with open(os.path.join(self.root, paths['site.css'] + '.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), css)
+        # Images are not compressed, nor files gzip would make bigger
+        self.assertFalse(os.path.exists(os.path.join(self.root, paths['bg.png'] + '.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, paths['tiny.txt'] + '.gz')))
+
+    def test_served_with_cache_headers(self):
+        paths = self._collect()
+        with override_settings(STATIC_ROOT=self.root):
+            response = self.client.get('/static/' + paths['site.css'], HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+            self.assertIn('Accept-Encoding', response['Vary'])
+            response = self.client.get('/static/tiny.txt')
+            self.assertEqual(b''.join(response.streaming_content), b'x')
+            self.assertEqual(response['Cache-Control'], f'public, max-age={settings.CLINIC_STATIC_MAX_AGE}')
+
+    def test_optimized_url(self):
+        index = {'blur-hospital.jpg': {'widths': [640, 1280, 1920], 'formats': ['jpg', 'webp']}}
+        with mock.patch('home.assets.variants', return_value=index), \
+                override_settings(CLINIC_IMAGE_WIDTH=1920):
+            url = settings.STATIC_URL
+            self.assertTrue(optimized_url('blur-hospital.jpg', width=1000)
+                            .endswith(url + 'optimized/blur-hospital-1280.jpg'))
+            self.assertTrue(optimized_url('blur-hospital.jpg', 'webp', 5000)
+                            .endswith(url + 'optimized/blur-hospital-1920.webp'))
+            self.assertTrue(optimized_url('blur-hospital.jpg').endswith('blur-hospital-1920.jpg'))
+            # No such variant: the original image
+            self.assertTrue(optimized_url('blur-hospital.jpg', 'png').endswith(url + 'blur-hospital.jpg'))
+            self.assertTrue(optimized_url('logo.png').endswith(url + 'logo.png'))
+
+
+class RoleTests(TestCase):
+    """ Roles resolved at login and kept in the session, and the login
+    throttle.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    @override_settings(CLINIC_DOCTOR_ACCOUNTS={'sridharandoc': 'csp'})
+    def test_resolve(self):
+        self.assertEqual(resolve('sridharandoc'), ('doctor', 'csp'))
+        self.assertEqual(resolve('newdoc'), ('doctor', None))
+        self.assertEqual(resolve('karunarep'), ('receptionist', None))
+        self.assertEqual(resolve('ashapat'), ('patient', None))
+        self.assertEqual(resolve('admin'), (None, None))
+
+    def test_role_required(self):
+        @role_required('doctor', 'csp')
+        def view(request):
+            return HttpResponse(request.clinic_doctor)
+
+        def get(role=None, doctor=None):
+            request = RequestFactory().get('/doctor/doctorcsphome')
+            request.session = {ROLE_KEY: role, DOCTOR_KEY: doctor} if role else {}
+            return view(request)
+
+        with override_settings(CLINIC_REQUIRE_ROLES=True):
+            self.assertEqual(get('doctor', 'csp').content, b'csp')
+            for response in (get(), get('doctor', 'gendoc'), get('receptionist')):
+                self.assertEqual((response.status_code, response['Location']), (302, reverse('doctor')))
+        with override_settings(CLINIC_REQUIRE_ROLES=False):
+            self.assertEqual(get().status_code, 200)
+
+    def test_login_throttle(self):
+        throttle = LoginThrottle(attempts=3, seconds=60)
+        self.assertEqual([throttle.allow('sridharandoc', 'doctor') for _ in range(4)], [True, True, True, False])
+        self.assertTrue(throttle.allow('vijayalakshmidoc', 'doctor'))
+        throttle.succeeded('sridharandoc')
+        self.assertTrue(throttle.allow('sridharandoc', 'doctor'))
+
+    @override_settings(CLINIC_REQUIRE_ROLES=True)
+    def test_login_keeps_the_role(self):
+        User.objects.create_user(username='sridharandoc', password='secret')
+        self.assertEqual(self.client.get('/doctor/doctorcsphome').status_code, 302)
+        response = self.client.post('/doctor', {'username': 'sridharandoc', 'password': 'secret', 'login': '1'})
+        self.assertEqual(response['Location'], '/doctor/doctorcsphome')
+        self.assertEqual(self.client.get('/doctor/doctorcsphome').status_code, 200)
+        self.assertEqual(self.client.get('/doctor/doctorgendochome').status_code, 302)
+        self.assertEqual(self.client.get('/receptionist/recephome').status_code, 302)
+
+    def test_login_is_throttled(self):
+        attempts, seconds = settings.CLINIC_LOGIN_THROTTLE
+        for _ in range(attempts):
+            response = self.client.post('/receptionist', {'username': 'karunarep', 'password': 'x', 'login': '1'})
+            self.assertEqual(response.status_code, 200)
+        response = self.client.post('/receptionist', {'username': 'karunarep', 'password': 'x', 'login': '1'})
+        self.assertEqual(response.status_code, 429)
+
+
+class PatientLookupTests(TestCase):
+    """ Reception finds patients by a prefix of their phone number or of
+    any word of their name.
+    """
+
+    def setUp(self):
+        Appointment.objects.create(name='Ravi Kumar', doctor='csp', phone='7896543210')
+        Appointment.objects.create(name='Asha Rani', doctor='gendoc', phone='9999900000')
+        Appointment.objects.create(name='Ravi K', doctor='csp', phone='7896543210')
+        # A patient whose bookings were archived, named from the registry
+        Patient.objects.create(phone='5551234', name='Old Timer')
+        state = DatabaseStateBackend()
+        state.add_history('gendoc', '5551234', ['checkup,2023-01-01'])
+        patcher = mock.patch('home.state.get_state', return_value=state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lookup = PatientLookup(refresh=3600)
+
+    def test_search_by_name(self):
+        ravi = {'name': 'Ravi K', 'phone': '7896543210', 'doctor': 'csp'}
+        # The latest booking names the patient
+        self.assertEqual(self.lookup.search('ravi'), [ravi])
+        self.assertEqual(self.lookup.search('  K '), [ravi])
+        self.assertEqual(self.lookup.search('kum'), [])
+        self.assertEqual(self.lookup.search('rani'), [{'name': 'Asha Rani', 'phone': '9999900000', 'doctor': 'gendoc'}])
+        self.assertEqual(self.lookup.search('old'), [{'name': 'Old Timer', 'phone': '5551234', 'doctor': 'gendoc'}])
+
+    def test_search_by_phone(self):
+        for query in ('7896', '0789', '+91 78965 43210'):
+            self.assertEqual([match['phone'] for match in self.lookup.search(query)], ['7896543210'])
+        self.assertEqual(self.lookup.search('123'), [])
+
+    def test_doctor_and_limit(self):
+        self.assertEqual([match['doctor'] for match in self.lookup.search('a', doctor='gendoc')], ['gendoc'])
+        self.assertEqual(len(self.lookup.search('', limit=1)), 0)
+        self.lookup.search('ravi')
+        self.lookup.add('gendoc', 'Ravi Shankar', '7000000001')
+        self.assertEqual(len(self.lookup.search('ravi')), 2)
+        self.assertEqual(len(self.lookup.search('ravi', limit=1)), 1)
+        self.assertEqual(self.lookup.search('shank'),
+                         [{'name': 'Ravi Shankar', 'phone': '7000000001', 'doctor': 'gendoc'}])
+
+
+class HistoryIndexTests(TestCase):
+    """ Keyword search over the history, from the posting sets of the words.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.state = LocalStateBackend(history_dir=self.dir)
+        self.addCleanup(self.state.store.close)
+        patcher = mock.patch('home.state.get_state', return_value=self.state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = HistoryIndex(refresh=3600)
+        history_changed.connect(self.index.receiver, dispatch_uid='test-history-index')
+        self.addCleanup(history_changed.disconnect, dispatch_uid='test-history-index')
+
+    def _texts(self, query, **kwargs):
+        return [(match['phone'], match['text']) for match in self.index.search(query, **kwargs)]
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('Dry cough; PARACETAMOL 500mg, dry-cough'),
+                         {'dry', 'cough', 'paracetamol', '500mg'})
+        self.assertEqual(tokenize(' ,; '), set())
+
+    def test_every_word_matches(self):
+        self.state.add_history('csp', '9876543210', ['fever cough,2024-01-02', 'dry cough,2024-01-09'])
+        self.state.add_history('gendoc', '9123456780', ['Cough syrup,2024-02-01'])
+        self.assertEqual(self._texts('cough'), [('9123456780', 'Cough syrup'), ('9876543210', 'dry cough'),
+                                                ('9876543210', 'fever cough')])
+        self.assertEqual(self._texts('COUGH dry'), [('9876543210', 'dry cough')])
+        self.assertEqual(self._texts('cough', doctor='csp', until=date(2024, 1, 5)),
+                         [('9876543210', 'fever cough')])
+        self.assertEqual(self._texts('cough', limit=1), [('9123456780', 'Cough syrup')])
+        self.assertEqual(self._texts('rash'), [])
+        self.assertEqual(self._texts(''), [])
+
+    def test_reindexed_on_write(self):
+        self.state.add_history('csp', '9876543210', ['fever,2024-01-02'])
+        self.assertEqual(self._texts('fever'), [('9876543210', 'fever')])
+        self.state.amend_history('csp', '9876543210', 'dry cough,2024-01-02')
+        self.state.add_history('csp', '9123456780', ['fever,2024-01-03'])
+        self.assertEqual(self._texts('fever'), [('9123456780', 'fever')])
+        self.assertEqual(self._texts('cough'), [('9876543210', 'dry cough')])
+
+    def test_rebuilt_for_a_shared_state_only(self):
+        with mock.patch('home.fulltext.threading.Thread') as thread:
+            self.index.search('fever')
+            thread.assert_not_called()
+            with mock.patch('home.state.get_state', return_value=DatabaseStateBackend()):
+                HistoryIndex(refresh=3600).search('fever')
+            thread.return_value.start.assert_called_once_with()
+
+
+class PhoneKeyTests(TestCase):
+    """ Every spelling of a phone number has one integer key.
+    """
+
+    def test_spellings_share_a_key(self):
+        for spelling in ('7896543210', '07896543210', '+91 78965 43210', '(0)78965-43210', 7896543210):
+            self.assertEqual(phone_key(spelling), 7896543210)
+        self.assertEqual(canonical_phone('+91 78965 43210'), '7896543210')
+        # Only a full national number loses the country code
+        self.assertEqual(phone_key('9112345'), 9112345)
+
+    def test_invalid_numbers(self):
+        for value in ('', None, 'no phone', '000', '1234567890123456', 0, 10 ** 15):
+            with self.assertRaises(InvalidPhone):
+                phone_key(value)
+        self.assertIsNone(canonical_phone('no phone'))
+
+    def test_other_digits_refused(self):
+        for value in ('98765\u00b24321', '78965\u06634321', '\u0967\u0968\u0969'):
+            with self.assertRaises(InvalidPhone):
+                phone_key(value)
+        self.assertIsNone(canonical_phone('98765\u00b24321'))
+
+    def test_history_found_by_any_spelling(self):
+        directory = tempfile.mkdtemp(prefix='clinictest')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        store = HistoryStore(directory)
+        self.addCleanup(store.close)
+        store.add('csp', '07896543210', ['fever,2024-01-02'])
+        store.add('csp', '+91 78965 43210', ['cough,2024-01-09'])
+        self.assertEqual([str(record) for record in store.search('csp', '7896543210')],
+                         ['fever,2024-01-02', 'cough,2024-01-09'])
+        self.assertEqual(store.patients('csp'), ['7896543210'])
+        self.assertIsNone(store.search('csp', 'no phone'))
+
+
+class ArrayBinarySearchTreeTests(BinarySearchTreeTests):
+    """ The struct-of-arrays tree behaves as the AVL history tree.
+    """
+
+    tree_class = ArrayBinarySearchTree
+
+
+class ArrayHistoryTests(TestCase):
+    """ The history of a patient of the array tree reads, pages and
+    amends as HistoryRecords do.
+    """
+
+    def _histories(self, entries):
+        tree = ArrayBinarySearchTree()
+        return tree.insert(7896543210, _records(*entries), 'csp').pat_his, _records(*entries)
+
+    def test_records_kept_in_date_order(self):
+        history, expected = self._histories(['b,2024-02-01', 'a,2024-01-01', 'c,2024-02-01', 'z,2023-12-31'])
+        self.assertEqual(list(history), list(expected))
+        self.assertEqual([str(history[i]) for i in range(-4, 4)], [str(expected[i]) for i in range(-4, 4)])
+        self.assertEqual(str(history[-1]), 'c,2024-02-01')
+        with self.assertRaises(IndexError):
+            history[4]
+
+    def test_amend_replaces_the_latest_record(self):
+        history, expected = self._histories(['a,2024-01-01', 'b,2024-01-05'])
+        for records in (history, expected):
+            records.amend(HistoryRecord.parse('b2,2024-01-04', 'csp'))
+            records.amend(HistoryRecord.parse('b3,2024-01-06', 'csp'))
+        self.assertEqual(list(history), list(expected))
+        self.assertEqual(len(history), 2)
+        self.assertEqual(str(history[-1]), 'b3,2024-01-06')
+
+    def test_pages_match_history_records(self):
+        rnd = random.Random(5)
+        entries = [f'visit {i},2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}' for i in range(40)]
+        history, expected = self._histories(entries)
+        for since in (None, date(2024, 6, 1), date(2025, 1, 1)):
+            for cursor in (None, '0', '7', '39', '40', '55'):
+                for limit in (1, 10, 50):
+                    self.assertEqual(history.page(since, cursor, limit), expected.page(since, cursor, limit))
+        # Following the cursors reads every record once
+        records, cursor = history.page(limit=15)
+        while cursor is not None:
+            page, cursor = history.page(cursor=cursor, limit=15)
+            records += page
+        self.assertEqual(records, list(expected))
+
+
+class PatientRegistryTests(TestCase):
+    """ One Patient row per phone number, written only when the
+    demographics change.
+    """
+
+    def test_register_writes_only_changes(self):
+        registry = PatientRegistry()
+        with self.captureOnCommitCallbacks(execute=True):
+            pk = registry.register('9876543210', 'Asha', '34', 'asha@example.com', 'female')
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.register('9876543210', 'Asha', 34, 'asha@example.com', 'female'), pk)
+        self.assertEqual(registry.register('9876543210', 'Asha', ' 35 ', 'asha@example.com', 'female'), pk)
+        self.assertEqual(Patient.objects.get().age, 35)
+        self.assertEqual(registry.get('9876543210'), Demographics('Asha', 35, 'asha@example.com', 'female'))
+        self.assertNotEqual(registry.register('9123456780', 'Ravi', '', None, 'male'), pk)
+        self.assertEqual(registry.get('9123456780'), Demographics('Ravi', None, '', 'male'))
+        self.assertIsNone(registry.get('9000000001'))
+
+    def test_registered_by_another_worker(self):
+        first, second = PatientRegistry(), PatientRegistry()
+        with self.captureOnCommitCallbacks(execute=True):
+            pk = first.register('9876543210', 'Asha', '34', '', 'female')
+        # The other worker's registry has not seen the patient: same row
+        self.assertEqual(second.register('9876543210', 'Asha K', '34', '', 'female'), pk)
+        self.assertEqual(list(Patient.objects.values_list('name', flat=True)), ['Asha K'])
+        # Until it forgets, the first worker still has the details it wrote
+        self.assertEqual(first.get('9876543210').name, 'Asha')
+        first.forget()
+        self.assertEqual(first.get('9876543210').name, 'Asha K')
+
+    def test_registered_concurrently(self):
+        update = QuerySet.update
+
+        def other_worker_first(rows, **fields):
+            # Another worker inserts the patient between our UPDATE and INSERT
+            if not Patient.objects.exists():
+                Patient.objects.create(phone='9876543210', name='Asha K')
+                return 0
+            return update(rows, **fields)
+
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=other_worker_first):
+            pk = PatientRegistry().register('9876543210', 'Asha', '34', '', 'female')
+        patient = Patient.objects.get()
+        self.assertEqual((patient.pk, patient.name, patient.age), (pk, 'Asha', 34))
+
+    def test_rolled_back_rows_are_not_cached(self):
+        registry = PatientRegistry()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(DatabaseError), transaction.atomic():
+                registry.register('9876543210', 'Asha', '34', '', 'female')
+                raise DatabaseError('disk full')
+        self.assertFalse(Patient.objects.exists())
+        pk = registry.register('9876543210', 'Asha', '34', '', 'female')
+        self.assertEqual(Patient.objects.get().pk, pk)
+
+
+class P2QuantileTests(TestCase):
+    """ The streaming quantile stays close to the exact one.
+    """
+
+    def _exact(self, values, p):
+        ordered = sorted(values)
+        return ordered[max(0, math.ceil(len(ordered) * p) - 1)]
+
+    def test_few_values(self):
+        quantile = P2Quantile(0.9)
+        self.assertIsNone(quantile.value())
+        for value in (300, 100, 200):
+            quantile.add(value)
+        self.assertEqual(quantile.value(), 300)
+        median = P2Quantile(0.5)
+        for value in (5, 1, 4, 2, 3):
+            median.add(value)
+        self.assertEqual(median.value(), 3)
+
+    def test_streams(self):
+        rnd = random.Random(3)
+        streams = {
+            'uniform': [rnd.uniform(0, 1000) for _ in range(20000)],
+            'exponential': [rnd.expovariate(1 / 600) for _ in range(20000)],
+            'sorted': sorted(rnd.uniform(0, 1000) for _ in range(5000)),
+        }
+        for name, values in streams.items():
+            for p in (0.5, 0.9):
+                quantile = P2Quantile(p)
+                for value in values:
+                    quantile.add(value)
+                exact = self._exact(values, p)
+                self.assertLess(abs(quantile.value() - exact) / exact, 0.05, (name, p))
+                self.assertEqual(quantile.count, len(values))
+
+
+class WaitEstimatorTests(TestCase):
+    """ Consultations are timed from the calls of the doctor.
+    """
+
+    def test_consultations_and_estimates(self):
+        estimator = WaitEstimator(default_seconds=600, max_seconds=3600, alpha=0.5)
+        self.assertEqual(estimator.consultation('csp'), (600, 600))
+        estimator.joined('csp', '1', now=0)
+        estimator.joined('csp', '2', now=0)
+        estimator.called('csp', '1', now=100)
+        estimator.called('csp', '2', now=400)
+        self.assertEqual(estimator.consultation('csp'), (300, 300))
+        # A patient who joined after the last call was waited for
+        estimator.joined('csp', '3', now=1000)
+        estimator.called('csp', '3', now=1200)
+        self.assertEqual(estimator.consultation('csp')[0], 250)
+        # A break is not a consultation
+        estimator.called('csp', '4', now=1200 + 7200)
+        self.assertEqual(estimator.summary('csp')['timed'], 2)
+        self.assertEqual(estimator.consultation('gendoc'), (600, 600))
+        expected, p90 = estimator.estimate('csp', 3, now=1200 + 7200 + 50)
+        self.assertEqual(expected, 200 + 2 * 250)
+        self.assertGreaterEqual(p90, expected)
+
+
+class DailyStatsTests(TestCase):
+    """ Daily counters are added up in the database and reported per day.
+    """
+
+    day = date(2024, 5, 6)
+
+    def _count(self, stats, doctor, event, n=1, key=''):
+        stats.count(doctor, event, key, n, day=self.day)
+
+    def test_flush_and_report(self):
+        stats = DailyStats(flush_interval=3600)
+        self._count(stats, 'csp', BOOKED, 4)
+        self._count(stats, 'csp', FULL)
+        self._count(stats, 'csp', ATTENDED, 3)
+        self._count(stats, 'csp', CHECKIN, 3)
+        self._count(stats, 'csp', EMERGENCY)
+        self._count(stats, 'csp', SEEN, 4)
+        self._count(stats, 'csp', SYMPTOM, 2, 'fever')
+        self._count(stats, 'csp', SYMPTOM, 1, 'dry cough')
+        stats.flush()
+        # Another worker counts into the same rows
+        other = DailyStats(flush_interval=3600)
+        self._count(other, 'csp', BOOKED)
+        self._count(other, 'csp', SYMPTOM, 1, 'dry cough')
+        self._count(other, 'gendoc', EMERGENCY)
+        other.flush()
+        self.assertEqual(DailyCount.objects.get(date=self.day, doctor='csp', event=BOOKED).count, 5)
+        report = stats.report(self.day, top=1)
+        self.assertEqual({event: report['csp'][event] for event in (BOOKED, FULL, CHECKIN, EMERGENCY, SEEN)},
+                         {BOOKED: 5, FULL: 1, CHECKIN: 3, EMERGENCY: 1, SEEN: 4})
+        # Emergencies check in without a booking: only booked check-ins count
+        self.assertEqual(report['csp']['no_shows'], 2)
+        self.assertIn(report['csp']['symptoms'], ([('fever', 2)], [('dry cough', 2)]))
+        self.assertEqual(report['gendoc'][EMERGENCY], 1)
+        self.assertEqual(report['gendoc']['no_shows'], 0)
+        self.assertEqual(stats.report(date(2024, 5, 7))['csp'][BOOKED], 0)
+        self.assertEqual(list(stats.range(date(2024, 5, 1), date(2024, 5, 31))), [self.day])
+
+    def test_failed_flush_keeps_the_counts(self):
+        stats = DailyStats(flush_interval=3600)
+        self._count(stats, 'csp', BOOKED, 2)
+        self._count(stats, 'csp', SEEN, 1)
+        add = stats._add
+        calls = []
+
+        def failing(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise DatabaseError('database is locked')
+            add(*args)
+
+        with mock.patch.object(stats, '_add', side_effect=failing):
+            with self.assertRaises(DatabaseError):
+                stats.flush()
+        stats.flush()
+        report = stats.report(self.day)
+        self.assertEqual((report['csp'][BOOKED], report['csp'][SEEN]), (2, 1))
+
+    def test_symptom_phrases(self):
+        self.assertEqual(symptom_phrases('Fever,  Dry   Cough; headache/\nfever'),
+                         ['fever', 'dry cough', 'headache', 'fever'])
+        self.assertEqual(symptom_phrases(None), [])
+
+
+class AppointmentStoreTests(TestCase):
+    """ Bookings are kept in day partitions; old days are archived and
+    can still be read.
+    """
+
+    def setUp(self):
+        self.store = AppointmentStore(SlotReservations(capacity={'csp': 2, 'gendoc': 2}, hold_seconds=600),
+                                      PatientRegistry(), hot_days=7)
+        # Archive in the test, not in a background thread
+        patcher = mock.patch.object(self.store, 'archive_later')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.today = timezone.localdate()
+
+    @staticmethod
+    def _row(name, phone, doctor='csp'):
+        return [name, '34', f'{name.lower()}@example.com', 'female', doctor, phone]
+
+    def test_archive_keeps_old_days_readable(self):
+        old = self.today - timedelta(days=10)
+        self.store.add('csp', self._row('Asha', '9999900000'), old)
+        self.store.add('csp', self._row('Ravi', '7896543210'), old)
+        self.store.add('gendoc', self._row('Mala', '9123456780', 'gendoc'), old)
+        self.store.rollover('csp', old)
+        self.store.add('csp', self._row('Gita', '9000000001'), old)
+        self.store.add('csp', self._row('Hari', '9000000002'))
+        before = list(self.store.between('csp', old, self.today))
+        self.assertEqual([(day, number, len(rows)) for day, number, rows in before],
+                         [(old, 0, 2), (old, 1, 1), (self.today, 0, 1)])
+
+        self.assertEqual(self.store.archive(), 3)
+        self.assertEqual(self.store.archive(), 0)
+        self.assertEqual(list(Appointment.objects.values_list('name', flat=True)), ['Hari'])
+        self.assertEqual(list(self.store.between('csp', old, self.today)), before)
+        self.assertEqual(AppointmentPartition.objects.get(doctor='gendoc', date=old).count, 1)
+        self.assertEqual(self.store.find('csp', 'Hari', '9000000002').name, 'Hari')
+        self.assertIsNone(self.store.find('csp', 'Gita', '9000000001'))
+
+    def test_full_day_and_rollover(self):
+        self.assertTrue(self.store.book('csp', self._row('Asha', '09999900000')))
+        self.assertTrue(self.store.book('csp', self._row('Ravi', '7896543210')))
+        self.assertFalse(self.store.book('csp', self._row('Gita', '9000000001')))
+        self.assertEqual(self.store.count('csp'), 2)
+        self.assertEqual(self.store.find('csp', 'Asha', '9999900000').phone, '9999900000')
+        # Clearing the day opens a new partition and frees the slots
+        self.store.rollover('csp')
+        self.assertEqual(self.store.count('csp'), 0)
+        self.assertIsNone(self.store.find('csp', 'Asha', '9999900000'))
+        self.assertTrue(self.store.book('csp', self._row('Gita', '9000000001')))
+        self.assertEqual([len(rows) for day, number, rows in self.store.between('csp', self.today, self.today)],
+                         [2, 1])
+
+
+class ColdHistoryTests(TestCase):
+    """ Patients not seen for `hot_days' days move to compressed cold
+    segments at a snapshot and are read back, across restarts.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='clinictest')
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        today = date.today()
+        self.old = (today - timedelta(days=800)).isoformat()
+        self.last_year = (today - timedelta(days=500)).isoformat()
+        self.today = today.isoformat()
+
+    def _open(self, tree_class=BinarySearchTree, **options):
+        store = HistoryStore(self.dir, tree_class=tree_class, hot_days=365, **options)
+        self.addCleanup(store.close)
+        return store
+
+    @staticmethod
+    def _history(store, pat_num):
+        return [str(record) for record in store.search('csp', pat_num)]
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.dir) if name.endswith('.seg'))
+
+    def test_round_trip(self):
+        for tree_class in (BinarySearchTree, ArrayBinarySearchTree):
+            with self.subTest(tree_class=tree_class.__name__):
+                shutil.rmtree(self.dir)
+                store = self._open(tree_class)
+                store.add('csp', '7896543210', [f'a,{self.old}', f'b,{self.today}'])
+                store.add('csp', '9999900000', [f'c,{self.old}', f'd,{self.last_year}'])
+                store.snapshot()
+                # The active patient stays in memory, whole
+                self.assertEqual(len(store.tree('csp').search(7896543210).pat_his), 2)
+                self.assertIsNone(store.tree('csp').search(9999900000))
+                self.assertEqual(len(self._segments()), 1)
+                self.assertEqual(self._history(store, '9999900000'), [f'c,{self.old}', f'd,{self.last_year}'])
+                self.assertEqual(sorted(store.patients('csp')), ['7896543210', '9999900000'])
+
+                restarted = self._open(tree_class)
+                self.assertEqual(self._history(restarted, '9999900000'), [f'c,{self.old}', f'd,{self.last_year}'])
+                # Back after a long time: the whole history returns to memory
+                restarted.add('csp', '9999900000', [f'e,{self.today}'])
+                self.assertEqual(len(restarted.tree('csp').search(9999900000).pat_his), 3)
+                restarted.snapshot()
+                self.assertEqual(self._segments(), [])
+                self.assertEqual(self._history(self._open(tree_class), '9999900000'),
+                                 [f'c,{self.old}', f'd,{self.last_year}', f'e,{self.today}'])
+
+    def test_amend_cold_patient(self):
+        store = self._open()
+        store.add('csp', '9999900000', [f'c,{self.old}', f'd,{self.last_year}'])
+        store.snapshot()
+        store.amend('csp', '9999900000', f'd2,{self.last_year}')
+        self.assertEqual(self._history(self._open(), '9999900000'), [f'c,{self.old}', f'd2,{self.last_year}'])
+
+    def test_visits_during_snapshot(self):
+        store = self._open()
+        store.add('csp', '9000000001', [f'a,{self.old}'])
+        store.snapshot()
+        store.add('csp', '9999900000', [f'c,{self.old}'])
+        write = store._writeSnapshot
+
+        def visits(*args):
+            # One cold patient and one moving to the cold tier come back
+            store.amend('csp', '9000000001', f'a2,{self.old}')
+            store.add('csp', '9999900000', [f'd,{self.today}'])
+            return write(*args)
+
+        with mock.patch.object(store, '_writeSnapshot', side_effect=visits):
+            store.snapshot()
+        expected = {'9000000001': [f'a2,{self.old}'], '9999900000': [f'c,{self.old}', f'd,{self.today}']}
+        for pat_num, history in expected.items():
+            self.assertEqual(self._history(store, pat_num), history)
+            self.assertIsNotNone(store.tree('csp').search(int(pat_num)))
+        self.assertEqual(sorted(store.patients('csp')), sorted(expected))
+        restarted = self._open()
+        for pat_num, history in expected.items():
+            self.assertEqual(self._history(restarted, pat_num), history)
+
+    def test_segments_merged(self):
+        store = self._open(cold_segments=2)
+        for i in range(3):
+            store.add('csp', f'900000000{i}', [f'visit {i},{self.old}'])
+            store.snapshot()
+        # The third snapshot found two segments and merged them into one
+        self.assertEqual(len(self._segments()), 1)
+        restarted = self._open(cold_segments=2)
+        for i in range(3):
+            self.assertEqual(self._history(restarted, f'900000000{i}'), [f'visit {i},{self.old}'])
+
+
+def _sse(chunk):
+    event, data = chunk.decode().splitlines()[:2]
+    return event[len('event: '):], json.loads(data[len('data: '):])
+
+
+class QueueEventsTests(TestCase):
+    """ The live queue stream: a snapshot, then the changes, and a fresh
+    snapshot after the screen fell behind.
+    """
+
+    @override_settings(CLINIC_REQUIRE_ROLES=False, CLINIC_QUEUE_HEARTBEAT=60)
+    async def test_snapshot_delta_and_resync(self):
+        state = DatabaseStateBackend()
+        enqueue, remove = sync_to_async(state.enqueue), sync_to_async(state.remove)
+        with mock.patch('home.views.state', state), mock.patch.object(feed, 'maxsize', 2):
+            await enqueue('csp', _patient('1'))
+            response = await self.async_client.get('/queue/events/csp')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            stream = response.streaming_content
+
+            async def event():
+                return _sse(await asyncio.wait_for(stream.__anext__(), 5))
+
+            self.assertEqual(await event(), ('snapshot', [{'name': 'patient 1', 'doctor': 'csp', 'phone': '1'}]))
+            await enqueue('csp', _patient('2'))
+            self.assertEqual(await event(), ('enqueue', {'name': 'patient 2', 'doctor': 'csp',
+                                                         'phone': '2', 'position': 2}))
+            # Three changes overflow the two queued events of the screen
+            for pnum in ('3', '4', '5'):
+                await enqueue('csp', _patient(pnum))
+            await remove('csp', '3')
+            self.assertEqual(await event(), ('snapshot', [{'name': f'patient {pnum}', 'doctor': 'csp', 'phone': pnum}
+                                                          for pnum in ('1', '2', '4', '5')]))
+            # The events queued before the snapshot are not replayed
+            await remove('csp', '1')
+            self.assertEqual(await event(), ('remove', {'name': 'patient 1', 'doctor': 'csp',
+                                                        'phone': '1', 'position': None}))
+
+
+class HistoryCacheTests(TestCase):
+    """ History pages cached in front of the state backend.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.state = mock.Mock()
+        self.state.history_page.side_effect = lambda doctor, pat_num, since, cursor, limit: (
+            None if pat_num == 'unknown' else ([f'{doctor}:{pat_num}:{cursor}'], None))
+        self.histories = HistoryCache(self.state, size=2, ttl=60)
+
+    def _reads(self):
+        return self.state.history_page.call_count
+
+    def test_backend_resolved_on_first_use(self):
+        with mock.patch('home.state.get_state') as get_state:
+            histories = HistoryCache()
+            get_state.assert_not_called()
+            self.assertIs(histories.state, get_state.return_value)
+            self.assertIsNone(histories.use(self.state))
+            self.assertIs(histories.state, self.state)
+            self.assertIs(histories.use(None), self.state)
+            self.assertIs(histories.state, get_state.return_value)
+
+    def test_least_recently_used_page_dropped(self):
+        self.assertEqual(self.histories.page('csp', '1'), (['csp:1:None'], None))
+        self.histories.page('csp', '2')
+        self.histories.page('csp', '1')
+        self.histories.page('csp', '3')
+        self.assertEqual((len(self.histories), self._reads()), (2, 3))
+        self.histories.page('csp', '1')
+        self.assertEqual(self._reads(), 3)
+        self.histories.page('csp', '2')
+        self.assertEqual(self._reads(), 4)
+        # A patient without history is not cached
+        self.assertIsNone(self.histories.page('csp', 'unknown'))
+        self.assertIsNone(self.histories.page('csp', 'unknown'))
+        self.assertEqual(self._reads(), 6)
+
+    def test_pages_expire(self):
+        with mock.patch('home.historycache.time') as clock:
+            clock.monotonic.return_value = 100
+            self.histories.page('csp', '1')
+            clock.monotonic.return_value = 160
+            self.histories.page('csp', '1')
+            self.assertEqual(self._reads(), 1)
+            clock.monotonic.return_value = 161
+            self.histories.page('csp', '1')
+            self.assertEqual(self._reads(), 2)
+
+    def test_new_version_or_change_drops_pages(self):
+        self.histories.page('csp', '1', version=1)
+        self.histories.page('csp', '1', version=1)
+        self.assertEqual(self._reads(), 1)
+        self.histories.page('csp', '1', version=2)
+        self.assertEqual(self._reads(), 2)
+        # Without a version, the version of the patient is read
+        self.histories.page('csp', '1', cursor='c')
+        self.histories.page('csp', '1', cursor='c')
+        self.assertEqual(self._reads(), 3)
+        self.histories.historyChanged(None, 'gendoc', '1')
+        self.histories.page('csp', '1', cursor='c')
+        self.assertEqual(self._reads(), 3)
+        self.histories.historyChanged(None, 'csp', '1')
+        self.assertEqual(len(self.histories), 0)
+        self.histories.page('csp', '1', cursor='c')
+        self.assertEqual(self._reads(), 4)
+
+    def test_dequeue_reads_ahead(self):
+        self.histories.queueChanged(None, 'csp', 'enqueue', _patient('7'))
+        self.assertEqual(self._reads(), 0)
+        self.histories.queueChanged(None, 'csp', 'dequeue', _patient('7'))
+        self.state.history_page.assert_called_once_with('csp', '7', None, None, settings.CLINIC_HISTORY_PAGE_SIZE)
+        self.assertEqual(self.histories.page('csp', '7'), (['csp:7:None'], None))
+        self.histories.queueChanged(None, 'csp', 'dequeue', _patient('7'))
+        self.assertEqual(self._reads(), 1)
@@ -0,0 +1,571 @@
+import logging
+from abc import ABC, abstractmethod
+
+from .log import log_event
+from .metrics import TREE_COMPARISONS, TREE_SEARCH_DEPTH
+
+
+logger = logging.getLogger(__name__)
+
+
+class AbstractTree(ABC):
+    """ Abstract Base Class for tree structure.
+    Only five of the methods are abstract!
+    Several concrete methods can be defined without
+    knowing anything about the data structures for trees!!!
+    Since the class is abstract, no objects can be created.
+    """
+
+    @abstractmethod
+    def root(self):
+        """ Returns the root (position) of this tree
+        """
+
+    @abstractmethod
+    def parent(self, pos):
+        """ Returns the parent of node at given position 'pos'.
+        It is assumed that a valid position in this tree is given.
+        """
+
+    @abstractmethod
+    def numChildren(self, pos):
+        """ Returns the number of children of node at given position 'pos'.
+        It is assumed that a valid position in this tree is given.
+        """
+
+    @abstractmethod
+    def children(self, pos):
+        """ Returns an iterator for the list of children of the node
+        at given position 'pos'.
+        It is assumed that a valid position in this tree is given.
+        """
+
+    @abstractmethod
+    def __len__(self):
+        """ Returns the total number of objects (nodes) in this tree.
+        """
+
+    def isRoot(self, pos):
+        """ Returns `True' is the node at the given position `pos'
+        is the root of this tree.
+        It is assumed that a valid position in this tree is given.
+        """
+        return (pos == self.root())
+
+    def isLeaf(self, pos):
+        """ Returns `True' is the node at the given position `pos'
+        is a leaf in this tree.
+        It is assumed that a valid position in this tree is given.
+        """
+        return (self.numChildren(pos) == 0)
+
+    def isEmpty(self):
+        """ Returns `True' if this tree is empty.
+        """
+        return (len(self) == 0)
+
+    def depthN(self, pos):
+        """ Returns the depth of the node at the given position.
+        Runs in linear time --- linear wrt the height --- O(h)
+        """
+        if self.isRoot(pos):
+            return 0
+        return 1 + self.depth(self.parent(pos))
+
+    def _heightN(self, pos):
+        """ Returns the height of the node at the given position.
+        This is same as the height of the subtree rooted at `pos'.
+        """
+        if self.isLeaf(pos):
+            return 0
+        return 1 + max(self._heightN(child) for child in self.children(pos))
+
+    def height(self, pos=None):
+        """ Returns the height of the subtree rooted at `pos'.
+        Returns the height of this tree, if `pos' is `None'.
+        """
+        if pos is None:
+            if self.isEmpty():
+                return -1  # By convention, height of empty tree is -1
+            pos = self.root()
+        return self._heightN(pos)
+
+    def __iter__(self):
+        """ Returns an iterator for this tree.
+        This uses the iterator for positions in the tree.
+        """
+        for pos in self.positions():
+            yield pos.getItem()
+
+    def positions(self):
+        """ Returns an iterator for positions in this tree.
+        Uses the preorder traversal.
+        """
+        return self.preorder()
+
+    def preorder(self):
+        """ Returns the preorder iterator for positions in this tree.
+        """
+        if (not self.isEmpty()):
+            for pos in self._preorderSubTree(self.root()):
+                yield pos
+
+    def _preorderSubTree(self, pos):
+        """ Non-public recursive function used by the preorder iterator.
+        """
+        yield pos
+        for child in self.children(pos):
+            for p in self._preorderSubTree(child):
+                yield p
+
+    def postorder(self):
+        """ Returns the postorder iterator for positions in this tree.
+        """
+        if (not self.isEmpty()):
+            for pos in self._postorderSubTree(self.root()):
+                yield pos
+
+    def _postorderSubTree(self, pos):
+        """ Non-public recursive function used by the postorder iterator.
+        """
+        for child in self.children(pos):
+            for p in self._preorderSubTree(child):
+                yield p
+        yield pos
+
+    # def breadthFirst(self):
+    #     """ Returns the breadth-first iterator for positions in this tree.
+    #     Uses a queue to keep track of all the paths in the tree.
+    #     Space complexity is high compared to the depth-first iterators.
+    #     """
+    #     if ( not self.isEmpty() ):
+    #         fringe = LinkedQueue()
+    #         fringe.enqueue(self.root())
+    #     while ( not fringe.isEmpty() ):
+    #         pos = fringe.dequeue()
+    #         yield pos
+    #         for child in self.children(pos):
+    #             fringe.enqueue(child)
+# End of the class AbstractTree
+
+
+class AbsBinaryTree(AbstractTree):
+    """ An abstract base class for binary trees.
+    This extends the abstract base class designed for general trees.
+    One inherited abstract method (children) is overridden with a
+    concrete implementation.
+    Adds two abstract methods and a concrete method.
+    """
+
+    @abstractmethod
+    def left(self, pos):
+        """ Returns the left child of `pos' (if exists).
+        Returns `None' is there is no left child.
+        """
+
+    @abstractmethod
+    def right(self, pos):
+        """ Returns the right child of `pos' (if exists).
+        Returns `None' is there is no right child.
+        """
+
+    def children(self, pos):
+        """ Returns an iterator for the list of children of the node
+        at given position 'pos'.
+        It is assumed that a valid position in this tree is given.
+        """
+        if (self.left(pos) is not None):
+            yield self.left(pos)
+        if (self.right(pos) is not None):
+            yield self.right(pos)
+
+    def sibling(self, pos):
+        """ Returns the sibling of node at position `pos'.
+        Returns `None' if `pos' does not have a sibling.
+        It is assumed that a valid position in this tree is given.
+        """
+        parent = self.parent(pos)
+        if parent is None:
+            return None  # Self must be the root node
+        if pos == self.left(parent):
+            return self.right(parent)
+        return self.left(parent)
+# End of the class AbsBinaryTree
+
+
+class LinkedBinaryTree(AbsBinaryTree):
+    """ Concrete implementation of binary tree.
+    Overrides all the abstract methods defined in the base classes.
+    """
+
+    class _historyNode:
+        """ A nested class to define a binary tree node
+        """
+
+        # Let's explicity declare the fields
+        # __slots__ = ['_item', '_parent', '_left', '_right']
+
+        def __init__(self, pat_num, pat_his, pat_docass, parent=None, left=None, right=None):
+            """ Constructs a new node with the given item
+            """
+            self.pat_num = pat_num
+            self.pat_his = pat_his
+            self.pat_docass = pat_docass
+            self._parent = parent
+            self._left = left
+            self._right = right
+
+        # def getItem(self):
+        #     """ Accessor method to get the item stored in this node
+        #     """
+        #     return self._item
+
+        # def setItem(self, item):
+        #     """ Accessor method to modify the item stored in this node
+        #     """
+        #     self._item = item
+    # End of nested class _BTNode
+
+    # Fields of a tree object
+    # __slots__ = ['_root', '_size']
+
+    def __init__(self, pat_num=None, pat_his=None, pat_docass=None, TLeft=None, TRight=None):
+        """ Construct a new empty binary tree, if no arguments are given.
+        If only an item is given, a single node tree (containing that item)
+        is created.
+        """
+        # First, construct an empty tree
+        self._root = None  # This implementation does not use a dummy header
+        self._size = 0
+        # Add root and subtrees, if they are not None (and empty)
+        if (pat_num is not None and pat_his is not None and pat_docass is not None):
+            root = self.addRoot(pat_num, pat_his, pat_docass)
+            # Add left subtree, if given
+            if (TLeft is not None):
+                # Ignore if TLeft is an empty tree
+                if (TLeft._root is not None):
+                    TLeft._root._parent = root
+                    root._left = TLeft._root
+                    self._size += TLeft._size
+                    # Clear TLeft and make it an empty tree
+                    TLeft._root = None
+                    TLeft._size = 0
+            # Add right subtree, if given
+            if (TRight is not None):
+                # Ignore if TRight is an empty tree
+                if (TRight._root is not None):
+                    TRight._root._parent = root
+                    root._right = TRight._root
+                    self._size += TRight._size
+                    # Clear TRight and make it an empty tree
+                    TRight._root = None
+                    TRight._size = 0
+    # End of the construtor for LinkedBinaryTree
+
+    def root(self):
+        """ Returns the root (position) of this tree.
+        """
+        return self._root
+
+    def __len__(self):
+        """ Returns the total number of objects (nodes) in this tree.
+        """
+        return self._size
+
+    # def __str__(self):
+        """ Returns a string representation of this tree.
+        Uses the preorder traversal strategy.
+        """
+        # def __preorder(pos):
+        #     res = f"[{pos._item} "
+        #     if pos._left is not None:
+        #         res += __preorder(pos._left)
+        #     if pos._right is not None:
+        #         res += __preorder(pos._right)
+        #     res += ']'
+        #     return res
+        # if self._root is None:
+        #     return '[]'
+        # return __preorder(self._root)
+
+    def parent(self, pos):
+        """ Returns the parent of node at given position 'pos'.
+        It is assumed that a valid position in this tree is given.
+        """
+        if pos is None:
+            return None
+        return pos._parent
+
+    def numChildren(self, pos):
+        """ Returns the number of children of node at given position 'pos'.
+        It is assumed that a valid position in this tree is given.
+        """
+        count = 0
+        if pos is None:
+            return count
+        if pos._left is not None:
+            count += 1
+        if pos._right is not None:
+            count += 1
+        return count
+
+    def left(self, pos):
+        """ Returns the left child of `pos' (if exists).
+        Returns `None' is there is no left child.
+        """
+        if pos is None:
+            return None
+        return pos._left
+
+    def right(self, pos):
+        """ Returns the right child of `pos' (if exists).
+        Returns `None' is there is no right child.
+        """
+        if pos is None:
+            return None
+        return pos._right
+
+    def addRoot(self, pat_num, pat_his, pat_docass):
+
+        if self._root is not None:
+            raise ValueError("Root already exists!")
+        self._root = self._historyNode(pat_num, pat_his, pat_docass)
+        self._size = 1
+        return self._root
+
+    def addLeft(self, pat_num, pat_his, pat_docass, pos):
+        if pos is None:
+            raise TypeError("Not a valid position.")
+        if pos._left is not None:
+            raise ValueError("Left child already exists!")
+        pos._left = self._historyNode(pat_num, pat_his, pat_docass, pos)
+        self._size += 1
+        return pos._left
+
+    def addRight(self, pat_num, pat_his, pat_docass, pos):
+        if pos is None:
+            raise TypeError("Not a valid position.")
+        if pos._right is not None:
+            raise ValueError("Right child already exists!")
+        pos._right = self._historyNode(pat_num, pat_his, pat_docass, pos)
+        self._size += 1
+        return pos._right
+
+    # def replace(self, item, pos):
+    #     if pos is None:
+    #         raise TypeError("Not a valid position.")
+    #     old = pos._item
+    #     pos.setItem(item)
+    #     return old
+# End of class LinkedBinaryTree
+
+
+
+
+class BinarySearchTree(LinkedBinaryTree):
+    """ AVL tree of patient histories keyed on the patient's phone number.
+    The heights of the two subtrees of every node differ by at most one,
+    so the tree stays balanced even when phone numbers arrive in sorted
+    order. Search, insert and delete walk the tree iteratively and run in
+    O(log n) time.
+    """
+
+    class _historyNode(LinkedBinaryTree._historyNode):
+        """ A history node that also records the height of its subtree.
+        """
+
+        def __init__(self, pat_num, pat_his, pat_docass, parent=None, left=None, right=None):
+            super().__init__(pat_num, pat_his, pat_docass, parent, left, right)
+            self._height = 1
+
+    def __init__(self, pat_num=None, pat_his=None, pat_docass=None, Tleft=None, Tright=None):
+        super().__init__(pat_num, pat_his, pat_docass, Tleft, Tright)
+
+    @staticmethod
+    def _nodeHeight(pos):
+        """ Height of the subtree at `pos' counted in nodes (0 for None).
+        """
+        return pos._height if pos is not None else 0
+
+    def _updateHeight(self, pos):
+        pos._height = 1 + max(self._nodeHeight(pos._left),
+                              self._nodeHeight(pos._right))
+
+    def _rotate(self, pos):
+        """ Rotates `pos' above its parent, keeping the search order.
+        """
+        parent = pos._parent
+        grand = parent._parent
+        if grand is None:
+            self._root = pos
+        elif grand._left is parent:
+            grand._left = pos
+        else:
+            grand._right = pos
+        pos._parent = grand
+        if pos is parent._left:
+            parent._left = pos._right
+            if pos._right is not None:
+                pos._right._parent = parent
+            pos._right = parent
+        else:
+            parent._right = pos._left
+            if pos._left is not None:
+                pos._left._parent = parent
+            pos._left = parent
+        parent._parent = pos
+        self._updateHeight(parent)
+        self._updateHeight(pos)
+
+    def _rebalance(self, pos):
+        """ Restores the AVL property on the path from `pos' to the root.
+        """
+        while pos is not None:
+            self._updateHeight(pos)
+            balance = self._nodeHeight(pos._left) - self._nodeHeight(pos._right)
+            if balance > 1:
+                child = pos._left
+                if self._nodeHeight(child._left) < self._nodeHeight(child._right):
+                    child = child._right
+                    self._rotate(child)
+                self._rotate(child)
+                pos = child
+            elif balance < -1:
+                child = pos._right
+                if self._nodeHeight(child._right) < self._nodeHeight(child._left):
+                    child = child._left
+                    self._rotate(child)
+                self._rotate(child)
+                pos = child
+            pos = pos._parent
+
+    def height(self, pos=None):
+        """ Returns the height of the subtree rooted at `pos' in O(1) time.
+        Returns the height of this tree, if `pos' is `None'.
+        """
+        if pos is None:
+            if self.isEmpty():
+                return -1
+            pos = self._root
+        return pos._height - 1
+
+    def copy(self):
+        """ Returns a copy of this tree, of the same shape, holding copies
+        of the histories, so it does not change with this tree.
+        """
+        other = type(self)()
+        other._root = self._copySubTree(self._root, None)
+        other._size = self._size
+        return other
+
+    def _copySubTree(self, pos, parent):
+        if pos is None:
+            return None
+        node = self._historyNode(pos.pat_num, pos.pat_his.copy(), pos.pat_docass, parent)
+        node._height = pos._height
+        node._left = self._copySubTree(pos._left, node)
+        node._right = self._copySubTree(pos._right, node)
+        return node
+
+    def insert(self, pat_num, pathis, pat_doc, pos=None):
+        """ Adds the history `pathis' of patient `pat_num'.
+        The history is appended to the existing node if the patient is
+        already in the tree. Returns the node of the patient.
+        """
+        if self._root is None:
+            return self.addRoot(pat_num, pathis, pat_doc)
+        if pos is None:
+            pos = self._root
+        while True:
+            if pat_num == pos.pat_num:
+                pos.pat_his.extend(pathis)
+                return pos
+            elif pat_num < pos.pat_num:
+                if pos._left is None:
+                    node = self.addLeft(pat_num, pathis, pat_doc, pos)
+                    break
+                pos = pos._left
+            else:
+                if pos._right is None:
+                    node = self.addRight(pat_num, pathis, pat_doc, pos)
+                    break
+                pos = pos._right
+        self._rebalance(pos)
+        return node
+
+    def search(self, patnum, pos=None):
+        """ Returns the node of patient `patnum', or `None' if not found.
+        The depth reached and the comparisons made are recorded in the
+        metrics (see home.metrics); with DEBUG logging on, the path taken
+        is logged as a "tree.search" event.
+        """
+        if pos is None:
+            pos = self._root
+        path = [] if logger.isEnabledFor(logging.DEBUG) else None
+        depth = comparisons = 0
+        while pos is not None:
+            if path is not None:
+                path.append(pos.pat_num)
+            depth += 1
+            comparisons += 1
+            if patnum == pos.pat_num:
+                break
+            comparisons += 1
+            if patnum < pos.pat_num:
+                pos = pos._left
+            else:
+                pos = pos._right
+        TREE_SEARCH_DEPTH.observe(depth)
+        TREE_COMPARISONS.inc(comparisons)
+        if path is not None:
+            log_event(logger, 'tree.search', logging.DEBUG, key=patnum, found=pos is not None,
+                      depth=depth, comparisons=comparisons, path=path)
+        return pos
+
+    def findmax(self, pos=None):
+        """ Returns the node with the largest key in the subtree at `pos'.
+        """
+        if pos is None:
+            pos = self._root
+        while pos is not None and pos._right is not None:
+            pos = pos._right
+        return pos
+
+    def findmin(self, pos=None):
+        """ Returns the node with the smallest key in the subtree at `pos'.
+        """
+        if pos is None:
+            pos = self._root
+        while pos is not None and pos._left is not None:
+            pos = pos._left
+        return pos
+
+    def delete(self, patnum):
+        """ Removes patient `patnum' from the tree.
+        Returns a detached node holding the removed patient,
+        or `None' if the patient is not in the tree.
+        """
+        pos = self.search(patnum)
+        if pos is None:
+            return None
+        if pos._left is not None and pos._right is not None:
+            # Move the in-order successor up and unlink its old node instead
+            succ = self.findmin(pos._right)
+            pos.pat_num, succ.pat_num = succ.pat_num, pos.pat_num
+            pos.pat_his, succ.pat_his = succ.pat_his, pos.pat_his
+            pos.pat_docass, succ.pat_docass = succ.pat_docass, pos.pat_docass
+            pos = succ
+        child = pos._left if pos._left is not None else pos._right
+        parent = pos._parent
+        if child is not None:
+            child._parent = parent
+        if parent is None:
+            self._root = child
+        elif parent._left is pos:
+            parent._left = child
+        else:
+            parent._right = child
+        pos._parent = pos._left = pos._right = None
+        self._size -= 1
+        self._rebalance(parent)
+        return pos
@@ -1,5 +1,6 @@
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 from home import views
 
 urlpatterns = [
@@ -25,9 +26,20 @@ urlpatterns = [
     path('doctor/doctorgendochome/patienthis',views.patientgendochistory),
     path('doctor/doctorgendochome/showgendocqueue',views.showgendocqueue),
     path('doctor/doctorgendochome/prescriptiongendoc',views.presriptiongendoc),
+    path('doctor/historysearch',views.historysearch,name='historysearch'),
+    path('doctor/patient',views.patientrecord,name='patientrecord'),
     path('receptionist/recephome/emergency',views.emergency),
-    path('receptionist/recephome/clearappointments',views.clearappointments)
+    path('receptionist/recephome/lookup',views.patientlookup,name='patientlookup'),
+    path('receptionist/recephome/clearappointments',views.clearappointments),
+    path('receptionist/recephome/report',views.dailyreport,name='dailyreport'),
+    path('receptionist/recephome/report.csv',views.dailyreportcsv,name='dailyreportcsv'),
+    path('queue/events/<str:doctor>',views.queueevents,name='queueevents'),
+    path('queue/wait/<str:doctor>',views.queuewait,name='queuewait'),
+    path('metrics',views.metrics,name='metrics'),
     # path('receptionist/recephome/makepayment',views.makepayment,name='payment')
     # path('doctor/doctorhome/patienthis',views.patienthistory,name='patienthis')
 
-]
\ No newline at end of file
+]
+
+if settings.CLINIC_SERVE_STATIC:
+    urlpatterns.append(re_path(r'^%s(?P<path>.+)$' % settings.STATIC_URL.lstrip('/'), views.staticasset))
@@ -1,442 +1,49 @@
 
+import asyncio
+import csv
+import logging
+import os
+import re
+import time
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, HttpResponse, redirect
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.functional import SimpleLazyObject
+from django.views.static import serve
 from django.contrib.auth.models import User
 from django.contrib.auth import logout, authenticate, login
-import csv
-from abc import ABC, abstractmethod
-from datetime import datetime
+from django.conf import settings
+from datetime import date, datetime, timedelta
+
+from .analytics import ATTENDED, BOOKED, CHECKIN, EMERGENCY, FULL, SEEN, daily
+from .appointments import AppointmentStore
+from .events import feed, sse
+from .fulltext import index as history_index
+from .historycache import histories
+from .log import log_event
+from .lookup import lookup
+from .metrics import registry
+from .models import DOCTORS
+from .patientqueue import PatientQueue, queuepatientobject
+from .phones import canonical_phone
+from .registry import registry as patients
+from .roles import LoginThrottle, remember, resolve, role_required
+from .state import get_state
+from .templating import fragment_cached, history_version, queue_version
+from .waittime import estimator
 
 
 # from LinkedQueue import LinkedQueue
 
 
-class AbstractTree(ABC):
-    """ Abstract Base Class for tree structure.
-    Only five of the methods are abstract!
-    Several concrete methods can be defined without
-    knowing anything about the data structures for trees!!!
-    Since the class is abstract, no objects can be created.
-    """
+logger = logging.getLogger(__name__)
 
-    @abstractmethod
-    def root(self):
-        """ Returns the root (position) of this tree
-        """
-
-    @abstractmethod
-    def parent(self, pos):
-        """ Returns the parent of node at given position 'pos'.
-        It is assumed that a valid position in this tree is given.
-        """
-
-    @abstractmethod
-    def numChildren(self, pos):
-        """ Returns the number of children of node at given position 'pos'.
-        It is assumed that a valid position in this tree is given.
-        """
-
-    @abstractmethod
-    def children(self, pos):
-        """ Returns an iterator for the list of children of the node
-        at given position 'pos'.
-        It is assumed that a valid position in this tree is given.
-        """
-
-    @abstractmethod
-    def __len__(self):
-        """ Returns the total number of objects (nodes) in this tree.
-        """
-
-    def isRoot(self, pos):
-        """ Returns `True' is the node at the given position `pos'
-        is the root of this tree.
-        It is assumed that a valid position in this tree is given.
-        """
-        return (pos == self.root())
-
-    def isLeaf(self, pos):
-        """ Returns `True' is the node at the given position `pos'
-        is a leaf in this tree.
-        It is assumed that a valid position in this tree is given.
-        """
-        return (self.numChildren(pos) == 0)
-
-    def isEmpty(self):
-        """ Returns `True' if this tree is empty.
-        """
-        return (len(self) == 0)
-
-    def depthN(self, pos):
-        """ Returns the depth of the node at the given position.
-        Runs in linear time --- linear wrt the height --- O(h)
-        """
-        if self.isRoot(pos):
-            return 0
-        return 1 + self.depth(self.parent(pos))
-
-    def _heightN(self, pos):
-        """ Returns the height of the node at the given position.
-        This is same as the height of the subtree rooted at `pos'.
-        """
-        if self.isLeaf(pos):
-            return 0
-        return 1 + max(self._heightN(child) for child in self.children(pos))
-
-    def height(self, pos=None):
-        """ Returns the height of the subtree rooted at `pos'.
-        Returns the height of this tree, if `pos' is `None'.
-        """
-        if pos is None:
-            if self.isEmpty():
-                return -1  # By convention, height of empty tree is -1
-            pos = self.root()
-        return self._heightN(pos)
-
-    def __iter__(self):
-        """ Returns an iterator for this tree.
-        This uses the iterator for positions in the tree.
-        """
-        for pos in self.positions():
-            yield pos.getItem()
-
-    def positions(self):
-        """ Returns an iterator for positions in this tree.
-        Uses the preorder traversal.
-        """
-        return self.preorder()
-
-    def preorder(self):
-        """ Returns the preorder iterator for positions in this tree.
-        """
-        if (not self.isEmpty()):
-            for pos in self._preorderSubTree(self.root()):
-                yield pos
-
-    def _preorderSubTree(self, pos):
-        """ Non-public recursive function used by the preorder iterator.
-        """
-        yield pos
-        for child in self.children(pos):
-            for p in self._preorderSubTree(child):
-                yield p
-
-    def postorder(self):
-        """ Returns the postorder iterator for positions in this tree.
-        """
-        if (not self.isEmpty()):
-            for pos in self._postorderSubTree(self.root()):
-                yield pos
-
-    def _postorderSubTree(self, pos):
-        """ Non-public recursive function used by the postorder iterator.
-        """
-        for child in self.children(pos):
-            for p in self._preorderSubTree(child):
-                yield p
-        yield pos
-
-    # def breadthFirst(self):
-    #     """ Returns the breadth-first iterator for positions in this tree.
-    #     Uses a queue to keep track of all the paths in the tree.
-    #     Space complexity is high compared to the depth-first iterators.
-    #     """
-    #     if ( not self.isEmpty() ):
-    #         fringe = LinkedQueue()
-    #         fringe.enqueue(self.root())
-    #     while ( not fringe.isEmpty() ):
-    #         pos = fringe.dequeue()
-    #         yield pos
-    #         for child in self.children(pos):
-    #             fringe.enqueue(child)
-# End of the class AbstractTree
-
-
-class AbsBinaryTree(AbstractTree):
-    """ An abstract base class for binary trees.
-    This extends the abstract base class designed for general trees.
-    One inherited abstract method (children) is overridden with a
-    concrete implementation.
-    Adds two abstract methods and a concrete method.
-    """
-
-    @abstractmethod
-    def left(self, pos):
-        """ Returns the left child of `pos' (if exists).
-        Returns `None' is there is no left child.
-        """
-
-    @abstractmethod
-    def right(self, pos):
-        """ Returns the right child of `pos' (if exists).
-        Returns `None' is there is no right child.
-        """
-
-    def children(self, pos):
-        """ Returns an iterator for the list of children of the node
-        at given position 'pos'.
-        It is assumed that a valid position in this tree is given.
-        """
-        if (self.left(pos) is not None):
-            yield self.left(pos)
-        if (self.right(pos) is not None):
-            yield self.right(pos)
-
-    def sibling(self, pos):
-        """ Returns the sibling of node at position `pos'.
-        Returns `None' if `pos' does not have a sibling.
-        It is assumed that a valid position in this tree is given.
-        """
-        parent = self.parent(pos)
-        if parent is None:
-            return None  # Self must be the root node
-        if pos == self.left(parent):
-            return self.right(parent)
-        return self.left(parent)
-# End of the class AbsBinaryTree
-
-
-class LinkedBinaryTree(AbsBinaryTree):
-    """ Concrete implementation of binary tree.
-    Overrides all the abstract methods defined in the base classes.
-    """
-
-    class _historyNode:
-        """ A nested class to define a binary tree node
-        """
-
-        # Let's explicity declare the fields
-        # __slots__ = ['_item', '_parent', '_left', '_right']
-
-        def __init__(self, pat_num, pat_his, pat_docass, parent=None, left=None, right=None):
-            """ Constructs a new node with the given item
-            """
-            self.pat_num = pat_num
-            self.pat_his = pat_his
-            self.pat_docass = pat_docass
-            self._parent = parent
-            self._left = left
-            self._right = right
-
-        # def getItem(self):
-        #     """ Accessor method to get the item stored in this node
-        #     """
-        #     return self._item
-
-        # def setItem(self, item):
-        #     """ Accessor method to modify the item stored in this node
-        #     """
-        #     self._item = item
-    # End of nested class _BTNode
-
-    # Fields of a tree object
-    # __slots__ = ['_root', '_size']
-
-    def __init__(self, pat_num=None, pat_his=None, pat_docass=None, TLeft=None, TRight=None):
-        """ Construct a new empty binary tree, if no arguments are given.
-        If only an item is given, a single node tree (containing that item)
-        is created.
-        """
-        # First, construct an empty tree
-        self._root = None  # This implementation does not use a dummy header
-        self._size = 0
-        # Add root and subtrees, if they are not None (and empty)
-        if (pat_num is not None and pat_his is not None and pat_docass is not None):
-            root = self.addRoot(pat_num, pat_his, pat_docass)
-            # Add left subtree, if given
-            if (TLeft is not None):
-                # Ignore if TLeft is an empty tree
-                if (TLeft._root is not None):
-                    TLeft._root._parent = root
-                    root._left = TLeft._root
-                    self._size += TLeft._size
-                    # Clear TLeft and make it an empty tree
-                    TLeft._root = None
-                    TLeft._size = 0
-            # Add right subtree, if given
-            if (TRight is not None):
-                # Ignore if TRight is an empty tree
-                if (TRight._root is not None):
-                    TRight._root._parent = root
-                    root._right = TRight._root
-                    self._size += TRight._size
-                    # Clear TRight and make it an empty tree
-                    TRight._root = None
-                    TRight._size = 0
-    # End of the construtor for LinkedBinaryTree
-
-    def root(self):
-        """ Returns the root (position) of this tree.
-        """
-        return self._root
-
-    def __len__(self):
-        """ Returns the total number of objects (nodes) in this tree.
-        """
-        return self._size
-
-    # def __str__(self):
-        """ Returns a string representation of this tree.
-        Uses the preorder traversal strategy.
-        """
-        # def __preorder(pos):
-        #     res = f"[{pos._item} "
-        #     if pos._left is not None:
-        #         res += __preorder(pos._left)
-        #     if pos._right is not None:
-        #         res += __preorder(pos._right)
-        #     res += ']'
-        #     return res
-        # if self._root is None:
-        #     return '[]'
-        # return __preorder(self._root)
-
-    def parent(self, pos):
-        """ Returns the parent of node at given position 'pos'.
-        It is assumed that a valid position in this tree is given.
-        """
-        if pos is None:
-            return None
-        return pos._parent
-
-    def numChildren(self, pos):
-        """ Returns the number of children of node at given position 'pos'.
-        It is assumed that a valid position in this tree is given.
-        """
-        count = 0
-        if pos is None:
-            return count
-        if pos._left is not None:
-            count += 1
-        if pos._right is not None:
-            count += 1
-        return count
-
-    def left(self, pos):
-        """ Returns the left child of `pos' (if exists).
-        Returns `None' is there is no left child.
-        """
-        if pos is None:
-            return None
-        return pos._left
-
-    def right(self, pos):
-        """ Returns the right child of `pos' (if exists).
-        Returns `None' is there is no right child.
-        """
-        if pos is None:
-            return None
-        return pos._right
-
-    def addRoot(self, pat_num, pat_his, pat_docass):
-
-        if self._root is not None:
-            raise ValueError("Root already exists!")
-        self._root = self._historyNode(pat_num, pat_his, pat_docass)
-        self._size = 1
-        return self._root
-
-    def addLeft(self, pat_num, pat_his, pat_docass, pos):
-        if pos is None:
-            raise TypeError("Not a valid position.")
-        if pos._left is not None:
-            raise ValueError("Left child already exists!")
-        pos._left = self._historyNode(pat_num, pat_his, pat_docass, pos)
-        self._size += 1
-        return pos._left
-
-    def addRight(self, pat_num, pat_his, pat_docass, pos):
-        if pos is None:
-            raise TypeError("Not a valid position.")
-        if pos._right is not None:
-            raise ValueError("Right child already exists!")
-        pos._right = self._historyNode(pat_num, pat_his, pat_docass, pos)
-        self._size += 1
-        return pos._right
-
-    # def replace(self, item, pos):
-    #     if pos is None:
-    #         raise TypeError("Not a valid position.")
-    #     old = pos._item
-    #     pos.setItem(item)
-    #     return old
-# End of class LinkedBinaryTree
-
-
-class BinarySearchTree(LinkedBinaryTree):
-    def __init__(self, pat_num=None, pat_his=None, pat_docass=None, Tleft=None, Tright=None):
-        super().__init__(pat_num, pat_his, pat_docass, Tleft, Tright)
-
-    def insert(self, pat_num, pathis, pat_doc, pos):
-
-        if pat_num == pos.pat_num:
-            pos.pat_his.extend(pathis)
-        elif pat_num < pos.pat_num:
-            if pos._left is None:
-                pos._left = self.addLeft(pat_num, pathis, pat_doc, pos)
-            else:
-                self.insert(pat_num, pathis, pat_doc, pos._left)
-        elif pat_num > pos.pat_num:
-            if pos._right is None:
-                pos._right = self.addRight(pat_num, pathis, pat_doc, pos)
-            else:
-                self.insert(pat_num, pathis, pat_doc, pos._right)
-
-    def search(self, patnum, pos):
-        print(pos)
-
-        if patnum == pos.pat_num:
-            return pos
-        elif patnum < pos.pat_num and pos._left is not None:
-            return self.search(patnum, pos._left)
-        elif patnum > pos.pat_num and pos._right is not None:
-            return self.search(patnum, pos._right)
-
-    def findmax(self, pos=None):
-        if pos is None:
-            return pos._parent
-        elif pos._right is not None:
-            return self.findmax(pos._right)
-        else:
-            return pos
-
-    def findmin(self, pos=None):
-        if pos is None:
-            return pos._parent
-        elif pos.left is not None:
-            return self.findmin(pos._left)
-        else:
-            return pos
-
-    def delete(self, patnum):
-        pos = self.search(patnum, self._root)
-
-        parent = pos._parent
-        if pos._left is None and pos._right is None:  # No children
-
-            if parent._left == pos:
-                parent._left = None
-                self.size -= 1
-                return
-            elif parent.right == pos:
-                parent.right = None
-                self.size -= 1
-        elif pos._left is not None and pos._right is None:  # one children - left
-            parent._left = pos._left
-            pos._parent = pos._left = pos._right = None
-            self._size -= 1
-        elif pos._right is not None and pos._left is None:  # one children - right
-            parent._right = pos._right
-            pos._parent = pos._left = pos._right = None
-            self._size -= 1
-        else:  # Two children
-            r = self.findmin(pos._right)
-            pos.pat_num = r.pat_num
-            r.pat_num = 1000000
-            self.delete(r.pat_num)
-
-
-bstcsp = BinarySearchTree()
-bstgendoc = BinarySearchTree()
+# Resolved on first use, so that importing the views (e.g. for the URL
+# checks of every manage.py command) does not open the clinic state
+state = SimpleLazyObject(get_state)
 
 
 class Patient_object:
@@ -451,39 +58,15 @@ class Patient_object:
         self.p_num = p_num
 
 
-class queuepatientobject:
-    def __init__(self, p_name, p_doc, p_num):
-        self.patname = p_name
-        self.doc = p_doc
-        self.pnum = p_num
-
-
-class Queue:
-    def __init__(self, d_name):
-        self.queue = []
-        self.doc = d_name
-
-    def enqueue(self, patient):
-        self.queue.append(patient)
-
-    def dequeue(self):
-        if not self.is_empty():
-            return self.queue.pop(0)
-        else:
-            return None
-
-    def emergency(self, patient):
-        self.queue.insert(0, patient)
-
-    def is_empty(self):
-        return len(self.queue) == 0
-
-    def size(self):
-        return len(self.queue)
+appointments = AppointmentStore()
+throttle = LoginThrottle()
 
 
-qcsp = Queue('csp')
-qdoc = Queue('gendoc')
+def _invalidphone(request):
+    return render(request,
+                  'removepatientdisplay.html',
+                  {"alertmessage": "invalid phone number!"},
+                  )
 
 
 def home(request):
@@ -495,10 +78,13 @@ def patient(request):
         username = request.POST.get('username')
         password = request.POST.get('password')
 
-        if not username.endswith('pat'):
+        role = resolve(username)[0]
+        if role != 'patient':
             return redirect('home')
 
         if 'login' in request.POST:
+            if not throttle.allow(username, role):
+                return render(request, 'patientlogin.html', status=429)
             user = authenticate(username=username, password=password)
 
             # user_exists = User.objects.filter(username=username).exists()
@@ -507,20 +93,25 @@ def patient(request):
             #     return redirect('/patient/patientform')
             # else:
             #     return render(request, '/patient/patientlogin.html')
-            print(user)
+            log_event(logger, 'auth.login', username=username, role=role,
+                      success=user is not None)
             if user is not None:
                 login(request, user)
+                remember(request, role)
+                throttle.succeeded(username)
                 return redirect('/patient/patientform')
             else:
-                return render(request, r'D:\c++ course\python\clinic\templates\patientlogin.html')
+                return render(request, 'patientlogin.html')
 
         elif 'signup' in request.POST:
             if User.objects.filter(username=username).exists():
                 # User with the given username already exists
-                return render(request, r'D:\c++ course\python\clinic\templates\response2.html')
+                return render(request, 'response2.html')
             else:
                 user = User.objects.create_user(
                     username=username, password=password)
+                login(request, user)
+                remember(request, role)
                 return redirect('/patient/patientform')
 
     else:
@@ -532,19 +123,26 @@ def doctor(request):
         username = request.POST.get('username')
         password = request.POST.get('password')
 
-        if not username.endswith('doc'):
+        role, doctor_ass = resolve(username)
+        if role != 'doctor':
             return redirect('home')
 
         if 'login' in request.POST:
+            if not throttle.allow(username, role):
+                return render(request, 'doctorlogin.html', status=429)
             user = authenticate(username=username, password=password)
+            log_event(logger, 'auth.login', username=username, role=role,
+                      success=user is not None)
             if user is not None:
                 login(request, user)
-                if username == 'sridharandoc':
+                remember(request, role, doctor_ass)
+                throttle.succeeded(username)
+                if doctor_ass == 'csp':
                     return redirect('/doctor/doctorcsphome')
-                elif username == 'vijayalakshmidoc':
+                elif doctor_ass == 'gendoc':
                     return redirect('/doctor/doctorgendochome')
             else:
-                return render(request, r'D:\c++ course\python\clinic\templates\doctorlogin.html')
+                return render(request, 'doctorlogin.html')
 
         # elif 'signup' in request.POST:
         #     if User.objects.filter(username=username).exists():
@@ -561,13 +159,20 @@ def receptionist(request):
         username = request.POST.get('username')
         password = request.POST.get('password')
 
-        if not username.endswith('rep'):
+        role = resolve(username)[0]
+        if role != 'receptionist':
             return redirect('home')
 
         if 'login' in request.POST:
+            if not throttle.allow(username, role):
+                return render(request, 'receptionistlogin.html', status=429)
             user = authenticate(username=username, password=password)
+            log_event(logger, 'auth.login', username=username, role=role,
+                      success=user is not None)
             if user is not None:
                 login(request, user)
+                remember(request, role)
+                throttle.succeeded(username)
                 return redirect('/receptionist/recephome')
             else:
                 return render(request, 'receptionistlogin.html')
@@ -582,6 +187,7 @@ def receptionist(request):
     return render(request, 'receptionistlogin.html')
 
 
+@role_required('patient')
 def makeappointment(request):
     if request.method == 'POST':
         if 'submit' in request.POST:
@@ -600,8 +206,11 @@ def makeappointment(request):
             # if others_option:
             #     patgen='others'
             doctor_ass = request.POST.get('doc_ass', None)
-            pat_num = request.POST.get('p_num')
+            pat_num = canonical_phone(request.POST.get('p_num'))
+            if pat_num is None:
+                return _invalidphone(request)
             pat_sym = request.POST.get('symptoms')
+            typed_sym = pat_sym
             currentdate = datetime.today().date()
             pat_sym = [pat_sym+','+str(currentdate)]
 
@@ -609,122 +218,41 @@ def makeappointment(request):
             # date=datetime.date.today()
             p_obj = Patient_object(
                 pat_name, pat_age, pat_emailid, patgen, doctor_ass, pat_num)
+            data = [pat_name, pat_age, pat_emailid,
+                    patgen, doctor_ass, pat_num]
             if p_obj.p_doc == 'csp':
-                fr = open(
-                    r'D:\c++ course\python\clinic\appointment\appointmentcsp.csv', 'r')
-                reader = csv.reader(fr)
-                reader = list(reader)
-                print(len(reader))
-                # if len(reader)!=1:
-                #     for i in reader:
-                #         if i[5]==pat_num:
-                #             return render(
-                #             request,
-                #             r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                #             {"alertmessage": "you have already booked an appointment!"},
-                #         ) 
-                #         else:
-                #             pass
-                        
-                if len(reader) < 3:
-
-                    fw = open(
-                        r'D:\c++ course\python\clinic\appointment\appointmentcsp.csv', 'a', newline="")
-                    writer = csv.writer(fw)
-                    data = [pat_name, pat_age, pat_emailid,
-                            patgen, doctor_ass, pat_num]
-                    writer.writerow(data)
-
-                    fw.close()
-                    if len(bstcsp) == 0:
-                        bstcsp.addRoot(pat_num, pat_sym, doctor_ass)
-                        print('hi')
-                    else:
-                        k = bstcsp.search(pat_num, bstcsp._root)
-                        if k is None:
-                            bstcsp.insert(pat_num, pat_sym,
-                                          doctor_ass, bstcsp._root)
-                            print('again')
-                        else:
-                            k.pat_his.extend(pat_sym)
+                if appointments.book('csp', data):
+                    log_event(logger, 'appointment.booked', doctor='csp', phone=pat_num)
+                    state.add_history('csp', pat_num, pat_sym)
+                    daily.symptoms('csp', typed_sym)
                 else:
+                    log_event(logger, 'appointment.full', doctor='csp', phone=pat_num)
+                    daily.count('csp', FULL)
                     return render(
                         request,
-                        r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
+                        'removepatientdisplay.html',
                         {"alertmessage": "appointments are filled!"},
                     )
 
             elif p_obj.p_doc == 'gendoc':
-                fr = open(
-                    r'D:\c++ course\python\clinic\appointment\appointmentgendoc.csv', 'r')
-                reader = csv.reader(fr)
-                reader = list(reader)
-                # if len(reader)!=0:
-                #     for i in reader:
-                #         if i[5]==pat_num:
-                #             return render(
-                #             request,
-                #             r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                #             {"alertmessage": "you have already booked an appointment!"},
-                #         ) 
-                #         else:
-                #             pass
-                if len(reader) < 3:
-
-                    fw = open(
-                        r'D:\c++ course\python\clinic\appointment\appointmentgendoc.csv', 'a', newline="")
-                    data = [pat_name, pat_age, pat_emailid,
-                            patgen, doctor_ass, pat_num]
-                    writer = csv.writer(fw)
-                    writer.writerow(data)
-                    fw.close()
-                    if len(bstgendoc) == 0:
-                        bstgendoc.addRoot(pat_num, pat_sym, doctor_ass)
-                    else:
-                        bstgendoc.insert(pat_num, pat_sym,
-                                         doctor_ass, bstgendoc._root)
+                if appointments.book('gendoc', data):
+                    log_event(logger, 'appointment.booked', doctor='gendoc', phone=pat_num)
+                    state.add_history('gendoc', pat_num, pat_sym)
+                    daily.symptoms('gendoc', typed_sym)
                 else:
+                    log_event(logger, 'appointment.full', doctor='gendoc', phone=pat_num)
+                    daily.count('gendoc', FULL)
                     return render(
                         request,
-                        r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
+                        'removepatientdisplay.html',
                         {"alertmessage": "appointments are filled!"},
                     )
 
-            # fr=open(r'D:\c++ course\python\clinic\appointment\history.csv','r')
-            # reader=csv.reader(fr)
-            # tot_data=list(reader)
-            # for data in tot_data:
-            #     if data[-2]==pat_num and data[-3]==doctor_ass:
-            #         data[-1].append(pat_sym)
-            #         break
-            # else:
-            #     tot_data.append([pat_name,pat_emailid,patgen,doctor_ass,pat_num,pat_sym])
-
-            # fr.close()
-
-            # f=open(r'D:\c++ course\python\clinic\appointment\history.csv','w')
-            # writer=csv.writer(f)
-            # for data in tot_data:
-            #     writer.writerow(data)
-            # f.close()
-            # if doctor_ass=='csp':
-            #     if len(bstcsp)==0:
-            #         bstcsp.addRoot(pat_num,pat_sym,doctor_ass)
-            #         print('hi')
-            #     else:
-            #         bstcsp.insert(pat_num,pat_sym,doctor_ass,bstcsp._root)
-            #         print('again')
-            elif doctor_ass == 'gendoc':
-                if len(bstgendoc) == 0:
-                    bstgendoc.addRoot(pat_num, pat_sym, doctor_ass)
-                else:
-                    bstgendoc.insert(pat_num, pat_sym,
-                                     doctor_ass, bstgendoc._root)
-
-            return render(request, r'D:\c++ course\python\clinic\templates\response1.html')
+            return render(request, 'response1.html')
     return render(request, 'patient-form.html')
 
 
+@role_required('receptionist')
 def addpatienttoqueue(request):
     if request.method == 'POST':
 
@@ -743,206 +271,235 @@ def addpatienttoqueue(request):
             # if others_option:
             #     patgen='others'
             doctor_ass = request.POST.get('doc_ass', None)
-            pat_num = request.POST.get('p_num')
+            pat_num = canonical_phone(request.POST.get('p_num'))
+            if pat_num is None:
+                return _invalidphone(request)
 
             if doctor_ass == 'csp':
-                f = open(
-                    r'D:\c++ course\python\clinic\appointment\appointmentcsp.csv', 'r', newline="")
-                reader = csv.reader(f)
-                reader = list(reader)
-                try:
-                    for row in reader:
-                        if row[0] == pat_name and row[-1] == pat_num:
-                            pat_obj = queuepatientobject(
-                                pat_name, doctor_ass, pat_num)
-                            qcsp.enqueue(pat_obj)
-                            return render(
-                                request,
-                                r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                                {"alertmessage": "appointment found you can wait in the queue!"},
-                            )
-                            break
-                    else:
-
-                        return render(
-                            request,
-                            r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                            {"alertmessage": "appointment not found!"},
-                        )
-                except:
+                if appointments.find('csp', pat_name, pat_num) is not None:
+                    pat_obj = queuepatientobject(
+                        pat_name, doctor_ass, pat_num)
+                    if state.enqueue('csp', pat_obj):
+                        daily.count('csp', ATTENDED)
+                    log_event(logger, 'queue.checkin', doctor='csp', phone=pat_num)
+                    return render(
+                        request,
+                        'removepatientdisplay.html',
+                        {"alertmessage": "appointment found you can wait in the queue!"},
+                    )
+                else:
                     return render(
                         request,
-                        r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
+                        'removepatientdisplay.html',
                         {"alertmessage": "appointment not found!"},
                     )
 
-                f.close()
-
             elif doctor_ass == 'gendoc':
-                f = open(
-                    r'D:\c++ course\python\clinic\appointment\appointmentgendoc.csv', 'r', newline="")
-                reader = csv.reader(f)
-                reader = list(reader)
-                try:
-                    for row in reader:
-                        print(row)
-                        # if len(row) ==0:
-                        #     return render(
-                        #     request,
-                        #     r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                        #     {"alertmessage": "appointment not found!"},
-                        #     )
-                        if row[0] == pat_name and row[-1] == pat_num:
-                            pat_obj = queuepatientobject(
-                                pat_name, doctor_ass, pat_num)
-                            qdoc.enqueue(pat_obj)
-                            return render(
-                                request,
-                                r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                                {"alertmessage": "appointment  found  you can wait in the queue!"},
-                            )
-                            break
-
-                    else:
-                        print('a')
-                        return render(
-                            request,
-                            r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                            {"alertmessage": "appointment not found!"},
-                        )
-                except:
+                if appointments.find('gendoc', pat_name, pat_num) is not None:
+                    pat_obj = queuepatientobject(
+                        pat_name, doctor_ass, pat_num)
+                    if state.enqueue('gendoc', pat_obj):
+                        daily.count('gendoc', ATTENDED)
+                    log_event(logger, 'queue.checkin', doctor='gendoc', phone=pat_num)
+                    return render(
+                        request,
+                        'removepatientdisplay.html',
+                        {"alertmessage": "appointment  found  you can wait in the queue!"},
+                    )
+                else:
                     return render(
                         request,
-                        r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
+                        'removepatientdisplay.html',
                         {"alertmessage": "appointment not found!"},
                     )
 
-                f.close()
-
     return render(request, 'addpatqueue.html')
 
 
+@role_required('receptionist')
+def patientlookup(request):
+    """ Typeahead for the reception forms: the patients whose phone number
+    or name starts with `q' (optionally only those of `doctor'), as JSON.
+    """
+    query = request.GET.get('q', '').strip()
+    doctor = request.GET.get('doctor') or None
+    try:
+        limit = min(int(request.GET.get('k', settings.CLINIC_LOOKUP_LIMIT)), settings.CLINIC_LOOKUP_LIMIT)
+    except ValueError:
+        limit = settings.CLINIC_LOOKUP_LIMIT
+    if not query or limit < 1:
+        return JsonResponse({'matches': []})
+    return JsonResponse({'matches': lookup.search(query, limit, doctor)})
+
+
+def _triage(value):
+    """ The triage level typed in the emergency form, or the most urgent
+    one if `value' is not a level an emergency can be given.
+    """
+    try:
+        level = int(value)
+    except (TypeError, ValueError):
+        return PatientQueue.EMERGENCY
+    if not PatientQueue.EMERGENCY <= level < PatientQueue.REGULAR:
+        return PatientQueue.EMERGENCY
+    return level
+
+
+@role_required('receptionist')
 def emergency(request):
     if request.method == 'POST':
 
         if 'submit' in request.POST:
             pat_name = request.POST.get('p_name')
             doctor_ass = request.POST.get('doc_ass', None)
-            pat_num = request.POST.get('p_num')
+            pat_num = canonical_phone(request.POST.get('p_num'))
+            if pat_num is None:
+                return _invalidphone(request)
+            triage = _triage(request.POST.get('triage'))
 
             if doctor_ass == 'csp':
 
                 pat_obj = queuepatientobject(pat_name, doctor_ass, pat_num)
-                qcsp.emergency(pat_obj)
+                state.emergency('csp', pat_obj, triage)
                 return render(request,
-                              r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
+                              'removepatientdisplay.html',
                               {"alertmessage": "you can wait in the queue!"},
                               )
 
             elif doctor_ass == 'gendoc':
 
                 pat_obj = queuepatientobject(pat_name, doctor_ass, pat_num)
-                qdoc.emergency(pat_obj)
+                state.emergency('gendoc', pat_obj, triage)
                 return render(
                     request,
-                    r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
+                    'removepatientdisplay.html',
                     {"alertmessage": " you can wait in the queue!"},
                 )
 
     return render(request, 'emergency.html')
 
 
+@role_required('receptionist')
 def addpat(request):
     return render(request, 'addpatqueue.html')
 
 
+@role_required('receptionist')
 def recephome(request):
-    return render(request, r'D:\c++ course\python\clinic\templates\recp.html')
+    return render(request, 'recp.html')
 
 
+@role_required('doctor', 'csp')
 def doccsphome(request):
-    return render(request, r'D:\c++ course\python\clinic\templates\doctorcsphome.html')
+    return render(request, 'doctorcsphome.html')
 
 
+@role_required('doctor', 'gendoc')
 def gendochome(request):
-    return render(request, r'D:\c++ course\python\clinic\templates\doctorgendoc.html')
+    return render(request, 'doctorgendoc.html')
 
 
-def patientcsphistory(request):
-    if request.method != 'POST':
-        return render(request, r'D:\c++ course\python\clinic\templates\searchhistorycsp.html')
+def _history_query(request):
+    """ Returns (pat_num, since, cursor) of a history search, sent either
+    by the search form (POST) or by a page link (GET), or `None' if no
+    patient was asked for.
+    """
+    if request.method == 'POST':
+        if 'submit' not in request.POST:
+            return None
+        params = request.POST
     else:
-        if 'submit' in request.POST:
+        params = request.GET
+    pat_num = canonical_phone(params.get('p_num'))
+    if pat_num is None:
+        return None
+    try:
+        since = date.fromisoformat(params.get('since', ''))
+    except ValueError:
+        since = None
+    cursor = params.get('cursor') or None
+    if cursor is not None and not state.valid_cursor(cursor):
+        # A stale or edited link: start from the first page
+        cursor = None
+    return pat_num, since, cursor
+
+
+def _patienthistory(request, doctor, search_template, history_template):
+    """ History search of `doctor'. The history list is a cached fragment
+    (see templating); the history is only read when the fragment for the
+    current history version of the patient is not cached, and then comes
+    from the history cache (see historycache) if it can.
+    """
+    query = _history_query(request)
+    if query is None:
+        return render(request, search_template)
+    pat_num, since, cursor = query
+    version = history_version(doctor, pat_num)
+    page = None
+    if not fragment_cached('history', doctor, pat_num, since, cursor, version):
+        page = histories.page(doctor, pat_num, since, cursor, version=version)
+        if page is None:
+            return render(request,
+                          'removepatientdisplay.html',
+                          {"alertmessage": f'{pat_num} history not found'},
+                          )
 
-            pat_num = request.POST.get('p_num')
+    def load():
+        # Only called if the fragment expired after the check above
+        nonlocal page
+        if page is None:
+            page = histories.page(doctor, pat_num, since, cursor, version=version) or ([], None)
+        return page
 
-            # print(bstcsp._root.pat_num)
-            if bstcsp._root is not None:
-                pos = bstcsp.search(pat_num, bstcsp._root)
+    context = {'des': lambda: load()[0], 'next_cursor': lambda: load()[1], 'doctor': doctor,
+               'p_num': pat_num, 'since': since, 'cursor': cursor, 'version': version}
+    return render(request, history_template, context)
+
+
+@role_required('doctor', 'csp')
+def patientcsphistory(request):
+    return _patienthistory(request, 'csp', 'searchhistorycsp.html', 'patienthistoryviewcsp.html')
 
-                if pos == None:
-                    return render(request,
-                              r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                              {"alertmessage": f'{pat_num} history not found'},
-                              )
-                    
-                else:
-                    # return HttpResponse(f'this is the history of patient :{pos.pat_his}')
-                    context={'des':pos.pat_his,'k':0}
-                
-                    return render(request,'patienthistoryviewcsp.html',context)
-            else:
-                return render(request,
-                              r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                              {"alertmessage": f'{pat_num} history not found'},
-                              )
-                
 
+@role_required('doctor', 'csp')
 def presriptioncsp(request):
     if request.method != 'POST':
-        return render(request, r'D:\c++ course\python\clinic\templates\prescriptioncsp.html')
+        return render(request, 'prescriptioncsp.html')
     else:
         if 'submit' in request.POST:
 
-            pat_num = request.POST.get('p_num')
+            pat_num = canonical_phone(request.POST.get('p_num'))
+            if pat_num is None:
+                return _invalidphone(request)
             pat_sym=request.POST.get('p_problems')
             currentdate=datetime.today().date()
             pat_pre=request.POST.get('Prescription')
             doctor_ass='csp'
-            pat_sym=[pat_sym+' '+pat_pre+','+str(currentdate)]
-            k = bstcsp.search(pat_num, bstcsp._root)
-            if k is None:
-                bstcsp.insert(pat_num, pat_sym,doctor_ass, bstcsp._root)
-                print('again')
-            else:
-                popped=k.pat_his.pop()
-                k.pat_his.extend(pat_sym) 
+            pat_sym=pat_sym+' '+pat_pre+','+str(currentdate)
+            state.amend_history(doctor_ass, pat_num, pat_sym)
             return render(request,
-                              r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
+                              'removepatientdisplay.html',
                               {"alertmessage": "medical history has been updated!"},
                               ) 
         
+@role_required('doctor', 'gendoc')
 def presriptiongendoc(request):
     if request.method != 'POST':
-        return render(request, r'D:\c++ course\python\clinic\templates\prescriptiongendoc.html')
+        return render(request, 'prescriptiongendoc.html')
     else:
         if 'submit' in request.POST:
 
-            pat_num = request.POST.get('p_num')
+            pat_num = canonical_phone(request.POST.get('p_num'))
+            if pat_num is None:
+                return _invalidphone(request)
             pat_sym=request.POST.get('p_problems')
             currentdate=datetime.today().date()
             pat_pre=request.POST.get('Prescription')
             doctor_ass='gendoc'
-            pat_sym=[pat_sym+' '+pat_pre+','+str(currentdate)]
-            k = bstgendoc.search(pat_num, bstgendoc._root)
-            if k is None:
-                bstgendoc.insert(pat_num, pat_sym,doctor_ass, bstgendoc._root)
-                print('again')
-            else:
-                popped=k.pat_his.pop()
-                k.pat_his.extend(pat_sym) 
+            pat_sym=pat_sym+' '+pat_pre+','+str(currentdate)
+            state.amend_history(doctor_ass, pat_num, pat_sym)
             return render(request,
-                              r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
+                              'removepatientdisplay.html',
                               {"alertmessage": "medical history has been updated!"},
                               ) 
                  
@@ -964,100 +521,245 @@ def presriptiongendoc(request):
             # self.insert(pat_num, pathis, pat_doc, pos._right)
     
 
+@role_required('receptionist')
 def clearappointments(request):
-    fw = open(r'D:\c++ course\python\clinic\appointment\appointmentcsp.csv', 'w')
-    fw.close()
-    fw = open(r'D:\c++ course\python\clinic\appointment\appointmentgendoc.csv', 'w')
-    fw.close()
+    appointments.rollover('csp')
+    appointments.rollover('gendoc')
     return render(request,
-                  r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
+                  'removepatientdisplay.html',
                   {"alertmessage": "all appointments made today are cancelled!"},
                   )
 
 
+@role_required('doctor', 'gendoc')
 def patientgendochistory(request):
-    if request.method != 'POST':
-        return render(request, r'D:\c++ course\python\clinic\templates\searchhistorygendoc.html')
-    else:
-        if 'submit' in request.POST:
+    return _patienthistory(request, 'gendoc', 'searchhistorygendoc.html', 'patienthistoryviewgendoc.html')
 
-            pat_num = request.POST.get('p_num')
 
-            if bstgendoc._root is not None:
-                pos = bstgendoc.search(pat_num, bstgendoc._root)
+def _date(value):
+    try:
+        return date.fromisoformat(value or '')
+    except ValueError:
+        return None
 
-                if pos == None:
-                    return render(request,
-                              r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                              {"alertmessage": f'{pat_num} history not found'},
-                              )
-                else:
-                    # return HttpResponse(f'this is the history of patient :{pos.pat_his}')
-                    context={'des':pos.pat_his}
-                
-                    return render(request,'patienthistoryviewgendoc.html',context)
-            else:
-                return render(request,
-                              r'D:\c++ course\python\clinic\templates\removepatientdisplay.html',
-                              {"alertmessage": f'{pat_num} history not found'},
-                              )
+
+@role_required('doctor')
+def historysearch(request):
+    """ Keyword search over the history of every patient: the entries
+    holding every word of `q' (a symptom, a drug...), optionally only
+    those of `doctor' and dated from `since' to `until', as JSON.
+    """
+    query = request.GET.get('q', '')
+    try:
+        limit = min(int(request.GET.get('k', settings.CLINIC_HISTORY_SEARCH_LIMIT)),
+                    settings.CLINIC_HISTORY_SEARCH_LIMIT)
+    except ValueError:
+        limit = settings.CLINIC_HISTORY_SEARCH_LIMIT
+    matches = history_index.search(query, _date(request.GET.get('since')), _date(request.GET.get('until')),
+                                   request.GET.get('doctor') or None, max(limit, 0))
+    return JsonResponse({'matches': matches})
+
+
+@role_required('doctor')
+def patientrecord(request):
+    """ The details of patient `p_num' and their history with every
+    doctor, oldest first, as JSON.
+    """
+    pat_num = canonical_phone(request.GET.get('p_num'))
+    if pat_num is None:
+        raise Http404("Invalid phone number")
+    demographics = patients.get(pat_num)
+    records = state.patient_history(pat_num)
+    if demographics is None and records is None:
+        raise Http404("Unknown patient")
+    return JsonResponse({
+        'phone': pat_num,
+        'patient': demographics._asdict() if demographics is not None else None,
+        'history': [{'doctor': record.doctor, 'date': record.date.isoformat(), 'text': record.text}
+                    for record in records or ()],
+    })
+
+
+@role_required('receptionist')
+def dailyreport(request):
+    """ Bookings, check-ins, no-shows, emergencies, patients seen and
+    top symptoms of each doctor on `date' (today by default).
+    """
+    day = _date(request.GET.get('date')) or timezone.localdate()
+    daily.flush()
+    report = daily.report(day)
+    return render(request, 'dailyreport.html', {"day": day, "report": report})
 
 
-def showcspqueuetodoc(request):
-    context = {}
-    i = 0
-    for detail in qcsp.queue:
-        i += 1
-        context[i] = detail
+@role_required('receptionist')
+def dailyreportcsv(request):
+    """ The daily figures of each doctor from `since' to `until' (the
+    last CLINIC_ANALYTICS_EXPORT_DAYS days by default), as CSV.
+    """
+    until = _date(request.GET.get('until')) or timezone.localdate()
+    since = _date(request.GET.get('since')) or until - timedelta(days=settings.CLINIC_ANALYTICS_EXPORT_DAYS - 1)
+    daily.flush()
+    response = HttpResponse(content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="clinic-{since}-{until}.csv"'
+    writer = csv.writer(response)
+    writer.writerow(['date', 'doctor', 'booked', 'turned away', 'checked in', 'no-shows',
+                     'emergencies', 'seen', 'top symptoms'])
+    for day, report in daily.range(since, until).items():
+        for doctor, counts in report.items():
+            writer.writerow([day.isoformat(), doctor, counts[BOOKED], counts[FULL], counts[CHECKIN],
+                             counts['no_shows'], counts[EMERGENCY], counts[SEEN],
+                             '; '.join(f'{symptom} ({count})' for symptom, count in counts['symptoms'])])
+    return response
+
+
+def _showqueue(request, doctor, template):
+    """ Queue table of `doctor'. `result' is a callable, so the queue is
+    only read when the cached table fragment is out of date.
+    """
+    def result():
+        return {i: detail for i, detail in enumerate(state.queue(doctor), 1)}
 
-    return render(request, "queuedetailcsp.html", {"result": context})
+    return render(request, template, {"result": result, "doctor": doctor,
+                                      "version": queue_version(doctor)})
 
 
-def showgendocqueue(request):
-    context = {}
-    i = 0
-    for detail in qdoc.queue:
-        i += 1
-        context[i] = detail
+@role_required('doctor', 'csp')
+def showcspqueuetodoc(request):
+    return _showqueue(request, 'csp', "queuedetailcsp.html")
 
-    return render(request, "queuedetailgendoc.html", {"result": context})
 
+@role_required('doctor', 'gendoc')
+def showgendocqueue(request):
+    return _showqueue(request, 'gendoc', "queuedetailgendoc.html")
 
-def showqueuecsp(request):
-    context = {}
-    i = 0
-    for detail in qcsp.queue:
-        i += 1
-        context[i] = detail
 
-    return render(request, "queuedetailcsp.html", {"result": context})
+@role_required('receptionist')
+def showqueuecsp(request):
+    return _showqueue(request, 'csp', "queuedetailcsp.html")
 
 
+@role_required('receptionist')
 def showqueuegendoc(request):
-    context = {}
-    i = 0
-    for detail in qdoc.queue:
-        i += 1
-        context[i] = detail
+    return _showqueue(request, 'gendoc', "queuedetailgendoc.html")
+
 
-    return render(request, "queuedetailgendoc.html", {"result": context})
+def _called(patient):
+    """ Message shown when `patient' is called in, with the expected
+    wait of the next patient.
+    """
+    waiting = state.queue_size(patient.doc)
+    if not waiting:
+        return f"{patient.patname} can meet {patient.doc}"
+    wait = estimator.estimate(patient.doc, 1)[0]
+    return (f"{patient.patname} can meet {patient.doc} "
+            f"({waiting} waiting, next in about {round(wait / 60)} min)")
 
 
+@role_required('receptionist')
 def dequeuegendoc(request):
-    rem_patient = qdoc.dequeue()
+    rem_patient = state.dequeue('gendoc')
     if rem_patient != None:
-        return (render(request, r'D:\c++ course\python\clinic\templates\removepatientdisplay.html', {"alertmessage": f"{rem_patient.patname} can meet {rem_patient.doc}"}))
+        return (render(request, 'removepatientdisplay.html', {"alertmessage": _called(rem_patient)}))
 
     else:
-        return render(request, r'D:\c++ course\python\clinic\templates\response3.html')
+        return render(request, 'response3.html')
 
 
+@role_required('receptionist')
 def dequeuecsp(request):
-    rem_patient = qcsp.dequeue()
+    rem_patient = state.dequeue('csp')
     if rem_patient != None:
-        return render(request, r'D:\c++ course\python\clinic\templates\removepatientdisplay.html', {"alertmessage": f"{rem_patient.patname} can meet {rem_patient.doc}"})
+        return render(request, 'removepatientdisplay.html', {"alertmessage": _called(rem_patient)})
+    else:
+        return render(request, 'response3.html')
+
+
+@role_required(('receptionist', 'doctor'))
+def queuewait(request, doctor):
+    """ The expected wait of every patient in the queue of `doctor' and
+    the consultation times it is based on, as JSON.
+    """
+    if doctor not in DOCTORS:
+        raise Http404("Unknown doctor")
+    now = time.time()
+    patients = []
+    for position, patient in enumerate(state.queue(doctor), 1):
+        wait, wait_p90 = estimator.estimate(doctor, position, now)
+        patients.append({'position': position, 'name': patient.patname, 'phone': patient.pnum,
+                         'wait_seconds': round(wait), 'wait_p90_seconds': round(wait_p90)})
+    return JsonResponse({'doctor': doctor, 'consultation': estimator.summary(doctor),
+                         'patients': patients})
+
+
+@role_required(('receptionist', 'doctor'))
+async def queueevents(request, doctor):
+    """ Live queue board: a Server-Sent Events stream that starts with
+    the whole queue of `doctor' and then only sends the changes.
+    Needs an ASGI server (see clinic/asgi.py).
+    """
+    if doctor not in DOCTORS:
+        raise Http404("Unknown doctor")
+
+    async def stream():
+        sub = feed.subscribe(doctor)
+        try:
+            while True:
+                # (Re)load the whole queue. Queued events are older than
+                # the snapshot and are dropped: replayed after it, a stale
+                # 'enqueue' would bring back a patient who already left.
+                # Changes made from here on may be in the snapshot too,
+                # which is harmless: the screen drops the row of a patient
+                # before placing it again.
+                sub.reset()
+                patients = await sync_to_async(state.queue)(doctor)
+                yield sse('snapshot', [{'name': p.patname, 'doctor': p.doc, 'phone': p.pnum}
+                                       for p in patients])
+                while not sub.stale:
+                    try:
+                        event, data = await asyncio.wait_for(sub.events.get(), settings.CLINIC_QUEUE_HEARTBEAT)
+                    except asyncio.TimeoutError:
+                        # Keeps proxies from closing an idle stream
+                        yield ': ping\n\n'
+                        continue
+                    yield sse(event, data)
+        finally:
+            feed.unsubscribe(doctor, sub)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def metrics(request):
+    """ The metrics of this worker in the Prometheus text format.
+    Only served to the addresses in CLINIC_METRICS_ALLOWED_IPS.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.CLINIC_METRICS_ALLOWED_IPS:
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.\w+$')
+
+
+def staticasset(request, path):
+    """ Serves a collected static file from STATIC_ROOT. Content-hashed
+    names (see GzipManifestStaticFilesStorage) never change, so they are
+    cached for a year; the precompressed .gz copy is sent to clients
+    that accept gzip.
+    """
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '') and \
+            os.path.exists(os.path.join(settings.STATIC_ROOT, path + '.gz')):
+        response = serve(request, path + '.gz', document_root=settings.STATIC_ROOT)
+    else:
+        response = serve(request, path, document_root=settings.STATIC_ROOT)
+    if HASHED_NAME.search(path):
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
     else:
-        return render(request, r'D:\c++ course\python\clinic\templates\response3.html')
+        response['Cache-Control'] = f'public, max-age={settings.CLINIC_STATIC_MAX_AGE}'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
 
 
 # def makepayment(request):
@@ -0,0 +1,185 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from .models import DOCTORS
+from .signals import queue_changed
+
+
+class P2Quantile:
+    """ Streaming estimate of the `p' quantile of the values added, with
+    the P-square algorithm (Jain and Chlamtac): five markers are moved
+    towards their ideal places as values come in, so memory and the time
+    per value are constant.
+    """
+    __slots__ = ['p', 'count', '_heights', '_positions', '_desired', '_increments']
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        self.count += 1
+        q = self._heights
+        if self.count <= 5:
+            q.append(x)
+            q.sort()
+            return
+        n = self._positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+        for i in range(1, 4):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Piecewise-parabolic prediction, linear if it leaves the bracket
+                h = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = h
+                n[i] += d
+
+    def value(self):
+        """ Returns the estimated quantile, or `None' before any value.
+        """
+        if not self.count:
+            return None
+        if self.count <= 5:
+            # Nearest rank of the few values seen
+            return self._heights[max(0, math.ceil(self.count * self.p) - 1)]
+        return self._heights[2]
+# End of the class P2Quantile
+
+
+class ConsultationStats:
+    """ Running statistics of the consultation durations (seconds) of one
+    doctor: an exponentially weighted moving average and a P-square 90th
+    percentile, both updated in constant time and memory.
+    """
+    __slots__ = ['ewma', 'p90', 'count', '_alpha']
+
+    def __init__(self, alpha):
+        self._alpha = alpha
+        self.ewma = None
+        self.p90 = P2Quantile(0.9)
+        self.count = 0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.ewma = seconds if self.ewma is None else self.ewma + self._alpha * (seconds - self.ewma)
+        self.p90.add(seconds)
+# End of the class ConsultationStats
+
+
+class WaitEstimator:
+    """ Estimates how long the patients in the queues have to wait.
+
+    Queue changes (the `queue_changed' signal) are timestamped as they
+    happen. When a doctor calls the next patient, the time since the
+    previous call -- or since the patient joined, if the doctor was
+    waiting for them -- is the length of the consultation that just
+    ended, and is added to the statistics of the doctor. Gaps longer
+    than `max_seconds' (breaks, the night) are not consultations and
+    are skipped. Each event costs O(1).
+
+    The wait of the patient at position k is what is left of the
+    current consultation plus k - 1 average consultations. Until a
+    doctor has been timed, consultations are assumed to last
+    `default_seconds'. Only the queue changes made by this process
+    are seen.
+    """
+
+    def __init__(self, doctors=DOCTORS, default_seconds=None, max_seconds=None, alpha=None):
+        self._default = default_seconds if default_seconds is not None else settings.CLINIC_CONSULTATION_SECONDS
+        self._max = max_seconds if max_seconds is not None else settings.CLINIC_CONSULTATION_MAX_SECONDS
+        alpha = alpha if alpha is not None else settings.CLINIC_WAIT_EWMA_ALPHA
+        self._stats = {doctor: ConsultationStats(alpha) for doctor in doctors}
+        self._called = {}
+        self._joined = {doctor: {} for doctor in doctors}
+        self._lock = threading.Lock()
+
+    def joined(self, doctor, pnum, now=None):
+        with self._lock:
+            self._joined[doctor].setdefault(pnum, now if now is not None else time.time())
+
+    def left(self, doctor, pnum):
+        with self._lock:
+            self._joined[doctor].pop(pnum, None)
+
+    def called(self, doctor, pnum, now=None):
+        """ Records that `doctor' called patient `pnum' in.
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            joined = self._joined[doctor].pop(pnum, None)
+            previous = self._called.get(doctor)
+            self._called[doctor] = now
+            if previous is None:
+                return
+            start = max(previous, joined) if joined is not None else previous
+            if 0 < now - start <= self._max:
+                self._stats[doctor].observe(now - start)
+
+    def consultation(self, doctor):
+        """ Returns (average, 90th percentile) consultation seconds of `doctor'.
+        """
+        with self._lock:
+            stats = self._stats[doctor]
+            if stats.ewma is None:
+                return self._default, self._default
+            return stats.ewma, stats.p90.value()
+
+    def summary(self, doctor):
+        average, p90 = self.consultation(doctor)
+        return {'average_seconds': round(average), 'p90_seconds': round(p90),
+                'timed': self._stats[doctor].count}
+
+    def estimate(self, doctor, position, now=None):
+        """ Returns the (expected, 90th percentile) wait in seconds of the
+        patient at 1-based `position' in the queue of `doctor'.
+        """
+        now = now if now is not None else time.time()
+        average, p90 = self.consultation(doctor)
+        with self._lock:
+            called = self._called.get(doctor)
+        elapsed = now - called if called is not None else 0
+        return (max(average - elapsed, 0) + (position - 1) * average,
+                max(p90 - elapsed, 0) + (position - 1) * p90)
+
+    def receiver(self, sender, doctor, event, patient, position=None, **kwargs):
+        """ `queue_changed' receiver.
+        """
+        if event in ('enqueue', 'emergency'):
+            self.joined(doctor, patient.pnum)
+        elif event == 'dequeue':
+            self.called(doctor, patient.pnum)
+        elif event == 'remove':
+            self.left(doctor, patient.pnum)
+# End of the class WaitEstimator
+
+
+estimator = WaitEstimator()
+
+
+def connect():
+    queue_changed.connect(estimator.receiver, dispatch_uid='home.waittime.estimator')